@@ -1,10 +1,15 @@
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta, datetime
-from typing import Union
+from typing import Any, Callable, Union
 
 import jwt
 import bcrypt
 
-from api import config
+from api import config, metrics, mutations
 from api.domain import User
 from api.db import get_user_with_email
 from api.domain import ApplicationState
@@ -12,6 +17,87 @@ from api.domain import ApplicationState
 JWT_EXP = timedelta(days=1)
 
 
+class TokenCache:
+    """
+    Bounded LRU cache of already verified tokens, so that repeated requests
+    with the same token skip signature verification.  Entries are keyed by a
+    digest of the token (so raw tokens aren't kept around) and stop being
+    served once the token expires.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries: OrderedDict[bytes, tuple[float, User]] = OrderedDict()
+
+    def get(self, token: str) -> Union[User, None]:
+        digest = self._digest(token)
+        entry = self._entries.get(digest)
+        if entry is None:
+            return None
+
+        exp, user = entry
+        if exp <= time.time():
+            del self._entries[digest]
+            return None
+
+        self._entries.move_to_end(digest)
+        return user
+
+    def put(self, token: str, user: User, exp: float):
+        self._entries[self._digest(token)] = (exp, user)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    @staticmethod
+    def _digest(token: str) -> bytes:
+        return hashlib.sha256(token.encode()).digest()
+
+
+token_cache = TokenCache(config.AUTH_TOKEN_CACHE_SIZE)
+
+
+class HashingPoolFull(Exception):
+    pass
+
+
+class HashingPool:
+    """
+    Runs bcrypt on a small, dedicated thread pool, so that hashing passwords
+    doesn't block the event loop (bcrypt releases the GIL while it works).
+    Once `max_pending` calls are queued or running, further calls fail with
+    `HashingPoolFull` instead of piling up.
+    """
+
+    def __init__(self, workers: int, max_pending: int):
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self._pending = 0
+
+    async def run(self, fn: Callable[..., Any], *args) -> Any:
+        if self._pending >= self.max_pending:
+            raise HashingPoolFull()
+
+        self._pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        finally:
+            self._pending -= 1
+
+
+hashing_pool = HashingPool(config.AUTH_HASHING_WORKERS, config.AUTH_HASHING_MAX_PENDING)
+
+
+def get_hash_rounds(password_hash: str) -> int:
+    # bcrypt hashes look like $2b$<rounds>$<salt and hash>
+    return int(password_hash.split("$")[2])
+
+
+checkpw = metrics.PASSWORD_HASH_SECONDS.timed(operation="check")(bcrypt.checkpw)
+
+
 class AuthProvider:
     def __init__(self, db: ApplicationState):
         self.db = db
@@ -22,21 +108,91 @@ class AuthProvider:
             "email": user.email,
             "exp": datetime.now() + JWT_EXP,
         }
-        return jwt.encode(payload, config.AUTH_SECRET_KEY, algorithm="HS256")
+        with metrics.JWT_SECONDS.time(operation="encode"):
+            return jwt.encode(payload, config.AUTH_SECRET_KEY, algorithm="HS256")
 
     def validate_token(self, token: str) -> Union[User, None]:
+        if not token:
+            return None
+
+        user = token_cache.get(token)
+        metrics.CACHE_REQUESTS.inc(cache="token", result="hit" if user else "miss")
+        if user:
+            return self._if_still_exists(user)
+
         try:
-            payload = jwt.decode(token, config.AUTH_SECRET_KEY, algorithms=["HS256"])
-            return User(**payload)
-        except jwt.exceptions.DecodeError:
+            with metrics.JWT_SECONDS.time(operation="decode"):
+                payload = jwt.decode(
+                    token,
+                    config.AUTH_SECRET_KEY,
+                    algorithms=["HS256"],
+                    # tokens are cached until they expire
+                    options={"require": ["exp"]},
+                )
+        except jwt.exceptions.InvalidTokenError:
+            # includes expired tokens and ones without an expiry, not just
+            # malformed ones
+            return None
+
+        user = User(**payload)
+        token_cache.put(token, user, payload["exp"])
+        return self._if_still_exists(user)
+
+    def _if_still_exists(self, user: User) -> Union[User, None]:
+        # tokens outlive the users they were issued for when the database is
+        # replaced, so check the token's user against the email index
+        if self.db is None:
+            return user
+        stored = get_user_with_email(self.db, user.email)
+        if not stored:
             return None
 
+        # the household isn't part of the token, since it can change
+        if stored.household != user.household:
+            return user.copy(update={"household": stored.household})
+        return user
+
+    @metrics.PASSWORD_HASH_SECONDS.timed(operation="hash")
     def hash_pw(self, passwd: str) -> str:
-        return bcrypt.hashpw(passwd.encode(), bcrypt.gensalt())
+        return bcrypt.hashpw(passwd.encode(), bcrypt.gensalt(config.AUTH_BCRYPT_ROUNDS)).decode()
 
     def check_password(self, email: str, plaintext_password: str) -> Union[User, None]:
         user = get_user_with_email(self.db, email)
+        if not user or not user.password_hash:
+            return None
+
         # compare password hashes
-        bcrypt.checkpw(plaintext_password.encode(), user.password_hash.encode())
+        if not checkpw(plaintext_password.encode(), user.password_hash.encode()):
+            return None
+
+        return user
+
+    async def hash_pw_async(self, passwd: str) -> str:
+        """
+        `hash_pw` on the hashing pool.
+        """
+        return await hashing_pool.run(self.hash_pw, passwd)
+
+    async def login(self, email: str, plaintext_password: str) -> Union[User, None]:
+        """
+        `check_password` on the hashing pool.  If the user's hash was made
+        with a different cost than `config.AUTH_BCRYPT_ROUNDS`, it is
+        replaced with a new one while we have the plaintext password.
+        """
+        user = get_user_with_email(self.db, email)
+        if not user or not user.password_hash:
+            return None
+
+        matches = await hashing_pool.run(
+            checkpw, plaintext_password.encode(), user.password_hash.encode()
+        )
+        if not matches:
+            return None
+
+        if get_hash_rounds(user.password_hash) != config.AUTH_BCRYPT_ROUNDS:
+            password_hash = await self.hash_pw_async(plaintext_password)
+            await mutations.submit(
+                lambda db: db.set_password_hash(get_user_with_email(db, email), password_hash)
+            )
 
         return user
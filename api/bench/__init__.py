@@ -0,0 +1,29 @@
+"""
+Benchmarks, run with `./x.py bench` (or `python -m api.bench`), a load
+generator, run with `./x.py load` (see `api.bench.load`), and the synthetic
+data they run against, see `api.bench.generate`.
+"""
+import os
+
+from api import config
+
+
+def database_paths(directory: str) -> dict[str, str]:
+    """
+    Returns the config of a database in `directory`, for every backend.
+    """
+    db_path = os.path.join(directory, "db.json")
+    return {
+        "DB_PATH": db_path,
+        "DB_LOG_PATH": f"{db_path}.log",
+        "DB_LOCK_PATH": f"{db_path}.lock",
+        "DB_BINARY_PATH": os.path.join(directory, "db.bin"),
+        "DB_SQLITE_PATH": os.path.join(directory, "db.sqlite3"),
+        "DB_SHARD_DIR": os.path.join(directory, "db"),
+        "DB_HOUSEHOLD_DIR": os.path.join(directory, "households"),
+    }
+
+
+def use_database_in(directory: str):
+    for key, path in database_paths(directory).items():
+        setattr(config, key, path)
@@ -0,0 +1,161 @@
+"""
+Runs the benchmarks against a generated state in a temporary directory, and
+compares the results with those saved by an earlier `--save`.
+
+    python -m api.bench [--save] [--years 3] [--per-month 300] ...
+"""
+import argparse
+import json
+import os
+import statistics
+import tempfile
+import time
+from datetime import datetime
+from typing import Callable, Optional
+
+from api import config
+from api.bench import use_database_in
+
+BASELINE_PATH = os.path.join(config.BASE_DIR, "bench_baseline.json")
+
+
+def measure(run: Callable, repeat: int, number: int = 1, setup: Optional[Callable] = None):
+    """
+    Returns the median over `repeat` rounds of the time per call of `run`,
+    which is called `number` times per round, after `setup` (if any).
+    """
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        for _ in range(number):
+            run()
+        times.append((time.perf_counter() - start) / number)
+
+    return statistics.median(times)
+
+
+def run_benchmarks(repeat: int) -> dict[str, float]:
+    # imported here, so that nothing is set up before the database is moved
+    from fastapi.testclient import TestClient
+
+    from api.auth import AuthProvider, token_cache
+    from api.db import (
+        _delete_db_singleton,
+        get_db_instance,
+        get_user_with_email,
+        save_state_to_file,
+    )
+    from api.domain import MonthlyState, get_monthly_report
+    from api.main import app
+    from api.reports import get_serialized_monthly_report
+
+    results = {}
+    results["load"] = measure(get_db_instance, repeat, setup=_delete_db_singleton)
+
+    db = get_db_instance()
+    now = datetime.now()
+    current_month = MonthlyState.key_for_date(now)
+    # what a write costs in snapshot mode: one changed month
+    results["save"] = measure(
+        lambda: save_state_to_file(db), repeat, setup=lambda: db.mark_dirty(current_month)
+    )
+
+    state = db.get_current_state()
+    results["monthly_report"] = measure(
+        lambda: get_monthly_report(db, state, now), repeat, number=10
+    )
+    results["monthly_report_serialized"] = measure(
+        lambda: get_serialized_monthly_report(db, now), repeat, setup=db._report_cache.clear
+    )
+
+    email = db.users[-1].email.upper()
+    results["user_lookup"] = measure(lambda: get_user_with_email(db, email), repeat, number=1000)
+
+    auth = AuthProvider(db)
+    token = auth.create_jwt_for_user(db.users[0])
+    results["jwt_validate"] = measure(
+        lambda: auth.validate_token(token), repeat, number=1, setup=token_cache.clear
+    )
+    results["jwt_validate_cached"] = measure(
+        lambda: auth.validate_token(token), repeat, number=1000
+    )
+
+    client = TestClient(app)
+    cookies = {"auth_token": token}
+    results["request_report"] = measure(
+        lambda: client.get("/months/current", cookies=cookies), repeat, number=10
+    )
+    results["request_add_transaction"] = measure(
+        lambda: client.post(
+            "/transactions", cookies=cookies, json={"category": "Gas", "amount": 1000}
+        ),
+        repeat,
+    )
+
+    _delete_db_singleton()
+    return results
+
+
+def format_duration(seconds: float) -> str:
+    for unit, scale in [("s", 1), ("ms", 1e-3)]:
+        if seconds >= scale:
+            return f"{seconds / scale:.2f} {unit}"
+    return f"{seconds / 1e-6:.2f} µs"
+
+
+def print_comparison(results: dict[str, float], baseline: Optional[dict[str, float]]):
+    print(f"{'benchmark':<28}{'median':>12}{'baseline':>12}{'change':>10}")
+    for name, seconds in results.items():
+        previous = (baseline or {}).get(name)
+        if previous:
+            columns = f"{format_duration(previous):>12}{(seconds / previous - 1) * 100:>+9.1f}%"
+        else:
+            columns = f"{'-':>12}{'-':>10}"
+        print(f"{name:<28}{format_duration(seconds):>12}{columns}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the benchmarks")
+    parser.add_argument("--users", type=int, default=4)
+    parser.add_argument("--years", type=int, default=3)
+    parser.add_argument("--per-month", type=int, default=300)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save", action="store_true", help="Save the results as the baseline")
+    args = parser.parse_args()
+
+    from api.bench.generate import generate_state
+    from api.db import create_backend
+
+    params = {"users": args.users, "years": args.years, "per_month": args.per_month}
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r") as file:
+            saved = json.loads(file.read())
+        if saved["params"] == params:
+            baseline = saved["results"]
+        else:
+            print(f"Not comparing with the baseline, which used {saved['params']}")
+
+    with tempfile.TemporaryDirectory() as directory:
+        use_database_in(directory)
+        state = generate_state(args.users, args.years, args.per_month)
+        # whichever backend is configured is what gets measured
+        backend = create_backend(config.DB_BACKEND)
+        backend.save(state).result()
+        backend.close()
+
+        results = run_benchmarks(args.repeat)
+
+    print_comparison(results, baseline)
+
+    if args.save:
+        with open(args.baseline, "w") as file:
+            file.write(json.dumps({"params": params, "results": results}, indent=2))
+        print(f"Saved the results to {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
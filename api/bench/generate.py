@@ -0,0 +1,89 @@
+"""
+Generates synthetic but realistic application states: a few users, several
+years of months, and transactions whose categories follow a skewed
+distribution (a handful of categories account for most spending, like real
+budgets).
+
+    python -m api.bench.generate --users 4 --years 3 --per-month 300 > db.json
+"""
+import argparse
+import random
+from datetime import datetime, timedelta
+from typing import Optional
+
+import bcrypt
+
+from api.db import default_state, serialize_state
+from api.domain import ApplicationState, MonthlyState, Transaction, User
+
+TITLES = ["Costco", "Shell", "Target", "Amazon", "Kroger", "Chipotle", "Power bill", None]
+
+
+def generate_state(
+    users: int = 4,
+    years: int = 3,
+    per_month: int = 300,
+    seed: int = 0,
+    end: Optional[datetime] = None,
+) -> ApplicationState:
+    """
+    Returns a state with `users` users (user0@example.com etc., all with
+    the password "password") and `years` years of months up to and including
+    the month of `end` (default now), each with `per_month` transactions.
+    """
+    rng = random.Random(seed)
+    state = ApplicationState(**{**default_state, "users": [], "state": {}})
+
+    # hashed once with the cheapest cost, hashing isn't what's measured here
+    password_hash = bcrypt.hashpw(b"password", bcrypt.gensalt(4)).decode()
+    for i in range(users):
+        state.users.append(
+            User(name=f"User {i}", email=f"user{i}@example.com", password_hash=password_hash)
+        )
+
+    categories = state.variable_categories + state.fixed_categories
+    # Zipf-like: the first category is picked twice as often as the second,
+    # three times as often as the third, ...
+    weights = [1 / (rank + 1) for rank in range(len(categories))]
+
+    end = end or datetime.now()
+    month = datetime(end.year - years, end.month, 1) + timedelta(days=32)
+    month = month.replace(day=1)
+    while month <= end:
+        key = MonthlyState.key_for_date(month)
+        state.state[key] = MonthlyState.new_from_defaults(state.defaults)
+        next_month = (month + timedelta(days=32)).replace(day=1)
+        # nothing in the future, though
+        seconds = int((min(next_month, end) - month).total_seconds())
+        for created_at in sorted(
+            month + timedelta(seconds=rng.randrange(max(seconds, 1))) for _ in range(per_month)
+        ):
+            state.state[key].add_transaction(
+                Transaction(
+                    category=rng.choices(categories, weights)[0],
+                    # mostly small amounts with the occasional big one
+                    amount=int(rng.lognormvariate(8, 1)),
+                    created_at=created_at,
+                    user=state.users[rng.randrange(users)].email if users else "",
+                    title=rng.choice(TITLES),
+                    notes=None,
+                )
+            )
+        month = next_month
+
+    return state
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Print a synthetic database as JSON")
+    parser.add_argument("--users", type=int, default=4)
+    parser.add_argument("--years", type=int, default=3)
+    parser.add_argument("--per-month", type=int, default=300)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print(serialize_state(generate_state(args.users, args.years, args.per_month, args.seed)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+"""
+Load generator: logs in a few users and has `--concurrency` clients send a
+mix of transaction posts, report reads and logins for `--duration` seconds,
+optionally capped at `--rate` requests per second in total, then reports the
+throughput, latency percentiles and errors of every kind of request.
+
+Unless `--url` is given, the app is started with uvicorn against a generated
+database in a temporary directory.
+
+    python -m api.bench.load [--url URL] [--workers 1] [--concurrency 8]
+                             [--duration 10] [--rate 0]
+                             [--mix post=5,report=4,login=1]
+"""
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Callable, NamedTuple, Optional
+
+import requests
+
+from api import config
+from api.bench import database_paths, use_database_in
+
+PASSWORD = "password"
+
+
+class Sample(NamedTuple):
+    operation: str
+    # seconds
+    latency: float
+    ok: bool
+
+
+class RateLimiter:
+    """
+    Hands out evenly spaced start times, `rate` per second across all
+    threads.  A rate of 0 means no limit.
+    """
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate else 0
+        self._next = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+
+        with self._lock:
+            start = max(self._next, time.perf_counter())
+            self._next = start + self.interval
+        delay = start - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+
+def login(session: requests.Session, url: str, email: str) -> requests.Response:
+    return session.post(f"{url}/accounts/login", json={"email": email, "password": PASSWORD})
+
+
+def operations(url: str, email: str) -> dict[str, Callable[[requests.Session], requests.Response]]:
+    return {
+        "post": lambda session: session.post(
+            f"{url}/transactions",
+            json={"category": random.choice(["Grocery", "Gas", "Utilities"]), "amount": 1234},
+        ),
+        "report": lambda session: session.get(f"{url}/months/current"),
+        # a separate session, so that the client's own cookie is left alone
+        "login": lambda session: login(requests.Session(), url, email),
+    }
+
+
+def run_client(
+    url: str,
+    email: str,
+    mix: dict[str, int],
+    deadline: float,
+    limiter: RateLimiter,
+    samples: list[Sample],
+):
+    session = requests.Session()
+    login(session, url, email).raise_for_status()
+
+    run = operations(url, email)
+    names, weights = list(mix), list(mix.values())
+    while True:
+        limiter.wait()
+        if time.perf_counter() >= deadline:
+            break
+
+        operation = random.choices(names, weights)[0]
+        start = time.perf_counter()
+        try:
+            ok = run[operation](session).ok
+        except requests.RequestException:
+            ok = False
+        # list.append is atomic, so the clients can share one list
+        samples.append(Sample(operation, time.perf_counter() - start, ok))
+
+
+def generate_load(
+    url: str, emails: list[str], concurrency: int, duration: float, rate: float, mix: dict
+) -> list[Sample]:
+    samples: list[Sample] = []
+    limiter = RateLimiter(rate)
+    deadline = time.perf_counter() + duration
+    threads = [
+        threading.Thread(
+            target=run_client,
+            args=(url, emails[i % len(emails)], mix, deadline, limiter, samples),
+        )
+        for i in range(concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return samples
+
+
+def percentile(values: list[float], p: float) -> float:
+    # nearest rank, on sorted values
+    return values[max(0, min(len(values) - 1, round(p / 100 * len(values)) - 1))]
+
+
+def summarize(samples: list[Sample], duration: float) -> dict[str, dict]:
+    results = {}
+    groups: dict[str, list[Sample]] = {}
+    for sample in samples:
+        groups.setdefault(sample.operation, []).append(sample)
+    for name, group in [*sorted(groups.items()), ("total", samples)]:
+        if not group:
+            continue
+        latencies = sorted(s.latency for s in group)
+        errors = sum(not s.ok for s in group)
+        results[name] = {
+            "requests": len(group),
+            "errors": errors,
+            "error_rate": errors / len(group),
+            "throughput": len(group) / duration,
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+        }
+
+    return results
+
+
+def print_results(results: dict[str, dict]):
+    print(
+        f"{'operation':<12}{'requests':>10}{'errors':>8}{'req/s':>10}"
+        f"{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+    )
+    for name, r in results.items():
+        print(
+            f"{name:<12}{r['requests']:>10}{r['errors']:>8}{r['throughput']:>10.1f}"
+            f"{r['p50'] * 1000:>10.1f}{r['p95'] * 1000:>10.1f}{r['p99'] * 1000:>10.1f}"
+        )
+
+
+def parse_mix(value: str) -> dict[str, int]:
+    mix = {}
+    for part in value.split(","):
+        name, _, weight = part.partition("=")
+        if name not in ["post", "report", "login"]:
+            raise argparse.ArgumentTypeError(f"Unknown operation: {name}")
+        mix[name] = int(weight or 1)
+
+    return mix
+
+
+def start_server(directory: str, users: int, workers: int = 1) -> tuple[str, subprocess.Popen]:
+    """
+    Starts the app against a generated database in `directory`, and returns
+    its URL once it responds.
+    """
+    from api.bench.generate import generate_state
+    from api.db import create_backend
+
+    use_database_in(directory)
+    backend = create_backend(config.DB_BACKEND)
+    backend.save(generate_state(users=users, years=1)).result()
+    backend.close()
+
+    # the workers share the database, which is cheapest with a change log
+    env = {"DB_MULTIPROCESS": "1", "DB_MODE": "log"} if workers > 1 else {}
+    return run_server(directory, workers, env)
+
+
+def run_server(
+    directory: str, workers: int = 1, env: Optional[dict[str, str]] = None
+) -> tuple[str, subprocess.Popen]:
+    """
+    Starts the app with `workers` processes against the database in
+    `directory`, with `env` on top of the current environment, and returns
+    its URL once it responds.
+    """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+
+    env = {**os.environ, **database_paths(directory), **(env or {})}
+    # the testing config ignores DB_PATH
+    if env.get("APP_ENV") == "testing":
+        del env["APP_ENV"]
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "api.main:app", "--port", str(port)]
+        + ["--workers", str(workers), "--log-level", "warning"],
+        env=env,
+    )
+
+    url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        if server.poll() is not None:
+            raise RuntimeError(f"The server exited with {server.returncode}")
+        try:
+            # any response means it's up, even the 401 of a route that
+            # needs a user
+            requests.get(f"{url}/variable_categories")
+            return url, server
+        except requests.RequestException:
+            time.sleep(0.1)
+
+    server.terminate()
+    raise RuntimeError("The server didn't start")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate load against the app")
+    parser.add_argument("--url", help="Use an already running server")
+    parser.add_argument("--users", type=int, default=4, help="Simulated users")
+    parser.add_argument("--workers", type=int, default=1, help="Server processes")
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent clients")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds")
+    parser.add_argument("--rate", type=float, default=0, help="Requests/s in total, 0 for max")
+    parser.add_argument("--mix", type=parse_mix, default="post=5,report=4,login=1")
+    parser.add_argument("--output", default=os.path.join(config.BASE_DIR, "load_results.json"))
+    args = parser.parse_args()
+
+    emails = [f"user{i}@example.com" for i in range(args.users)]
+    server: Optional[subprocess.Popen] = None
+    with tempfile.TemporaryDirectory() as directory:
+        url = args.url
+        if not url:
+            url, server = start_server(directory, args.users, args.workers)
+
+        try:
+            samples = generate_load(
+                url, emails, args.concurrency, args.duration, args.rate, args.mix
+            )
+        finally:
+            if server:
+                server.terminate()
+                server.wait()
+
+    results = summarize(samples, args.duration)
+    print_results(results)
+
+    params = {k: v for k, v in vars(args).items() if k != "output"}
+    with open(args.output, "w") as file:
+        file.write(json.dumps({"params": params, "results": results}, indent=2))
+    print(f"Saved the results to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
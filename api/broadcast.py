@@ -0,0 +1,148 @@
+"""
+Live totals of the current month, for `GET /months/current/stream`.
+
+The single writer (see `api.mutations`) tells the broadcaster whenever
+changes to a household (or the main state, None) are on disk.  That only
+wakes the household's subscribers: the totals are computed once per version
+of the state, however many subscribers there are, and each subscriber sends
+its client what changed since what it sent last.  A slow client therefore
+never makes changes pile up in memory or holds up anybody else; it just gets
+several changes at once when it catches up.
+
+Subscribers are registered as soon as they subscribe, before their response
+starts, so that a burst of clients can't get past `max_subscribers`.
+"""
+from __future__ import annotations
+
+import asyncio
+from datetime import datetime
+from typing import AsyncIterator, Callable, Optional
+
+from api import config, metrics
+from api.domain import MonthlyState, MonthlyTotalsUpdate
+from api.households import get_household_db
+from api.reports import get_monthly_totals_update
+
+
+class TooManySubscribers(Exception):
+    pass
+
+
+class Broadcaster:
+    def __init__(self, max_subscribers: int):
+        self.max_subscribers = max_subscribers
+        # household -> an event per subscriber, set when there are changes
+        self._subscribers: dict[Optional[str], set[asyncio.Event]] = {}
+        # household -> ((state version, month key), totals)
+        self._updates: dict[Optional[str], tuple[tuple[int, str], MonthlyTotalsUpdate]] = {}
+
+    @property
+    def subscriber_count(self) -> int:
+        return sum(len(events) for events in self._subscribers.values())
+
+    @property
+    def is_full(self) -> bool:
+        return self.subscriber_count >= self.max_subscribers
+
+    def subscribe(self, household: Optional[str]) -> Subscription:
+        """
+        Registers a subscriber to the totals of `household`, which takes a
+        slot until the subscription is closed.  Raises `TooManySubscribers`
+        if there are `max_subscribers` already.
+        """
+        if self.is_full:
+            raise TooManySubscribers()
+
+        subscription = Subscription(self, household)
+        self._subscribers.setdefault(household, set()).add(subscription.changed)
+        return subscription
+
+    def _unsubscribe(self, subscription: Subscription):
+        events = self._subscribers.get(subscription.household, set())
+        events.discard(subscription.changed)
+        if not events:
+            self._subscribers.pop(subscription.household, None)
+            self._updates.pop(subscription.household, None)
+
+    def publish(self, household: Optional[str]):
+        for event in self._subscribers.get(household, ()):
+            event.set()
+
+    def current(self, household: Optional[str], now: datetime) -> MonthlyTotalsUpdate:
+        db = get_household_db(household)
+        key = (db.version, MonthlyState.key_for_date(now))
+        cached = self._updates.get(household)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        update = get_monthly_totals_update(db, now)
+        self._updates[household] = (key, update)
+        return update
+
+
+class Subscription:
+    def __init__(self, broadcaster: Broadcaster, household: Optional[str]):
+        self.broadcaster = broadcaster
+        self.household = household
+        # set when there are changes
+        self.changed = asyncio.Event()
+
+    def close(self):
+        """
+        Gives the subscriber's slot back; closing more than once is fine.
+        """
+        self.broadcaster._unsubscribe(self)
+
+    async def events(self, get_now: Callable[[], datetime] = datetime.now) -> AsyncIterator[str]:
+        """
+        Yields server-sent events: a `snapshot` with the totals of every
+        category first (and whenever the month changes), and then a `delta`
+        with just the categories that changed whenever something changes.
+        Closes the subscription when done.
+        """
+        current = self.broadcaster.current
+        try:
+            sent = current(self.household, get_now())
+            yield format_event("snapshot", sent.json())
+
+            while True:
+                try:
+                    await asyncio.wait_for(self.changed.wait(), config.STREAM_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    # checking anyway picks up changes made by other processes
+                    pass
+                self.changed.clear()
+
+                update = current(self.household, get_now())
+                if update.month != sent.month:
+                    yield format_event("snapshot", update.json())
+                elif update != sent:
+                    delta = MonthlyTotalsUpdate(
+                        month=update.month,
+                        totals=update.totals,
+                        categories={
+                            name: total
+                            for name, total in update.categories.items()
+                            if sent.categories.get(name) != total
+                        },
+                    )
+                    yield format_event("delta", delta.json())
+                else:
+                    # keeps proxies from closing the connection
+                    yield ": keepalive\n\n"
+                sent = update
+        finally:
+            self.close()
+
+
+def format_event(event: str, data: str) -> str:
+    return f"event: {event}\ndata: {data}\n\n"
+
+
+broadcaster = Broadcaster(config.STREAM_MAX_SUBSCRIBERS)
+
+metrics.Gauge(
+    "stream_subscribers",
+    "Clients subscribed to live totals",
+    lambda: broadcaster.subscriber_count,
+)
@@ -7,21 +7,105 @@ class ConfigError(Exception):
     pass
 
 
-def _config_get(key: str, default: any = None) -> Any:
+def _config_get(key: str, default: any = None, required: bool = True) -> Any:
     is_production = ENV == "production"
     value = os.getenv(key)
 
-    if not value and is_production:
+    if not value and is_production and required:
         raise ConfigError(f"Could not find value {value} in env {ENV}")
 
     return value or default
 
 
 AUTH_SECRET_KEY = _config_get("AUTH_SECRET_KEY", "1234")
+# how many verified auth tokens to remember, see `api.auth.TokenCache`
+AUTH_TOKEN_CACHE_SIZE = int(_config_get("AUTH_TOKEN_CACHE_SIZE", 1024, required=False))
+# bcrypt cost for new password hashes; existing hashes are upgraded on login
+AUTH_BCRYPT_ROUNDS = int(_config_get("AUTH_BCRYPT_ROUNDS", 12, required=False))
+# password hashing runs on this many threads, and requests are turned away
+# with a 503 once this many hashes are queued or running
+AUTH_HASHING_WORKERS = int(_config_get("AUTH_HASHING_WORKERS", 2, required=False))
+AUTH_HASHING_MAX_PENDING = int(_config_get("AUTH_HASHING_MAX_PENDING", 16, required=False))
 
 BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
 
 if os.getenv("APP_ENV") == "testing":
     DB_PATH = os.path.join(BASE_DIR, "db_testing.json")
+    DB_SQLITE_PATH = os.path.join(BASE_DIR, "db_testing.sqlite3")
+    DB_SHARD_DIR = os.path.join(BASE_DIR, "db_testing")
+    DB_HOUSEHOLD_DIR = os.path.join(BASE_DIR, "db_testing_households")
 else:
     DB_PATH = _config_get("DB_PATH", os.path.join(BASE_DIR, "db.json"))
+    DB_SQLITE_PATH = _config_get(
+        "DB_SQLITE_PATH", os.path.join(BASE_DIR, "db.sqlite3"), required=False
+    )
+    DB_SHARD_DIR = _config_get("DB_SHARD_DIR", os.path.join(BASE_DIR, "db"), required=False)
+    DB_HOUSEHOLD_DIR = _config_get(
+        "DB_HOUSEHOLD_DIR", os.path.join(BASE_DIR, "households"), required=False
+    )
+
+# "json" keeps the whole state in DB_PATH, "sqlite" keeps it in DB_SQLITE_PATH
+# and "sharded" in one file per month under DB_SHARD_DIR.  The latter two only
+# load the months that are actually used, and keep at most
+# DB_MONTH_CACHE_SIZE of them (but never fewer than the two a report needs)
+# in memory.
+DB_BACKEND = _config_get("DB_BACKEND", "json", required=False)
+DB_MONTH_CACHE_SIZE = max(2, int(_config_get("DB_MONTH_CACHE_SIZE", 12, required=False)))
+
+# every household has a state of its own under DB_HOUSEHOLD_DIR (always in
+# the "json" backend), and at most DB_HOUSEHOLD_CACHE_SIZE of them are kept in
+# memory; the main database keeps the accounts, and the state of the users
+# without a household
+DB_HOUSEHOLD_CACHE_SIZE = max(1, int(_config_get("DB_HOUSEHOLD_CACHE_SIZE", 100, required=False)))
+
+# "snapshot" rewrites DB_PATH on every save, "log" appends each change to
+# DB_LOG_PATH and only rewrites DB_PATH once the log gets long enough
+DB_MODE = _config_get("DB_MODE", "snapshot", required=False)
+DB_LOG_PATH = _config_get("DB_LOG_PATH", f"{DB_PATH}.log", required=False)
+DB_COMPACT_THRESHOLD = int(_config_get("DB_COMPACT_THRESHOLD", 1000, required=False))
+# "json" writes snapshots to DB_PATH, "binary" to DB_BINARY_PATH in the
+# compact format of `api.snapshot`, which loads much faster.  A snapshot in
+# the other format is converted on startup.
+DB_SNAPSHOT_FORMAT = _config_get("DB_SNAPSHOT_FORMAT", "json", required=False)
+DB_BINARY_PATH = _config_get(
+    "DB_BINARY_PATH", f"{os.path.splitext(DB_PATH)[0]}.bin", required=False
+)
+
+# changes are written by a background thread, which waits this many seconds
+# after the first pending change so that concurrent changes share one write
+DB_FLUSH_INTERVAL = float(_config_get("DB_FLUSH_INTERVAL", 0.005, required=False))
+# "fsync" makes every write durable before it is acknowledged, "os" leaves
+# flushing to the operating system
+DB_DURABILITY = _config_get("DB_DURABILITY", "fsync", required=False)
+# changes are applied one at a time by a single writer, which hands up to
+# this many of the changes queued up meanwhile to the backend as one write
+DB_MUTATION_BATCH_SIZE = int(_config_get("DB_MUTATION_BATCH_SIZE", 256, required=False))
+
+# set DB_MULTIPROCESS=1 when several processes share the database, e.g. with
+# `uvicorn --workers N`: writes then take a lock on DB_LOCK_PATH, and each
+# process picks up what the others wrote (only the new part of the change
+# log, so DB_MODE=log is much cheaper).  Only the "json" backend supports it.
+DB_MULTIPROCESS = _config_get("DB_MULTIPROCESS", "0", required=False) == "1"
+DB_LOCK_PATH = _config_get("DB_LOCK_PATH", f"{DB_PATH}.lock", required=False)
+
+# clients of `GET /months/current/stream` are sent a comment after this many
+# seconds without changes, and turned away with a 503 beyond this many
+STREAM_KEEPALIVE_SECONDS = float(_config_get("STREAM_KEEPALIVE_SECONDS", 15, required=False))
+STREAM_MAX_SUBSCRIBERS = int(_config_get("STREAM_MAX_SUBSCRIBERS", 1000, required=False))
+
+# comma-separated emails of the users allowed to use admin-only endpoints
+ADMIN_EMAILS = {
+    email.strip().lower()
+    for email in _config_get("ADMIN_EMAILS", "", required=False).split(",")
+    if email.strip()
+}
+
+# lets scrapers read `/_internal/metrics` without logging in as an admin, by
+# sending `Authorization: Bearer <METRICS_TOKEN>`
+METRICS_TOKEN = _config_get("METRICS_TOKEN", "", required=False)
+
+# with PROFILING=1, requests by admins that have an `X-Profile: 1` header are
+# profiled, and the most recent PROFILE_KEEP profiles are kept in PROFILE_DIR
+PROFILING = _config_get("PROFILING", "0", required=False) == "1"
+PROFILE_DIR = _config_get("PROFILE_DIR", os.path.join(BASE_DIR, "profiles"), required=False)
+PROFILE_KEEP = int(_config_get("PROFILE_KEEP", 50, required=False))
@@ -1,10 +1,20 @@
+import atexit
+import base64
+import bisect
+import contextlib
+import fcntl
 import json
 import os
-from datetime import datetime
-from typing import Union
+import threading
+import time
+from concurrent.futures import Future
+from datetime import date, datetime, time as datetime_time, timedelta
+from typing import Any, Callable, Optional, Union
 
-from api.config import DB_PATH
-from api.domain import ApplicationState, MonthlyState, User
+from api import config, metrics
+from api.config import ConfigError
+from api.domain import ApplicationState, MonthlyState, Transaction, TransactionPage, User
+from api.snapshot import decode_snapshot, encode_snapshot
 
 default_state = {
     "users": [],
@@ -32,36 +42,589 @@ def ensure_exists(path: str):
 
 
 _db = None
+_backend = None
 
 
 def get_db_instance() -> ApplicationState:
     global _db
     if not _db:
-        ensure_exists(DB_PATH)
-        with open(DB_PATH, "r") as file:
-            json_object = json.loads(file.read())
-            _db = ApplicationState(**json_object)
-            maybe_rollover_month(_db)
+        with metrics.DB_LOAD_SECONDS.time():
+            _db = get_backend().load()
+        maybe_rollover_month(_db)
+    elif config.DB_MULTIPROCESS and not get_backend().lock.is_held:
+        # while this process holds the lock, nobody else can write
+        _db = get_backend().refresh(_db)
 
     return _db
 
-def _delete_db_singleton():
+
+def refresh_db_instance() -> ApplicationState:
+    """
+    Catches the state up with what other processes wrote, for the writer to
+    call once it holds the lock (see `config.DB_MULTIPROCESS`).
+    """
     global _db
+    _db = get_backend().refresh(get_db_instance())
+    return _db
+
+def _delete_db_singleton():
+    global _db, _backend
+    if _backend:
+        _backend.close()
     _db = None
+    _backend = None
+
+
+def get_backend():
+    """
+    Returns the storage backend selected by `config.DB_BACKEND`.
+    """
+    global _backend
+    if not _backend:
+        _backend = create_backend(config.DB_BACKEND)
+
+    return _backend
+
+
+def create_backend(name: str):
+    if config.DB_MULTIPROCESS and name != "json":
+        raise ConfigError(f"DB_MULTIPROCESS isn't supported by the {name} backend")
+
+    if name == "sqlite":
+        from api.sqlite_db import SqliteBackend
+
+        return SqliteBackend(config.DB_SQLITE_PATH)
+    elif name == "sharded":
+        from api.sharded_db import ShardedBackend
+
+        return ShardedBackend(config.DB_SHARD_DIR)
+
+    return JsonBackend(
+        config.DB_PATH,
+        config.DB_LOG_PATH,
+        binary_path=config.DB_BINARY_PATH,
+        snapshot_format=config.DB_SNAPSHOT_FORMAT,
+        lock_path=config.DB_LOCK_PATH,
+    )
 
 def save_state_to_file(state: ApplicationState):
-    with open(DB_PATH, "w") as file:
-        file.write(state.json())
+    """
+    Writes a full snapshot of `state` and blocks until it is on disk.
+    """
+    with metrics.DB_SAVE_SECONDS.time():
+        get_backend().save(state).result()
+
+
+def persist_changes(db: ApplicationState) -> Future:
+    """
+    Hands the changes recorded on `db` since the last call to the storage
+    backend.  Returns a future that resolves once the changes are on disk.
+    """
+    return get_backend().persist(db)
+
+
+def _transactions_in_memory() -> int:
+    return sum(len(month.transactions) for month in _db.state.values()) if _db else 0
+
+
+metrics.Gauge(
+    "db_transactions_in_memory",
+    "Transactions in the months currently loaded",
+    _transactions_in_memory,
+)
+metrics.Gauge(
+    "db_months_in_memory", "Months currently loaded", lambda: len(_db.state) if _db else 0
+)
+metrics.Gauge(
+    "db_disk_usage_bytes",
+    "Size of the files of the configured storage backend",
+    # left out until the backend has been created
+    lambda: _backend.disk_usage(),
+)
+
+
+def file_sizes(paths) -> int:
+    return sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+
+
+def file_stamp(path: str) -> Optional[tuple[int, int, int]]:
+    """
+    Returns what changes whenever the file at `path` is replaced or written
+    to, or None if there is no such file.
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def wait_for_writes():
+    """
+    Blocks until everything handed to the storage backend is on disk.
+    """
+    if _backend:
+        _backend.flush().result()
+
+
+def serialize_state(state: ApplicationState) -> str:
+    """
+    Serializes `state` to JSON, re-using the serialized form of every month
+    that hasn't changed since the last snapshot.
+    """
+    cache = state._serialized_months.setdefault("json", {})
+    for key in state.dirty_months | (state.state.keys() - cache.keys()):
+        cache[key] = state.state[key].json()
+    for key in cache.keys() - state.state.keys():
+        del cache[key]
+
+    months = ", ".join(f"{json.dumps(key)}: {cache[key]}" for key in state.state)
+    document = state.json(exclude={"state"})
+    return f'{document[:-1]}, "state": {{{months}}}}}'
+
+
+def atomic_write(path: str, contents: Union[str, bytes], fsync: bool):
+    """
+    Replaces the file at `path` with `contents`, going through a temporary
+    file so that a crash can never leave a truncated file behind.
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb" if isinstance(contents, bytes) else "w") as file:
+        file.write(contents)
+        metrics.DB_BYTES_WRITTEN.inc(file.tell())
+        file.flush()
+        if fsync:
+            os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+
+    if fsync:
+        dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+def resolved_future() -> Future:
+    future = Future()
+    future.set_result(None)
+    return future
+
+
+class PersistenceWriter:
+    """
+    Runs writes from a background thread, so that requests never block on
+    disk I/O.  Everything submitted within `flush_interval` seconds of the
+    first pending write is handed to `write` as one batch, so that it can be
+    coalesced into a single write (and a single fsync).
+    """
+
+    def __init__(self, write: Callable[[list[Any]], None], flush_interval: float):
+        self.write = write
+        self.flush_interval = flush_interval
+
+        self._pending: list[tuple[Any, Future]] = []
+        self._writing = False
+        self._condition = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(
+            target=self._run, name="persistence-writer", daemon=True
+        )
+        self._thread.start()
+        atexit.register(self.close)
+
+    def submit(self, item: Any) -> Future:
+        """
+        Queues `item` for the next batch.  Returns a future that resolves
+        once the batch has been written.
+        """
+        future = Future()
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("Persistence writer is closed")
+            self._pending.append((item, future))
+            self._condition.notify()
+
+        return future
+
+    def flush(self) -> Future:
+        """
+        Returns a future that resolves once everything queued so far has
+        been written.
+        """
+        return self.submit(None)
+
+    @property
+    def is_idle(self) -> bool:
+        with self._condition:
+            return not self._pending and not self._writing
+
+    def close(self, wait: bool = True):
+        """
+        Stops the writer once everything queued so far has been written.
+        With `wait`, blocks until then.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        atexit.unregister(self.close)
+        if wait:
+            self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._closed:
+                    self._condition.wait()
+                if not self._pending:
+                    return
+
+            # give concurrent requests the chance to join this write
+            if self.flush_interval:
+                time.sleep(self.flush_interval)
+
+            with self._condition:
+                batch, self._pending = self._pending, []
+                self._writing = True
+
+            items = [item for item, _ in batch if item is not None]
+            metrics.DB_WRITES.inc(len(items))
+            try:
+                with metrics.DB_WRITE_SECONDS.time():
+                    self.write(items)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+            else:
+                for _, future in batch:
+                    future.set_result(None)
+            finally:
+                with self._condition:
+                    self._writing = False
+
+
+class FileLock:
+    """
+    An exclusive lock shared between processes, held with `flock` on the
+    file at `path`.  Not reentrant, also not within one process.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._fd: Optional[int] = None
+
+    @property
+    def is_held(self) -> bool:
+        return self._fd is not None
+
+    def acquire(self):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        except BaseException:
+            os.close(fd)
+            raise
+        self._fd = fd
+
+    def release(self):
+        fd, self._fd = self._fd, None
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class JsonBackend:
+    """
+    Keeps the whole state in memory and on disk as one JSON document.  In
+    "log" mode (see `config.DB_MODE`) changes are appended to a change log
+    instead, which is compacted into the document once it gets long enough.
+
+    With `snapshot_format="binary"` the document is kept at `binary_path`
+    in the format of `api.snapshot` instead.  A snapshot found only in the
+    other format is converted when it is loaded.
+
+    With `config.DB_MULTIPROCESS`, the files may be shared with other
+    processes: they must only be written while holding `lock`, and `refresh`
+    picks up what the others wrote.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        log_path: str,
+        binary_path: Optional[str] = None,
+        snapshot_format: str = "json",
+        lock_path: Optional[str] = None,
+    ):
+        self.path = path
+        self.log_path = log_path
+        self.binary_path = binary_path or f"{os.path.splitext(path)[0]}.bin"
+        self.binary = snapshot_format == "binary"
+        self.fsync = config.DB_DURABILITY == "fsync"
+        self.shared = config.DB_MULTIPROCESS
+        self.lock = FileLock(lock_path or f"{path}.lock")
+        # number of records in the change log since the last snapshot
+        self._log_length = 0
+        # the snapshot and the part of the change log that the state in
+        # memory reflects, to tell when another process wrote to either
+        self._snapshot_stamp: Optional[tuple[int, int, int]] = None
+        self._log_offset = 0
+        # changes whose write failed, to be written again with the next
+        # persist (filled in by the writer)
+        self._failed_changes: list[str] = []
+        self._failed_lock = threading.Lock()
+        self._writer = PersistenceWriter(self._write, config.DB_FLUSH_INTERVAL)
+
+    @property
+    def snapshot_path(self) -> str:
+        return self.binary_path if self.binary else self.path
+
+    def load(self) -> ApplicationState:
+        if self.shared and not self.lock.is_held:
+            with self.lock:
+                return self._load()
+
+        return self._load()
+
+    def _load(self) -> ApplicationState:
+        other_path = self.path if self.binary else self.binary_path
+        if not os.path.exists(self.snapshot_path) and not os.path.exists(other_path):
+            ensure_exists(self.path)
+
+        if os.path.exists(self.snapshot_path):
+            self._snapshot_stamp = file_stamp(self.snapshot_path)
+            db = self._read_snapshot(self.snapshot_path)
+            self._replay_log(db)
+            return db
+
+        db = self._read_snapshot(other_path)
+        self._replay_log(db)
+        # convert, and only then remove the original, so that a crash in
+        # between leaves (at least) one complete snapshot
+        self.save(db).result()
+        os.remove(other_path)
+
+        return db
+
+    def refresh(self, db: ApplicationState) -> ApplicationState:
+        """
+        Returns `db` caught up with what other processes wrote since it was
+        loaded or last refreshed.  Usually that only means reading the new
+        part of the change log, but if the snapshot was rewritten it is
+        loaded again.  Changes on `db` that haven't been persisted yet are
+        kept, and given versions that follow those of the changes read.
+        """
+        failed = self._pop_failed_changes()
+        log_size = os.path.getsize(self.log_path) if os.path.exists(self.log_path) else 0
+        # changes whose write failed may have versions that others took
+        # since, so they are applied again on top of what's on disk
+        reload = (
+            bool(failed)
+            or file_stamp(self.snapshot_path) != self._snapshot_stamp
+            or log_size < self._log_offset
+        )
+        if not reload and log_size == self._log_offset:
+            return db
+
+        # the pending changes took the last versions, which the changes
+        # read from disk may need
+        pending = failed + db.pop_changes()
+        db.version -= len(pending)
+        if reload:
+            db = self._load()
+            for change in pending:
+                apply_log_record(db, json.loads(change))
+        else:
+            self._replay_log(db, self._log_offset)
+        db.rerecord_changes(pending)
+
+        return db
+
+    def _read_snapshot(self, path: str) -> ApplicationState:
+        if path == self.binary_path:
+            with open(path, "rb") as file:
+                return decode_snapshot(file.read())
+
+        with open(path, "r") as file:
+            return ApplicationState(**json.loads(file.read()))
+
+    def save(self, state: ApplicationState, changes: Optional[list[str]] = None) -> Future:
+        document = encode_snapshot(state) if self.binary else serialize_state(state)
+
+        # the snapshot now contains everything in the log; the changes, and
+        # any `changes` the caller already popped, go along in case writing
+        # it fails
+        changes = (changes or []) + state.pop_changes()
+        state.mark_clean()
+        self._log_length = 0
+
+        return self._writer.submit((document, changes))
+
+    def persist(self, db: ApplicationState) -> Future:
+        # changes whose write failed go ahead of the ones made since, which
+        # may depend on them
+        failed = self._pop_failed_changes()
+        if config.DB_MODE != "log":
+            if not db.is_dirty and not failed:
+                return resolved_future()
+            return self.save(db, failed)
+
+        changes = failed + db.pop_changes()
+        if not changes:
+            return resolved_future()
+
+        self._log_length += len(changes)
+        if self._log_length >= config.DB_COMPACT_THRESHOLD:
+            return self.save(db, changes)
+
+        return self._writer.submit((None, changes))
+
+    def flush(self) -> Future:
+        return self._writer.flush()
+
+    @property
+    def is_idle(self) -> bool:
+        return self._writer.is_idle
+
+    @property
+    def has_failed_changes(self) -> bool:
+        with self._failed_lock:
+            return bool(self._failed_changes)
+
+    def close(self, wait: bool = True):
+        self._writer.close(wait)
+
+    def disk_usage(self) -> int:
+        return file_sizes([self.snapshot_path, self.log_path])
+
+    def _pop_failed_changes(self) -> list[str]:
+        with self._failed_lock:
+            failed, self._failed_changes = self._failed_changes, []
+        return failed
+
+    def _keep_failed_changes(self, batch: list[tuple[Union[str, bytes, None], list[str]]]):
+        with self._failed_lock:
+            self._failed_changes += [record for _, records in batch for record in records]
+
+    def _write(self, batch: list[tuple[Union[str, bytes, None], list[str]]]):
+        # a snapshot supersedes everything that was queued before it,
+        # including the changes it was taken with
+        snapshots = [i for i, (snapshot, _) in enumerate(batch) if snapshot is not None]
+        if snapshots:
+            last = snapshots[-1]
+            try:
+                atomic_write(self.snapshot_path, batch[last][0], self.fsync)
+            except Exception:
+                self._keep_failed_changes(batch)
+                raise
+            # ...and every change whose write failed before it
+            self._pop_failed_changes()
+            if os.path.exists(self.log_path):
+                os.truncate(self.log_path, 0)
+            self._snapshot_stamp = file_stamp(self.snapshot_path)
+            self._log_offset = 0
+            batch = batch[last + 1:]
+
+        records = [record for _, records in batch for record in records]
+        if records:
+            with open(self.log_path, "a") as file:
+                file_size = file.tell()
+                try:
+                    file.write("".join(f"{record}\n" for record in records))
+                    metrics.DB_BYTES_WRITTEN.inc(file.tell() - file_size)
+                    self._sync(file)
+                except Exception:
+                    # don't leave part of the records behind, since they
+                    # are written again
+                    with contextlib.suppress(OSError):
+                        file.truncate(file_size)
+                    self._keep_failed_changes(batch)
+                    raise
+                self._log_offset = file.tell()
+
+    def _sync(self, file):
+        file.flush()
+        if self.fsync:
+            os.fsync(file.fileno())
+
+    def _replay_log(self, db: ApplicationState, offset: int = 0):
+        """
+        Applies every record in the change log from `offset` on that is
+        newer than `db`.
+        """
+        if not offset:
+            self._log_length = 0
+        if not os.path.exists(self.log_path):
+            self._log_offset = 0
+            return
+
+        # without the lock, an incomplete record may just be being written
+        # by another process
+        repair = not self.shared or self.lock.is_held
+        with open(self.log_path, "r+" if repair else "r") as file:
+            file.seek(offset)
+            for line in iter(file.readline, ""):
+                try:
+                    if not line.endswith("\n"):
+                        raise json.JSONDecodeError("Unterminated record", line, len(line))
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # a write was torn by a crash; drop it so that later
+                    # appends don't end up behind a corrupt line
+                    if repair:
+                        file.truncate(offset)
+                    break
+
+                offset = file.tell()
+                self._log_length += 1
+                if record["version"] > db.version:
+                    apply_log_record(db, record)
+                    db.version = record["version"]
+
+        self._log_offset = offset
+
+
+def apply_log_record(db: ApplicationState, record: dict):
+    op = record["op"]
+    if op == "add_user":
+        db.users.append(User(**record["user"]))
+        db.mark_dirty()
+    elif op == "set_password_hash":
+        get_user_with_email(db, record["email"]).password_hash = record["password_hash"]
+        db.mark_dirty()
+    elif op == "set_household":
+        get_user_with_email(db, record["email"]).household = record["household"]
+        db.mark_dirty()
+    elif op == "set_household_invite":
+        get_user_with_email(db, record["email"]).household_invite = record["household"]
+        db.mark_dirty()
+    elif op == "add_month":
+        # processes sharing the database may each have created the month
+        if record["key"] not in db.state:
+            db.state[record["key"]] = MonthlyState(**record["month"])
+            db.mark_dirty(record["key"])
+    elif op == "add_transaction":
+        db._month_for_write(record["key"]).add_transaction(Transaction(**record["transaction"]))
+        db.mark_dirty(record["key"])
+    else:
+        raise ValueError(f"Unknown log record: {op}")
 
 
 def maybe_rollover_month(db: ApplicationState, get_now=datetime.now):
     now: datetime = get_now()
     la = db.last_accessed
 
-    if la.month != now.month:
+    key = MonthlyState.key_for_date(now)
+    if la.month != now.month and db.get_month(key) is None:
         # create a new month
-        new_monthly_state = MonthlyState.new_from_defaults(db.defaults)
-        db.state[new_monthly_state.key_for_date(now)] = new_monthly_state
+        db.add_month(key, MonthlyState.new_from_defaults(db.defaults))
 
 
 ################################################################################
@@ -70,9 +633,130 @@ def maybe_rollover_month(db: ApplicationState, get_now=datetime.now):
 
 
 def get_user_with_email(db: ApplicationState, email: str) -> Union[User, None]:
-    # yes, this is O(n), but this app is designed to have 1-3 users, lol
-    for user in db.users:
-        if user.email == email:
-            return user
+    # emails are compared case-insensitively, through an index kept by the state
+    return db.get_user(email)
+
+
+def list_transactions(
+    db: ApplicationState,
+    month: Optional[str] = None,
+    category: Optional[str] = None,
+    user: Optional[str] = None,
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    cursor: Optional[str] = None,
+    limit: int = 50,
+) -> TransactionPage:
+    """
+    Returns up to `limit` transactions matching the filters (`start` and `end`
+    are inclusive dates), newest first, starting after `cursor`.  The cursor
+    marks a position rather than an offset, so pages don't shift when
+    transactions are added.
+
+    Raises ValueError for a cursor that wasn't returned by this function.
+    """
+    after = _decode_cursor(cursor) if cursor else None
+    start_time = datetime.combine(start, datetime_time.min) if start else None
+    end_time = datetime.combine(end + timedelta(days=1), datetime_time.min) if end else None
+
+    keys = [month] if month is not None else db.month_keys()
+    found: list[tuple[str, tuple[datetime, int], Transaction]] = []
+    for key in sorted(keys, key=MonthlyState.date_for_key, reverse=True):
+        first_day = MonthlyState.date_for_key(key)
+        if after and first_day > MonthlyState.date_for_key(after[0]):
+            continue
+        if end_time and first_day >= end_time:
+            continue
+        # months are newest first, so every month from here on is too old
+        if start_time and (first_day + timedelta(days=31)).replace(day=1) <= start_time:
+            break
+
+        state = db.get_month(key)
+        if state is None:
+            continue
+
+        entries = state.ordered_positions(category, user)
+        lo = bisect.bisect_left(entries, (start_time, -1)) if start_time else 0
+        hi = bisect.bisect_left(entries, (end_time, -1)) if end_time else len(entries)
+        if after and key == after[0]:
+            hi = min(hi, bisect.bisect_left(entries, after[1]))
+
+        # one more than asked for, to know whether there is a next page
+        for entry in reversed(entries[max(lo, hi - (limit + 1 - len(found))):hi]):
+            found.append((key, entry, state.transactions[entry[1]]))
+        if len(found) > limit:
+            break
+
+    next_cursor = None
+    if len(found) > limit:
+        found = found[:limit]
+        next_cursor = _encode_cursor(found[-1][0], found[-1][1])
+
+    return TransactionPage.construct(
+        transactions=[transaction for _, _, transaction in found], next_cursor=next_cursor
+    )
+
+
+def _encode_cursor(month_key: str, entry: tuple[datetime, int]) -> str:
+    created_at, position = entry
+    payload = json.dumps([month_key, created_at.isoformat(), position])
+    return base64.urlsafe_b64encode(payload.encode()).decode()
+
+
+def _decode_cursor(cursor: str) -> tuple[str, tuple[datetime, int]]:
+    try:
+        month_key, created_at, position = json.loads(base64.urlsafe_b64decode(cursor))
+        MonthlyState.date_for_key(month_key)
+        return month_key, (datetime.fromisoformat(created_at), int(position))
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+
+################################################################################
+# Migrations
+################################################################################
+
+
+def migrate(source, target):
+    """
+    Copies everything stored in the `source` backend into `target`,
+    replacing whatever `target` contained.
+    """
+    state = source.load()
+    state.load_all_months()
+    target.save(state).result()
+
+
+def main():
+    import argparse
+
+    backend_paths = {"sqlite": config.DB_SQLITE_PATH, "sharded": config.DB_SHARD_DIR}
+
+    parser = argparse.ArgumentParser(
+        description="Copy the JSON database into another storage backend"
+    )
+    parser.add_argument("--source", default=config.DB_PATH)
+    parser.add_argument("--backend", choices=backend_paths.keys(), default=config.DB_BACKEND)
+    parser.add_argument("--force", action="store_true", help="Overwrite an existing target")
+    args = parser.parse_args()
+
+    if args.backend not in backend_paths:
+        parser.error("--backend is required unless DB_BACKEND is sqlite or sharded")
+    if not os.path.exists(args.source):
+        parser.error(f"{args.source} does not exist")
+    if os.path.exists(backend_paths[args.backend]) and not args.force:
+        parser.error(f"{backend_paths[args.backend]} already exists, pass --force to overwrite it")
+
+    source = JsonBackend(args.source, f"{args.source}.log")
+    target = create_backend(args.backend)
+    try:
+        migrate(source, target)
+    finally:
+        source.close()
+        target.close()
+
+    print(f"Migrated {args.source} to {backend_paths[args.backend]}")
+
 
-    return None
+if __name__ == "__main__":
+    main()
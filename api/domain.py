@@ -1,10 +1,13 @@
 from __future__ import annotations
 
+import json
+import weakref
 from datetime import datetime, timedelta
-from typing import Dict, Optional
+from typing import Any, Callable, Dict, Iterable, Optional
 from functools import reduce
 
-from pydantic import BaseModel
+from pydantic import BaseModel, PrivateAttr
+from pydantic.json import pydantic_encoder
 
 
 class FixedExpense(BaseModel):
@@ -16,6 +19,19 @@ class User(BaseModel):
     name: str
     email: str
     password_hash: Optional[str]
+    # users without a household keep their transactions in the main state,
+    # see `api.households`
+    household: Optional[str] = None
+    # the household a member invited this user to, which only they can accept
+    household_invite: Optional[str] = None
+
+    @staticmethod
+    def normalize_email(email: str) -> str:
+        return email.strip().lower()
+
+
+class DuplicateUserError(Exception):
+    pass
 
 
 class Transaction(BaseModel):
@@ -27,6 +43,12 @@ class Transaction(BaseModel):
     notes: Optional[str]
 
 
+class TransactionPage(BaseModel):
+    transactions: list[Transaction]
+    # pass as `cursor` to get the next page; None on the last page
+    next_cursor: Optional[str]
+
+
 class StateDefaults(BaseModel):
     monthly_income: int
     fixed_expenses: list[FixedExpense]
@@ -39,6 +61,220 @@ class MonthlyState(BaseModel):
 
     _DATE_FORMAT = "%m/%y"
 
+    # running aggregates over `transactions`, kept up to date by
+    # `add_transaction` so that reports don't have to scan every transaction
+    _aggregated_count: int = PrivateAttr(default=0)
+    _total_spent: int = PrivateAttr(default=0)
+    _latest_created_at: Optional[datetime] = PrivateAttr(default=None)
+    _category_totals: Dict[str, int] = PrivateAttr(default_factory=dict)
+    _category_transactions: Dict[str, list[Transaction]] = PrivateAttr(default_factory=dict)
+    _category_day_totals: Dict[str, Dict[int, int]] = PrivateAttr(default_factory=dict)
+    # category -> cumulative total by day of month, where index `d` holds
+    # everything spent on days 1 through `d`.  Built from the day totals on
+    # first use and dropped whenever a transaction is added.
+    _category_cumulative: Optional[Dict[str, list[int]]] = PrivateAttr(default=None)
+    # (created_at, position in `transactions`) of every transaction in that
+    # order, and the same for the transactions of each ("category", name) and
+    # ("user", email).  Built on first use; extended as transactions are
+    # added in order, and dropped when one is added out of order.
+    _order: Optional[list[tuple[datetime, int]]] = PrivateAttr(default=None)
+    _order_indexes: Dict[tuple[str, str], list[tuple[datetime, int]]] = PrivateAttr(
+        default_factory=dict
+    )
+
+    def __init__(self, **data):
+        super().__init__(**data)
+        self.rebuild_aggregates()
+
+    @property
+    def version(self) -> int:
+        """
+        Transactions are only ever appended, so their count doubles as a
+        version that changes whenever the month does.
+        """
+        return len(self.transactions)
+
+    def add_transaction(self, transaction: Transaction):
+        self.transactions.append(transaction)
+        self._aggregate(transaction)
+
+    def copy_for_write(self) -> MonthlyState:
+        """
+        Returns a copy of this month that can be changed without affecting
+        it.  The transactions themselves, which are never changed, are
+        shared.
+        """
+        self.ensure_aggregates()
+        month = MonthlyState.construct(
+            monthly_income=self.monthly_income,
+            fixed_expenses=self.fixed_expenses,
+            transactions=list(self.transactions),
+        )
+        month._aggregated_count = self._aggregated_count
+        month._total_spent = self._total_spent
+        month._latest_created_at = self._latest_created_at
+        month._category_totals = dict(self._category_totals)
+        month._category_transactions = {
+            category: list(transactions)
+            for category, transactions in self._category_transactions.items()
+        }
+        month._category_day_totals = {
+            category: dict(day_totals)
+            for category, day_totals in self._category_day_totals.items()
+        }
+        if self._order is not None:
+            month._order = list(self._order)
+            month._order_indexes = {key: list(index) for key, index in self._order_indexes.items()}
+
+        return month
+
+    def rebuild_aggregates(self):
+        self._aggregated_count = 0
+        self._total_spent = 0
+        self._latest_created_at = None
+        self._category_totals = {}
+        self._category_transactions = {}
+        self._category_day_totals = {}
+        self._category_cumulative = None
+        self._order = None
+        self._order_indexes = {}
+        for transaction in self.transactions:
+            self._aggregate(transaction)
+
+    def ensure_aggregates(self):
+        """
+        Rebuilds the aggregates if `transactions` was changed without going
+        through `add_transaction`.
+        """
+        if self._aggregated_count != len(self.transactions):
+            self.rebuild_aggregates()
+
+    @property
+    def total_spent(self) -> int:
+        self.ensure_aggregates()
+        return self._total_spent
+
+    @property
+    def latest_created_at(self) -> Optional[datetime]:
+        self.ensure_aggregates()
+        return self._latest_created_at
+
+    @property
+    def category_totals(self) -> Dict[str, int]:
+        """
+        Category -> total spent, in order of each category's first transaction.
+        """
+        self.ensure_aggregates()
+        return self._category_totals
+
+    def category_count(self, category: str) -> int:
+        self.ensure_aggregates()
+        return len(self._category_transactions.get(category, []))
+
+    def category_transactions(self, category: str) -> list[Transaction]:
+        self.ensure_aggregates()
+        return self._category_transactions.get(category, [])
+
+    def category_day_totals(self, category: str) -> Dict[int, int]:
+        """
+        Day of month -> total spent in `category` on that day.
+        """
+        self.ensure_aggregates()
+        return self._category_day_totals.get(category, {})
+
+    def category_total_until_day(self, category: str, day: int) -> int:
+        """
+        Total spent in `category` on days 1 through `day` of the month.
+        """
+        self.ensure_aggregates()
+        if self._category_cumulative is None:
+            self._category_cumulative = {}
+            for name, day_totals in self._category_day_totals.items():
+                cumulative = [0] * 32
+                for d in range(1, 32):
+                    cumulative[d] = cumulative[d - 1] + day_totals.get(d, 0)
+                self._category_cumulative[name] = cumulative
+
+        cumulative = self._category_cumulative.get(category)
+        if not cumulative:
+            return 0
+
+        return cumulative[min(max(day, 0), 31)]
+
+    def ordered_positions(
+        self, category: Optional[str] = None, user: Optional[str] = None
+    ) -> list[tuple[datetime, int]]:
+        """
+        Returns (created_at, position in `transactions`) for every transaction
+        in `category` by `user` (either may be None for all), sorted oldest
+        first, with ties broken by position.  Don't modify the result.
+        """
+        self.ensure_aggregates()
+        if self._order is None:
+            self._order = sorted((t.created_at, i) for i, t in enumerate(self.transactions))
+            self._order_indexes = {}
+
+        keys = [key for key in [("category", category), ("user", user)] if key[1] is not None]
+        if not keys:
+            return self._order
+
+        indexes = {key: self._order_index(key) for key in keys}
+        smallest = min(indexes, key=lambda key: len(indexes[key]))
+        if len(indexes) == 1:
+            return indexes[smallest]
+
+        # filter the smaller index by the other field
+        (field, value), = [key for key in keys if key != smallest]
+        return [
+            entry
+            for entry in indexes[smallest]
+            if getattr(self.transactions[entry[1]], field) == value
+        ]
+
+    def _order_index(self, key: tuple[str, str]) -> list[tuple[datetime, int]]:
+        index = self._order_indexes.get(key)
+        if index is None:
+            field, value = key
+            index = [
+                entry
+                for entry in self._order
+                if getattr(self.transactions[entry[1]], field) == value
+            ]
+            self._order_indexes[key] = index
+
+        return index
+
+    def _aggregate(self, transaction: Transaction):
+        category, amount = transaction.category, transaction.amount
+        self._category_cumulative = None
+        self._extend_order(transaction)
+
+        self._aggregated_count += 1
+        self._total_spent += amount
+        if self._latest_created_at is None or transaction.created_at > self._latest_created_at:
+            self._latest_created_at = transaction.created_at
+
+        self._category_totals[category] = self._category_totals.get(category, 0) + amount
+        self._category_transactions.setdefault(category, []).append(transaction)
+        day_totals = self._category_day_totals.setdefault(category, {})
+        day = transaction.created_at.day
+        day_totals[day] = day_totals.get(day, 0) + amount
+
+    def _extend_order(self, transaction: Transaction):
+        if self._order is None:
+            return
+
+        entry = (transaction.created_at, self._aggregated_count)
+        if self._order and self._order[-1] > entry:
+            self._order = None
+            self._order_indexes = {}
+            return
+
+        self._order.append(entry)
+        for key in [("category", transaction.category), ("user", transaction.user)]:
+            if key in self._order_indexes:
+                self._order_indexes[key].append(entry)
+
     @staticmethod
     def key_for_date(dt: datetime):
         return dt.strftime(MonthlyState._DATE_FORMAT)
@@ -63,14 +299,316 @@ class ApplicationState(BaseModel):
     variable_categories: list[str]
     fixed_categories: list[str]
     state: Dict[str, MonthlyState]
+    # incremented on every recorded change, so that a log record can be
+    # matched against the snapshot it was (or was not) compacted into
+    version: int = 0
+
+    # encoded change records that have not been persisted yet
+    _changes: list[str] = PrivateAttr(default_factory=list)
+    # normalized email -> user, along with the list it was built from so
+    # that replacing or appending to `users` directly is noticed
+    _users_by_email: Dict[str, User] = PrivateAttr(default_factory=dict)
+    _indexed_users: Optional[list[User]] = PrivateAttr(default=None)
+    _indexed_user_count: int = PrivateAttr(default=0)
+    # what changed since the last full snapshot: `_dirty` covers everything
+    # outside of `state`, `_dirty_months` the keys of changed months
+    _dirty: bool = PrivateAttr(default=False)
+    _dirty_months: set[str] = PrivateAttr(default_factory=set)
+    # snapshot format -> month key -> serialized month as of the last
+    # snapshot, maintained by the persistence layer so that clean months
+    # aren't re-serialized
+    _serialized_months: Dict[str, Dict[str, str]] = PrivateAttr(default_factory=dict)
+    # (month key, with transactions) -> latest serialized report for that
+    # month, maintained by `api.reports`
+    _report_cache: Dict[tuple[str, bool], Any] = PrivateAttr(default_factory=dict)
+    # month key -> (month version, totals) for range reports, maintained by
+    # `api.reports`; dropped when the month changes, so that a month that
+    # isn't in memory doesn't have to be loaded to check it
+    _month_totals: Dict[str, Any] = PrivateAttr(default_factory=dict)
+    # for storage backends that don't keep every month in `state`: loads a
+    # month that isn't in memory yet, and lists the keys of every month
+    _load_month: Optional[Callable[[str], Optional[MonthlyState]]] = PrivateAttr(default=None)
+    _stored_month_keys: Optional[Callable[[], Iterable[str]]] = PrivateAttr(default=None)
+    # with a month loader, `state` is kept ordered from least to most
+    # recently used and clean months are evicted beyond this many
+    _month_cache_size: Optional[int] = PrivateAttr(default=None)
+    # the keys of the months in `state` that are shared with a snapshot,
+    # which are copied before they are changed
+    _shared_months: set[str] = PrivateAttr(default_factory=set)
+    _read_only: bool = PrivateAttr(default=False)
+    # the month loaders of snapshots still in use, which get the months
+    # loaded after they were taken
+    _snapshot_loaders: weakref.WeakSet[_SnapshotMonthLoader] = PrivateAttr(
+        default_factory=weakref.WeakSet
+    )
+
+    @property
+    def is_dirty(self) -> bool:
+        return self._dirty or bool(self._dirty_months)
+
+    @property
+    def dirty_months(self) -> set[str]:
+        return self._dirty_months
+
+    def mark_dirty(self, month_key: Optional[str] = None):
+        if month_key is None:
+            self._dirty = True
+        else:
+            self._dirty_months.add(month_key)
+            self._month_totals.pop(month_key, None)
+            self._forget_serialized_month(month_key)
+
+    def mark_clean(self):
+        self._dirty = False
+        self._dirty_months = set()
+
+    def set_month_loader(
+        self,
+        load_month: Callable[[str], Optional[MonthlyState]],
+        month_keys: Callable[[], Iterable[str]],
+        cache_size: Optional[int] = None,
+    ):
+        self._load_month = load_month
+        self._stored_month_keys = month_keys
+        self._month_cache_size = cache_size
+
+    def get_month(self, key: str) -> Optional[MonthlyState]:
+        month = self.state.get(key)
+        if not self._load_month:
+            return month
+        if self._read_only:
+            # a snapshot can't evict months, since it couldn't load them
+            # again, so it doesn't keep the ones it loads
+            return month if month is not None else self._load_month(key)
+
+        if month is not None:
+            del self.state[key]
+            self.state[key] = month
+        else:
+            month = self._load_month(key)
+            if month is not None:
+                self._add_loaded_month(key, month)
+
+        self._evict_months()
+        return month
+
+    def month_keys(self) -> list[str]:
+        """
+        Returns the key of every month, including those not loaded yet.
+        """
+        keys = list(self.state.keys())
+        if self._stored_month_keys:
+            keys += [key for key in self._stored_month_keys() if key not in self.state]
+
+        return keys
+
+    def load_all_months(self):
+        """
+        Loads every month into `state`, without evicting any.
+        """
+        if self._load_month:
+            for key in self.month_keys():
+                if key not in self.state:
+                    self._add_loaded_month(key, self._load_month(key))
+
+    def _add_loaded_month(self, key: str, month: MonthlyState):
+        self.state[key] = month
+        # snapshots that would otherwise load it themselves, by which time it
+        # may have changed, share it until it does
+        for loader in self._snapshot_loaders:
+            if loader.share(key, month):
+                self._shared_months.add(key)
+
+    def _evict_months(self):
+        if self._month_cache_size is None:
+            return
+
+        excess = len(self.state) - self._month_cache_size
+        evictable = [key for key in self.state if key not in self._dirty_months]
+        for key in evictable[: max(excess, 0)]:
+            del self.state[key]
+            self._shared_months.discard(key)
+            self._forget_serialized_month(key)
+
+    def _forget_serialized_month(self, key: str):
+        for months in self._serialized_months.values():
+            months.pop(key, None)
+
+    def snapshot(self) -> ApplicationState:
+        """
+        Returns a read-only copy of the state as of now, for reads that
+        aren't done in one go, like an export streamed to a client.  Changes
+        made afterwards never show up in it, and it never holds them up:
+        months are shared between the two until they are next changed, at
+        which point the state gets a copy of its own.
+
+        Months that aren't in memory are loaded from the storage backend
+        whenever the snapshot needs them, until the state loads them itself,
+        from then on it shares them with the snapshot.
+        """
+        if self._read_only:
+            return self
+
+        snapshot = ApplicationState.construct(
+            users=[user.copy() for user in self.users],
+            last_accessed=self.last_accessed,
+            defaults=self.defaults,
+            variable_categories=list(self.variable_categories),
+            fixed_categories=list(self.fixed_categories),
+            state=dict(self.state),
+            version=self.version,
+        )
+        if self._load_month:
+            keys = [key for key in self._stored_month_keys() if key not in self.state]
+            loader = _SnapshotMonthLoader(self._load_month, keys)
+            self._snapshot_loaders.add(loader)
+            snapshot.set_month_loader(loader, lambda: keys)
+        snapshot._read_only = True
+
+        self._shared_months = set(self.state)
+        return snapshot
+
+    def _check_writable(self):
+        if self._read_only:
+            raise TypeError("Snapshots of the state can't be changed")
+
+    def _month_for_write(self, key: str) -> MonthlyState:
+        month = self.state[key]
+        if key in self._shared_months:
+            month = self.state[key] = month.copy_for_write()
+            self._shared_months.discard(key)
+
+        return month
 
     def get_current_state(self, get_now=datetime.now) -> MonthlyState:
-        key = MonthlyState.key_for_date(get_now())
-        if not self.state.get(key):
-            self.state[key] = MonthlyState.new_from_defaults(self.defaults)
+        return self.get_state_for_date(get_now())
+
+    def get_state_for_date(self, dt: datetime) -> MonthlyState:
+        key = MonthlyState.key_for_date(dt)
+        if not self.get_month(key):
+            self.add_month(key, MonthlyState.new_from_defaults(self.defaults))
 
         return self.state[key]
 
+    def get_user(self, email: str) -> Optional[User]:
+        if self._indexed_users is not self.users or self._indexed_user_count != len(self.users):
+            self._rebuild_user_index()
+
+        return self._users_by_email.get(User.normalize_email(email))
+
+    def add_user(self, user: User):
+        self._check_writable()
+        if self.get_user(user.email):
+            raise DuplicateUserError(user.email)
+
+        self.users.append(user)
+        self._users_by_email[User.normalize_email(user.email)] = user
+        self._indexed_user_count += 1
+        self.mark_dirty()
+        self._record("add_user", user=user)
+
+    def _rebuild_user_index(self):
+        self._users_by_email = {}
+        # older databases may contain duplicates, the first one always won
+        for user in reversed(self.users):
+            self._users_by_email[User.normalize_email(user.email)] = user
+        self._indexed_users = self.users
+        self._indexed_user_count = len(self.users)
+
+    def set_password_hash(self, user: User, password_hash: str):
+        self._check_writable()
+        user.password_hash = password_hash
+        self.mark_dirty()
+        self._record("set_password_hash", email=user.email, password_hash=password_hash)
+
+    def set_household(self, user: User, household: Optional[str]):
+        self._check_writable()
+        user.household = household
+        self.mark_dirty()
+        self._record("set_household", email=user.email, household=household)
+
+    def set_household_invite(self, user: User, household: Optional[str]):
+        self._check_writable()
+        user.household_invite = household
+        self.mark_dirty()
+        self._record("set_household_invite", email=user.email, household=household)
+
+    def add_month(self, key: str, month: MonthlyState):
+        self._check_writable()
+        self.state[key] = month
+        self._shared_months.discard(key)
+        self.mark_dirty(key)
+        self._evict_months()
+        self._record("add_month", key=key, month=month)
+
+    def add_transaction(self, transaction: Transaction):
+        # make sure the month exists (and is recorded) before the transaction
+        self._check_writable()
+        key = MonthlyState.key_for_date(transaction.created_at)
+        self.get_state_for_date(transaction.created_at)
+        self._month_for_write(key).add_transaction(transaction)
+        self.mark_dirty(key)
+        self._record("add_transaction", key=key, transaction=transaction)
+
+    def pop_changes(self) -> list[str]:
+        changes, self._changes = self._changes, []
+        return changes
+
+    @property
+    def has_changes(self) -> bool:
+        return bool(self._changes)
+
+    def rerecord_changes(self, changes: list[str]):
+        """
+        Records `changes`, which were popped with `pop_changes` and are
+        already applied, again with new versions: for when changes made
+        elsewhere were applied in the meantime.
+        """
+        for change in changes:
+            record = json.loads(change)
+            del record["version"]
+            self._record(record.pop("op"), **record)
+
+    def _record(self, op: str, **payload):
+        # encode eagerly, since the objects in the payload may be mutated
+        # further before the change is persisted
+        self.version += 1
+        record = {"op": op, "version": self.version, **payload}
+        self._changes.append(json.dumps(record, default=pydantic_encoder))
+
+
+class _SnapshotMonthLoader:
+    """
+    Loads the months of a snapshot that weren't in memory when it was taken:
+    from the storage backend as long as they can't have changed since, that
+    is until the state loads them itself, and then as the state loaded them.
+    """
+
+    def __init__(self, load_month: Callable[[str], Optional[MonthlyState]], keys: list[str]):
+        self.load_month = load_month
+        self.pending = set(keys)
+        self.shared: Dict[str, MonthlyState] = {}
+
+    def __call__(self, key: str) -> Optional[MonthlyState]:
+        if key in self.shared:
+            return self.shared[key]
+        if key not in self.pending:
+            return None
+
+        return self.load_month(key)
+
+    def share(self, key: str, month: MonthlyState) -> bool:
+        """
+        Takes `month`, just loaded by the state, if the snapshot would
+        otherwise load it from the storage backend.
+        """
+        if key not in self.pending:
+            return False
+
+        self.pending.discard(key)
+        self.shared[key] = month
+        return True
+
 
 """
 REPORTING
@@ -84,6 +622,13 @@ class MonthlyTotals(BaseModel):
     unallocated: int
 
 
+class MonthlyTotalsUpdate(BaseModel):
+    month: str
+    totals: MonthlyTotals
+    # category -> total spent: all of them, or only those that changed
+    categories: Dict[str, int]
+
+
 class MonthlyCategoryReport(BaseModel):
     category: str
     total: int
@@ -95,20 +640,32 @@ class MonthlyReport(BaseModel):
     totals: MonthlyTotals
     categories: Dict[str, MonthlyCategoryReport]
 
+    def totals_json(self) -> str:
+        """
+        Serializes the report without the transactions of each category.
+        """
+        return self.json(exclude={"categories": {key: {"transactions"} for key in self.categories}})
+
 
 def get_previous_month(dt: datetime):
     if dt.month == 1:
-        previous_month = 12
-    else:
-        previous_month = dt.month - 1
+        return datetime(dt.year - 1, 12, 1)
 
-    return datetime(dt.year, previous_month, 1)
+    return datetime(dt.year, dt.month - 1, 1)
 
 
 def get_monthly_report(
-    db: ApplicationState, state: MonthlyState, end_time: datetime
+    db: ApplicationState,
+    state: MonthlyState,
+    end_time: datetime,
+    include_transactions: bool = True,
 ) -> MonthlyReport:
-    total_spent = sum(map(lambda t: t.amount, state.transactions))
+    """
+    Reports on `state` up until `end_time`.  Without `include_transactions`
+    the transaction lists of the categories are left empty, for
+    `MonthlyReport.totals_json`.
+    """
+    total_spent = state.total_spent
     total_remaining = state.monthly_income - total_spent
 
     unallocated = sum(map(lambda x: x.amount, state.fixed_expenses))
@@ -120,6 +677,46 @@ def get_monthly_report(
         unallocated=unallocated,
     )
 
+    categories: dict[str, MonthlyCategoryReport] = {}
+    if state.latest_created_at is None or state.latest_created_at <= end_time:
+        # the report covers the whole month, so the running totals are exact
+        for category, total in state.category_totals.items():
+            categories[category] = MonthlyCategoryReport.construct(
+                category=category,
+                total=total,
+                vs_previous_month=0,
+                transactions=(
+                    list(state.category_transactions(category)) if include_transactions else []
+                ),
+            )
+    else:
+        categories = _get_category_reports_until(state, end_time)
+
+    # now we have a mapping of all categories, and we need to calculate the vs. previous months
+    previous_month_key = state.key_for_date(get_previous_month(end_time))
+    previous_month_state = db.get_month(previous_month_key)
+    if not previous_month_state:
+        # don't bother summing, because we have nothing to do
+        return MonthlyReport.construct(totals=totals, categories=categories)
+
+    day_count = end_time.day
+    for category in categories.values():
+        previous_sum = previous_month_state.category_total_until_day(
+            category.category, day_count
+        )
+
+        # category: MonthlyCategoryReport
+        if previous_sum:
+            result = category.total / previous_sum  # e.g. 100 / 90 = 1.11
+            result = result * 100  # e.g. 111
+            category.vs_previous_month = result - 100  # e.g. 111-100 = 11%
+
+    return MonthlyReport.construct(totals=totals, categories=categories)
+
+
+def _get_category_reports_until(
+    state: MonthlyState, end_time: datetime
+) -> dict[str, MonthlyCategoryReport]:
     categories: dict[str, MonthlyCategoryReport] = {}
     for transaction in state.transactions:
         # only select transactions up until the given "end of report" date
@@ -128,7 +725,7 @@ def get_monthly_report(
 
         if categories.get(transaction.category) is None:
             # if we don't have one already, create a new one initialized with the first transaction
-            category_report = MonthlyCategoryReport(
+            category_report = MonthlyCategoryReport.construct(
                 category=transaction.category,
                 total=transaction.amount,
                 vs_previous_month=0,
@@ -142,32 +739,125 @@ def get_monthly_report(
             category_report.transactions.append(transaction)
             category_report.total += transaction.amount
 
-    # now we have a mapping of all categories, and we need to calculate the vs. previous months
-    previous_month_key = state.key_for_date(get_previous_month(end_time))
-    if not db.state.get(previous_month_key):
-        # don't bother summing, because we have nothing to do
-        return MonthlyReport(totals=totals, categories=categories)
+    return categories
 
-    previous_month_state = db.state.get(previous_month_key)
 
-    day_count = end_time.day
-    for category in categories.values():
-        previous_sum = 0
+class SpendingTotals(BaseModel):
+    income: int
+    spent: int
+    net: int
+    categories: Dict[str, int]
+
+    def __add__(self, other: SpendingTotals) -> SpendingTotals:
+        return SpendingTotals.construct(
+            income=self.income + other.income,
+            spent=self.spent + other.spent,
+            net=self.net + other.net,
+            categories=_combine_categories(self.categories, other.categories, 1),
+        )
 
-        # Yes, this is O(n^2), but you know what else isn't optimal?  You.
-        for transaction in previous_month_state.transactions:
-            if transaction.created_at.day > day_count:
-                break
+    def __sub__(self, other: SpendingTotals) -> SpendingTotals:
+        return SpendingTotals.construct(
+            income=self.income - other.income,
+            spent=self.spent - other.spent,
+            net=self.net - other.net,
+            categories=_combine_categories(self.categories, other.categories, -1),
+        )
 
-            if transaction.category != category.category:
-                continue
+    @staticmethod
+    def empty() -> SpendingTotals:
+        return SpendingTotals.construct(income=0, spent=0, net=0, categories={})
 
-            previous_sum += transaction.amount
 
-        # category: MonthlyCategoryReport
-        if previous_sum:
-            result = category.total / previous_sum  # e.g. 100 / 90 = 1.11
-            result = result * 100  # e.g. 111
-            category.vs_previous_month = result - 100  # e.g. 111-100 = 11%
+def _combine_categories(a: Dict[str, int], b: Dict[str, int], sign: int) -> Dict[str, int]:
+    combined = dict(a)
+    for category, total in b.items():
+        combined[category] = combined.get(category, 0) + sign * total
+    return combined
+
 
-    return MonthlyReport(totals=totals, categories=categories)
+class RangeMonthReport(BaseModel):
+    month: str
+    totals: SpendingTotals
+    # this month minus the same month a year earlier, if there is one
+    vs_previous_year: Optional[SpendingTotals]
+
+
+class RangeReport(BaseModel):
+    start: str
+    end: str
+    months: list[RangeMonthReport]
+    totals: SpendingTotals
+    # the totals above minus those of the same months a year earlier, over
+    # the months that exist in both years
+    vs_previous_year: Optional[SpendingTotals]
+
+
+def get_month_totals(state: MonthlyState) -> SpendingTotals:
+    # cheap, since the month keeps its totals up to date
+    return SpendingTotals.construct(
+        income=state.monthly_income,
+        spent=state.total_spent,
+        net=state.monthly_income - state.total_spent,
+        categories=dict(state.category_totals),
+    )
+
+
+def month_keys_between(start: str, end: str) -> list[str]:
+    """
+    Returns the key of every month from `start` to `end`, inclusive.
+    """
+    month = MonthlyState.date_for_key(start)
+    end_month = MonthlyState.date_for_key(end)
+
+    keys = []
+    while month <= end_month:
+        keys.append(MonthlyState.key_for_date(month))
+        month = (month + timedelta(days=32)).replace(day=1)
+
+    return keys
+
+
+def get_previous_year_key(key: str) -> str:
+    month = MonthlyState.date_for_key(key)
+    return MonthlyState.key_for_date(month.replace(year=month.year - 1))
+
+
+def get_range_report(
+    start: str, end: str, get_totals: Callable[[str], Optional[SpendingTotals]]
+) -> RangeReport:
+    """
+    Merges the totals of every month from `start` to `end` (inclusive) that
+    exists, as returned by `get_totals`, along with year-over-year changes.
+    """
+    months: list[RangeMonthReport] = []
+    totals = SpendingTotals.empty()
+    comparable, previous_year = SpendingTotals.empty(), SpendingTotals.empty()
+
+    for key in month_keys_between(start, end):
+        month_totals = get_totals(key)
+        if month_totals is None:
+            continue
+
+        previous_totals = get_totals(get_previous_year_key(key))
+        vs_previous_year = None
+        if previous_totals is not None:
+            vs_previous_year = month_totals - previous_totals
+            comparable += month_totals
+            previous_year += previous_totals
+
+        months.append(
+            RangeMonthReport.construct(
+                month=key, totals=month_totals, vs_previous_year=vs_previous_year
+            )
+        )
+        totals += month_totals
+
+    has_previous_year = any(month.vs_previous_year is not None for month in months)
+    return RangeReport.construct(
+        start=start,
+        end=end,
+        months=months,
+        totals=totals,
+        vs_previous_year=comparable - previous_year if has_previous_year else None,
+    )
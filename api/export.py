@@ -0,0 +1,113 @@
+"""
+Export of transactions as CSV or NDJSON, and of the whole state as JSON.
+
+The export is produced incrementally, one month at a time in chronological
+order, so that it starts straight away and only ever holds one month (and one
+chunk of output) in memory.  Exports should be made from a snapshot of the
+state (see `ApplicationState.snapshot`), so that transactions added while
+one is streamed don't end up in it.
+"""
+import csv
+import io
+import json
+from datetime import date, datetime, timedelta
+from typing import AsyncIterator, Iterator, Optional
+
+from api.domain import ApplicationState, MonthlyState, Transaction
+
+EXPORT_FIELDS = ["created_at", "category", "amount", "title", "notes", "user"]
+
+# number of rows sent to the client at a time
+EXPORT_CHUNK_SIZE = 500
+
+
+def iter_transactions(
+    db: ApplicationState, start: Optional[date] = None, end: Optional[date] = None
+) -> Iterator[Transaction]:
+    """
+    Yields every transaction created between `start` and `end` (both
+    inclusive), oldest first.
+    """
+    for key in sorted(db.month_keys(), key=MonthlyState.date_for_key):
+        first_day = MonthlyState.date_for_key(key).date()
+        if end and first_day > end:
+            break
+        if start and _next_month(first_day) <= start:
+            continue
+
+        month = db.get_month(key)
+        if month is None:
+            continue
+
+        for transaction in sorted(month.transactions, key=lambda t: t.created_at):
+            day = transaction.created_at.date()
+            if (start is None or day >= start) and (end is None or day <= end):
+                yield transaction
+
+
+def _next_month(day: date) -> date:
+    return (day.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+
+async def export_csv(
+    db: ApplicationState, start: Optional[date] = None, end: Optional[date] = None
+) -> AsyncIterator[str]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_FIELDS)
+    yield _drain(buffer)
+
+    for chunk in _chunks(iter_transactions(db, start, end)):
+        for transaction in chunk:
+            writer.writerow([_csv_value(getattr(transaction, f)) for f in EXPORT_FIELDS])
+        yield _drain(buffer)
+
+
+async def export_ndjson(
+    db: ApplicationState, start: Optional[date] = None, end: Optional[date] = None
+) -> AsyncIterator[str]:
+    for chunk in _chunks(iter_transactions(db, start, end)):
+        yield "".join(f"{transaction.json(include=set(EXPORT_FIELDS))}\n" for transaction in chunk)
+
+
+async def export_state(db: ApplicationState) -> AsyncIterator[str]:
+    """
+    The same document as `db.json()`, one month at a time.
+    """
+    yield db.json(exclude={"state"})[:-1] + ', "state": {'
+
+    separator = ""
+    for key in db.month_keys():
+        month = db.get_month(key)
+        if month is not None:
+            yield f"{separator}{json.dumps(key)}: {month.json()}"
+            separator = ", "
+
+    yield "}}"
+
+
+def _chunks(transactions: Iterator[Transaction]) -> Iterator[list[Transaction]]:
+    chunk = []
+    for transaction in transactions:
+        chunk.append(transaction)
+        if len(chunk) == EXPORT_CHUNK_SIZE:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+def _csv_value(value) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def _drain(buffer: io.StringIO) -> str:
+    contents = buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+    return contents
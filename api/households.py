@@ -0,0 +1,235 @@
+"""
+Households: every household has a state of its own, with its own defaults,
+categories and months, which is only loaded when one of its members uses it.
+The main state (see `api.db`) keeps every user's account, including which
+household they belong to, and is also the state of the users that don't
+belong to one.
+
+Loaded households are kept in a pool of at most
+`config.DB_HOUSEHOLD_CACHE_SIZE`; the least recently used one is dropped once
+there are more, and its changes written out in the background.  Each
+household also has its own single writer (see `api.mutations`) and, with
+`config.DB_MULTIPROCESS`, its own lock, so that one household's writes never
+wait for another's.
+"""
+import os
+import secrets
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Optional
+
+from api import config, metrics
+from api.db import (
+    JsonBackend,
+    get_backend,
+    get_db_instance,
+    maybe_rollover_month,
+    refresh_db_instance,
+)
+from api.domain import ApplicationState
+
+
+class UnknownHousehold(Exception):
+    pass
+
+
+class Household:
+    def __init__(self, id: str, backend: JsonBackend):
+        self.id = id
+        self.backend = backend
+        with metrics.DB_LOAD_SECONDS.time():
+            self.db = backend.load()
+        maybe_rollover_month(self.db)
+
+    def refresh(self) -> ApplicationState:
+        self.db = self.backend.refresh(self.db)
+        return self.db
+
+    @property
+    def has_unwritten_changes(self) -> bool:
+        return self.db.has_changes or self.backend.has_failed_changes
+
+    @property
+    def can_close_in_background(self) -> bool:
+        # with `config.DB_MULTIPROCESS`, changes may only be written under
+        # the lock, which may take a while to get
+        return not config.DB_MULTIPROCESS or not (
+            self.backend.lock.is_held or self.has_unwritten_changes
+        )
+
+    def close(self, wait: bool = True):
+        """
+        Writes out what hasn't been yet, and waits until it's on disk.
+        Without `wait`, only hands it to the backend (see
+        `can_close_in_background`), whose `close` must be called before the
+        household is loaded again.
+        """
+        # the lock may be held by this household's writer, with a write in
+        # flight that closing the backend waits for
+        if not config.DB_MULTIPROCESS or self.backend.lock.is_held:
+            self.backend.persist(self.db)
+        elif self.has_unwritten_changes:
+            with self.backend.lock:
+                self.backend.persist(self.refresh())
+        self.backend.close(wait)
+
+
+class HouseholdPool:
+    """
+    Bounded LRU pool of loaded households, kept as JSON documents in
+    `directory`.
+    """
+
+    def __init__(self, directory: str, max_size: int):
+        self.directory = directory
+        self.max_size = max_size
+        self._households: OrderedDict[str, Household] = OrderedDict()
+        # the backends of evicted households that may still be writing
+        self._closing: dict[str, JsonBackend] = {}
+
+    def __len__(self) -> int:
+        return len(self._households)
+
+    def create(self) -> str:
+        """
+        Creates an empty household, and returns its id.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        household_id = secrets.token_hex(8)
+        # loading a household that doesn't exist yet creates its files
+        self._add(Household(household_id, self._backend(household_id)))
+
+        return household_id
+
+    def get(self, household_id: str) -> Household:
+        household = self._households.get(household_id)
+        if household is not None:
+            self._households.move_to_end(household_id)
+            if config.DB_MULTIPROCESS and not household.backend.lock.is_held:
+                household.refresh()
+            return household
+
+        closing = self._closing.pop(household_id, None)
+        if closing is not None:
+            # only blocks if its last changes aren't on disk yet
+            closing.close()
+
+        backend = self._backend(household_id)
+        if not os.path.exists(backend.snapshot_path):
+            backend.close()
+            raise UnknownHousehold(household_id)
+
+        household = Household(household_id, backend)
+        self._add(household)
+        return household
+
+    def loaded(self, household_id: str) -> Optional[Household]:
+        return self._households.get(household_id)
+
+    def close(self):
+        while self._households:
+            _, household = self._households.popitem(last=False)
+            household.close()
+        while self._closing:
+            _, backend = self._closing.popitem()
+            backend.close()
+
+    def _add(self, household: Household):
+        self._households[household.id] = household
+        self._closing = {
+            id: backend for id, backend in self._closing.items() if not backend.is_idle
+        }
+
+        # evicting never waits for the disk, so the pool may stay over its
+        # size for a bit if it would have to
+        excess = len(self._households) - self.max_size
+        evictable = [
+            evicted
+            for evicted in self._households.values()
+            if evicted is not household and evicted.can_close_in_background
+        ]
+        for evicted in evictable[: max(excess, 0)]:
+            del self._households[evicted.id]
+            evicted.close(wait=False)
+            self._closing[evicted.id] = evicted.backend
+
+    def _backend(self, household_id: str) -> JsonBackend:
+        # ids are only ever made by `create`, but they do end up in paths
+        if not household_id.isalnum():
+            raise UnknownHousehold(household_id)
+
+        path = os.path.join(self.directory, f"{household_id}.json")
+        return JsonBackend(
+            path,
+            f"{path}.log",
+            binary_path=os.path.join(self.directory, f"{household_id}.bin"),
+            snapshot_format=config.DB_SNAPSHOT_FORMAT,
+            lock_path=f"{path}.lock",
+        )
+
+
+_pool: Optional[HouseholdPool] = None
+
+
+def get_pool() -> HouseholdPool:
+    global _pool
+    if _pool is None:
+        _pool = HouseholdPool(config.DB_HOUSEHOLD_DIR, config.DB_HOUSEHOLD_CACHE_SIZE)
+
+    return _pool
+
+
+def close_pool():
+    global _pool
+    if _pool is not None:
+        _pool.close()
+    _pool = None
+
+
+metrics.Gauge(
+    "db_households_in_memory", "Households currently loaded", lambda: len(_pool) if _pool else 0
+)
+
+
+################################################################################
+# The state of a household, or the main state for None
+################################################################################
+
+
+def get_household_db(household: Optional[str]) -> ApplicationState:
+    if household is None:
+        return get_db_instance()
+
+    return get_pool().get(household).db
+
+
+def is_current_household_db(household: Optional[str], db: ApplicationState) -> bool:
+    """
+    Whether `db` is still the loaded state of `household`.
+    """
+    if household is None:
+        return db is get_db_instance()
+
+    loaded = get_pool().loaded(household)
+    return loaded is not None and loaded.db is db
+
+
+def get_household_backend(household: Optional[str]):
+    if household is None:
+        return get_backend()
+
+    return get_pool().get(household).backend
+
+
+def refresh_household_db(household: Optional[str]) -> ApplicationState:
+    """
+    See `api.db.refresh_db_instance`.
+    """
+    if household is None:
+        return refresh_db_instance()
+
+    return get_pool().get(household).refresh()
+
+
+def persist_household(household: Optional[str], db: ApplicationState) -> Future:
+    return get_household_backend(household).persist(db)
@@ -0,0 +1,197 @@
+"""
+Bulk import of transactions, e.g. from a bank statement.
+
+Rows are validated one at a time as they arrive, and the valid ones are added
+to the state together at the end, so that an import costs one persistence
+step no matter how many rows it has.  Invalid rows are skipped and reported.
+"""
+import csv
+import json
+from datetime import datetime
+from typing import Any, AsyncIterable, AsyncIterator, Optional, Union
+
+from pydantic import BaseModel, ValidationError, validator
+
+from api.domain import ApplicationState, Transaction
+
+
+INVALID_ENCODING = "not valid UTF-8"
+
+
+class TransactionRow(BaseModel):
+    category: str
+    amount: int
+    created_at: Optional[datetime]
+    title: Optional[str]
+    notes: Optional[str]
+
+    @validator("created_at")
+    def to_local_time(cls, created_at: Optional[datetime]) -> Optional[datetime]:
+        # the state only holds naive local times, which can't be compared
+        # with ones that have an offset
+        if created_at is not None and created_at.tzinfo is not None:
+            return created_at.astimezone().replace(tzinfo=None)
+        return created_at
+
+
+class RowError(BaseModel):
+    row: int
+    error: str
+
+
+class ImportReport(BaseModel):
+    imported: int
+    errors: list[RowError]
+
+
+class TransactionImport:
+    def __init__(self, user_email: str, get_now=datetime.now):
+        self.user_email = user_email
+        self.get_now = get_now
+
+        # (row, transaction) for every row that is valid on its own
+        self._transactions: list[tuple[int, Transaction]] = []
+        self._errors: list[RowError] = []
+        self._row_count = 0
+
+    def add_row(self, row: Any):
+        """
+        Validates `row`, keeping it for `apply` if it is valid and recording
+        an error for it otherwise.
+        """
+        self._row_count += 1
+        if not isinstance(row, dict):
+            self.add_error("expected an object")
+            return
+
+        try:
+            parsed = TransactionRow(**row)
+        except ValidationError as e:
+            self.add_error(_format_validation_error(e))
+            return
+
+        self._transactions.append(
+            (
+                self._row_count,
+                Transaction(
+                    **{
+                        **parsed.dict(),
+                        "created_at": parsed.created_at or self.get_now(),
+                        "user": self.user_email,
+                    }
+                ),
+            )
+        )
+
+    def add_error(self, error: str):
+        """
+        Records an error for the current row, e.g. because it couldn't be
+        parsed at all.
+        """
+        self._errors.append(RowError(row=self._row_count, error=error))
+
+    def skip_row(self, error: str):
+        self._row_count += 1
+        self.add_error(error)
+
+    def apply(self, db: ApplicationState) -> ImportReport:
+        """
+        Adds every valid row to its month (by `created_at`) in `db`, and
+        reports what happened to the others.  Categories are checked here,
+        against the state the rows are added to.
+        """
+        categories = set(db.variable_categories) | set(db.fixed_categories)
+        errors = list(self._errors)
+        imported = 0
+        for row, transaction in self._transactions:
+            if transaction.category not in categories:
+                errors.append(RowError(row=row, error=f"unknown category: {transaction.category}"))
+                continue
+
+            db.add_transaction(transaction)
+            imported += 1
+
+        errors.sort(key=lambda error: error.row)
+        return ImportReport(imported=imported, errors=errors)
+
+
+def _format_validation_error(error: ValidationError) -> str:
+    return "; ".join(
+        f"{'.'.join(str(part) for part in e['loc'])}: {e['msg']}" for e in error.errors()
+    )
+
+
+async def iter_lines(chunks: AsyncIterable[bytes]) -> AsyncIterator[Optional[str]]:
+    """
+    Splits a stream of byte chunks into lines, without waiting for the whole
+    stream.  Lines that aren't valid UTF-8 come out as None.
+    """
+    buffer = b""
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield _decode(line)
+
+    if buffer:
+        yield _decode(buffer)
+
+
+def _decode(line: bytes) -> Optional[str]:
+    try:
+        return line.decode("utf-8-sig").rstrip("\r")
+    except UnicodeDecodeError:
+        return None
+
+
+async def read_ndjson(importer: TransactionImport, chunks: AsyncIterable[bytes]):
+    async for line in iter_lines(chunks):
+        if line is None:
+            importer.skip_row(INVALID_ENCODING)
+            continue
+        if not line.strip():
+            continue
+
+        try:
+            row = json.loads(line)
+        except json.JSONDecodeError as e:
+            importer.skip_row(f"invalid JSON: {e}")
+            continue
+
+        importer.add_row(row)
+
+
+async def read_csv(importer: TransactionImport, chunks: AsyncIterable[bytes]):
+    header: Optional[list[str]] = None
+    record = ""
+    async for line in iter_lines(chunks):
+        if line is None:
+            # drops the rest of the record it's part of, if any
+            record = ""
+            importer.skip_row(INVALID_ENCODING)
+            continue
+
+        # a quoted field may contain line breaks, so keep going until every
+        # quote is closed
+        record = f"{record}\n{line}" if record else line
+        if record.count('"') % 2:
+            continue
+
+        values, record = next(csv.reader([record]), []), ""
+        if not any(values):
+            continue
+
+        if header is None:
+            header = [name.strip() for name in values]
+        elif len(values) != len(header):
+            importer.skip_row(f"expected {len(header)} columns, got {len(values)}")
+        else:
+            importer.add_row(_csv_row(header, values))
+
+    if record:
+        importer.skip_row("unterminated quoted field")
+
+
+def _csv_row(header: list[str], values: list[str]) -> dict[str, Union[str, None]]:
+    # empty cells mean "no value" rather than an empty string
+    return {name: value if value != "" else None for name, value in zip(header, values)}
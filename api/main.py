@@ -1,13 +1,44 @@
-from typing import Optional
-from datetime import datetime
+import secrets
+import time
+from typing import Any, Literal, Optional
+from datetime import date, datetime
 
-from fastapi import Depends, FastAPI, Request, Response, status, HTTPException
+from fastapi import Body, Depends, FastAPI, Query, Request, Response, status, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
-from api.auth import JWT_EXP, AuthProvider
-
-from api.db import get_db_instance, save_state_to_file
-from api.domain import ApplicationState, Transaction, User, get_monthly_report
+from starlette.background import BackgroundTask
+from starlette.routing import Match
+from api import config, metrics, mutations, profiling
+from api.auth import JWT_EXP, AuthProvider, HashingPoolFull
+from api.broadcast import TooManySubscribers, broadcaster
+
+from api.db import (
+    get_db_instance,
+    get_user_with_email,
+    list_transactions,
+    wait_for_writes,
+)
+from api.domain import (
+    ApplicationState,
+    DuplicateUserError,
+    MonthlyState,
+    RangeReport,
+    Transaction,
+    TransactionPage,
+    User,
+)
+from api.export import export_csv, export_ndjson, export_state
+from api.households import (
+    UnknownHousehold,
+    close_pool,
+    get_household_db,
+    get_pool,
+    is_current_household_db,
+    persist_household,
+)
+from api.ingest import ImportReport, TransactionImport, read_csv, read_ndjson
+from api.reports import get_cached_range_report, get_serialized_monthly_report
 
 app = FastAPI()
 
@@ -21,21 +52,95 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.middleware("http")
+async def time_requests(request: Request, call_next):
+    start = time.perf_counter()
+    status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        return response
+    finally:
+        # streamed responses are timed until their headers are sent
+        metrics.REQUEST_SECONDS.observe(
+            time.perf_counter() - start,
+            method=request.method,
+            route=route_template(request),
+            status=str(status_code),
+        )
+
+
+@app.middleware("http")
+async def profile_requests(request: Request, call_next):
+    # a single check when profiling is off
+    if not config.PROFILING or request.headers.get("X-Profile") != "1":
+        return await call_next(request)
+    if not is_admin(user_for_request(request)):
+        return await call_next(request)
+
+    profile = profiling.start()
+    if profile is None:
+        return await call_next(request)
+
+    start = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        profile_id = profiling.stop(
+            profile, request.method, route_template(request), time.perf_counter() - start
+        )
+    response.headers["X-Profile-Id"] = profile_id
+    return response
+
+
+def route_template(request: Request) -> str:
+    # the template rather than the path, so that there's a bounded number
+    # of label values
+    for route in app.routes:
+        match, _ = route.matches(request.scope)
+        if match == Match.FULL:
+            return route.path
+
+    return "unmatched"
+
+
+@app.on_event("shutdown")
+async def flush_database():
+    try:
+        await mutations.close()
+    finally:
+        close_pool()
+        wait_for_writes()
+
+
 # wrap database in dependency so that we only save changes if the request
-# succeeded
+# succeeded.  Writes go through `mutations.submit`; what's saved here are
+# changes made along the way, like a month created by the first report in it
 async def database():
     db = get_db_instance()
     try:
         yield db
-        save_state_to_file(db)
+        await save_incidental_changes(db, None)
     except Exception as e:
+        metrics.DB_PERSIST_SKIPPED.inc()
         print(f"Not saving database because there was an exception: {e}")
 
 
-async def get_current_user(request: Request, db=Depends(database)):
-    token = request.cookies.get("auth_token")
-    auth = AuthProvider(db)
-    user = auth.validate_token(token)
+async def save_incidental_changes(db: ApplicationState, household: Optional[str]):
+    if not config.DB_MULTIPROCESS:
+        # the household may have been evicted, and its changes written out,
+        # since the request got its state
+        if is_current_household_db(household, db):
+            persist_household(household, db)
+    elif db.has_changes:
+        # only the writer may write, since it holds the lock
+        await mutations.submit(lambda db: None, household)
+
+
+# deliberately doesn't depend on `database`: validating a token only reads
+# state, and most of the time is answered from the token cache
+async def get_current_user(request: Request):
+    user = user_for_request(request)
 
     if not user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED)
@@ -43,16 +148,87 @@ async def get_current_user(request: Request, db=Depends(database)):
     return user
 
 
+def user_for_request(request: Request) -> Optional[User]:
+    token = request.cookies.get("auth_token")
+    return AuthProvider(get_db_instance()).validate_token(token)
+
+
+def is_admin(user: Optional[User]) -> bool:
+    return user is not None and User.normalize_email(user.email) in config.ADMIN_EMAILS
+
+
+# `database`, but for the household of the current user
+async def household_database(user: User = Depends(get_current_user)):
+    db = get_household_db(user.household)
+    try:
+        yield db
+        await save_incidental_changes(db, user.household)
+    except Exception as e:
+        metrics.DB_PERSIST_SKIPPED.inc()
+        print(f"Not saving database because there was an exception: {e}")
+
+
+async def get_admin_user(user: User = Depends(get_current_user)):
+    if not is_admin(user):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN)
+
+    return user
+
+
+# for scrapers, which can't log in: `Authorization: Bearer <METRICS_TOKEN>`
+async def get_metrics_reader(request: Request):
+    authorization = request.headers.get("Authorization", "")
+    if config.METRICS_TOKEN and secrets.compare_digest(
+        authorization.encode(), f"Bearer {config.METRICS_TOKEN}".encode()
+    ):
+        return None
+
+    return await get_admin_user(await get_current_user(request))
+
+
 class LoginBody(BaseModel):
     email: str
     password: str
 
 
+@app.exception_handler(HashingPoolFull)
+async def hashing_pool_full(request: Request, exc: HashingPoolFull):
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": "Too many logins in progress, try again shortly"},
+        headers={"Retry-After": "1"},
+    )
+
+
+@app.exception_handler(TooManySubscribers)
+async def too_many_subscribers(request: Request, exc: TooManySubscribers):
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": "Too many clients streaming, try again shortly"},
+        headers={"Retry-After": "5"},
+    )
+
+
+@app.exception_handler(UnknownHousehold)
+async def unknown_household(request: Request, exc: UnknownHousehold):
+    return JSONResponse(
+        status_code=status.HTTP_404_NOT_FOUND, content={"detail": "No such household"}
+    )
+
+
+@app.exception_handler(DuplicateUserError)
+async def duplicate_user(request: Request, exc: DuplicateUserError):
+    return JSONResponse(
+        status_code=status.HTTP_409_CONFLICT,
+        content={"detail": "An account with this email already exists"},
+    )
+
+
 @app.post("/accounts/login")
 async def read_root(body: LoginBody, response: Response, db=Depends(database)):
     auth = AuthProvider(db)
 
-    user = auth.check_password(body.email, body.password)
+    user = await auth.login(body.email, body.password)
     if not user:
         response.status_code = status.HTTP_401_UNAUTHORIZED
     else:
@@ -80,11 +256,16 @@ async def create_user(
     response_model_include={"name", "email"},
     db=Depends(database),
 ):
+    # checked again when the user is added, but there's no point in hashing
+    # a password for an account that can't be created
+    if get_user_with_email(db, body.email):
+        raise DuplicateUserError(body.email)
+
     auth = AuthProvider(db)
     user = User(
-        name=body.name, email=body.email, password_hash=auth.hash_pw(body.password)
+        name=body.name, email=body.email, password_hash=await auth.hash_pw_async(body.password)
     )
-    db.users.append(user)
+    await mutations.submit(lambda db: db.add_user(user))
     response.status_code = status.HTTP_201_CREATED
     return user
 
@@ -103,6 +284,99 @@ async def get_me(
     return current_user
 
 
+class HouseholdOut(BaseModel):
+    id: str
+    members: list[str]
+    invited: list[str]
+
+
+class MemberIn(BaseModel):
+    email: str
+
+
+def get_household_out(household_id: str) -> HouseholdOut:
+    users = get_db_instance().users
+    return HouseholdOut(
+        id=household_id,
+        members=[user.email for user in users if user.household == household_id],
+        invited=[user.email for user in users if user.household_invite == household_id],
+    )
+
+
+@app.post("/households", response_model=HouseholdOut)
+async def create_household(response: Response, current_user: User = Depends(get_current_user)):
+    """
+    Creates a household and moves the current user into it.  Transactions
+    made so far stay where they are.
+    """
+    household_id = get_pool().create()
+    await mutations.submit(
+        lambda db: db.set_household(db.get_user(current_user.email), household_id)
+    )
+    response.status_code = status.HTTP_201_CREATED
+    return get_household_out(household_id)
+
+
+@app.get("/households/current", response_model=HouseholdOut)
+async def get_household(current_user: User = Depends(get_current_user)):
+    if current_user.household is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+
+    return get_household_out(current_user.household)
+
+
+@app.post("/households/current/members", response_model=HouseholdOut)
+async def invite_household_member(body: MemberIn, current_user: User = Depends(get_current_user)):
+    """
+    Invites the user with `email` into the current user's household, which
+    they join with `POST /households/{id}/join`.  A later invite replaces an
+    earlier one.
+    """
+    if current_user.household is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+
+    def invite(db: ApplicationState):
+        user = db.get_user(body.email)
+        if user is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No such user")
+        if user.household == current_user.household:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Already a member")
+        db.set_household_invite(user, current_user.household)
+
+    await mutations.submit(invite)
+    return get_household_out(current_user.household)
+
+
+@app.post("/households/{household_id}/join", response_model=HouseholdOut)
+async def join_household(household_id: str, current_user: User = Depends(get_current_user)):
+    """
+    Accepts the current user's invite to `household_id`, moving them into it
+    (and out of the one they were in, if any).
+    """
+
+    def join(db: ApplicationState):
+        user = db.get_user(current_user.email)
+        if user.household_invite != household_id:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+        db.set_household_invite(user, None)
+        db.set_household(user, household_id)
+
+    await mutations.submit(join)
+    return get_household_out(household_id)
+
+
+@app.post("/households/current/leave", status_code=status.HTTP_204_NO_CONTENT)
+async def leave_household(current_user: User = Depends(get_current_user)):
+    """
+    Moves the current user out of their household, back to their own state.
+    """
+    if current_user.household is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+
+    await mutations.submit(lambda db: db.set_household(db.get_user(current_user.email), None))
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+
 class TransactionIn(BaseModel):
     category: str
     amount: int
@@ -115,7 +389,6 @@ async def create_transaction(
     transaction_body: TransactionIn,
     response: Response,
     current_user=Depends(get_current_user),
-    db: ApplicationState = Depends(database),
 ):
     transaction = Transaction(
         **{
@@ -124,27 +397,207 @@ async def create_transaction(
             "user": current_user.email,
         }
     )
-    db.get_current_state().transactions.append(transaction)
+    await mutations.submit(
+        lambda db: db.add_transaction(transaction), current_user.household
+    )
     response.status_code = status.HTTP_201_CREATED
     return transaction
 
 
+@app.get("/transactions", response_model=TransactionPage)
+async def get_transactions(
+    month: Optional[str] = Query(None, example="06/22"),
+    category: Optional[str] = None,
+    user: Optional[str] = None,
+    start: Optional[date] = Query(None, alias="from"),
+    end: Optional[date] = Query(None, alias="to"),
+    cursor: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=500),
+    current_user=Depends(get_current_user),
+    db: ApplicationState = Depends(household_database),
+):
+    """
+    Lists the transactions matching the filters, newest first, a page at a
+    time: pass the `next_cursor` of a page as `cursor` to get the next one.
+    """
+    try:
+        if month is not None:
+            month = MonthlyState.key_for_date(MonthlyState.date_for_key(month))
+        return list_transactions(db, month, category, user, start, end, cursor, limit)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e))
+
+
+async def commit_import(importer: TransactionImport, household: Optional[str], response: Response):
+    # however many rows there were, this is a single change
+    report = await mutations.submit(importer.apply, household)
+    response.status_code = (
+        status.HTTP_201_CREATED if report.imported else status.HTTP_422_UNPROCESSABLE_ENTITY
+    )
+    return report
+
+
+@app.post("/transactions/batch", response_model=ImportReport)
+async def create_transactions(
+    response: Response,
+    rows: list[Any] = Body(...),
+    current_user=Depends(get_current_user),
+):
+    """
+    Adds every valid transaction in `rows`, each to the month of its
+    `created_at` (default now), and reports the rows that were rejected.
+    """
+    importer = TransactionImport(current_user.email)
+    for row in rows:
+        importer.add_row(row)
+
+    return await commit_import(importer, current_user.household, response)
+
+
+@app.post("/transactions/import", response_model=ImportReport)
+async def import_transactions(
+    request: Request,
+    response: Response,
+    format: Optional[Literal["csv", "ndjson"]] = None,
+    current_user=Depends(get_current_user),
+):
+    """
+    Like `/transactions/batch`, but for a CSV (with a header row) or NDJSON
+    upload in the request body, which is parsed as it streams in.  The
+    format is taken from `format` or else the Content-Type.
+    """
+    if format is None:
+        content_type = request.headers.get("Content-Type", "")
+        format = "csv" if content_type.startswith("text/csv") else "ndjson"
+
+    importer = TransactionImport(current_user.email)
+    read = read_csv if format == "csv" else read_ndjson
+    await read(importer, request.stream())
+
+    return await commit_import(importer, current_user.household, response)
+
+
+@app.get("/transactions/export")
+async def export_transactions(
+    start: Optional[date] = Query(None, alias="from"),
+    end: Optional[date] = Query(None, alias="to"),
+    format: Literal["csv", "ndjson"] = "csv",
+    current_user=Depends(get_current_user),
+    db: ApplicationState = Depends(household_database),
+):
+    """
+    Streams every transaction between `from` and `to` (inclusive dates),
+    oldest first.
+    """
+    snapshot = db.snapshot()
+    if format == "csv":
+        rows, media_type = export_csv(snapshot, start, end), "text/csv"
+    else:
+        rows, media_type = export_ndjson(snapshot, start, end), "application/x-ndjson"
+
+    return StreamingResponse(
+        rows,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="transactions.{format}"'},
+    )
+
+
+@app.get("/_internal/metrics")
+async def get_metrics(reader: Optional[User] = Depends(get_metrics_reader)):
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/_internal/profiles", response_model=list[profiling.ProfileInfo])
+async def get_profiles(user: User = Depends(get_admin_user)):
+    return profiling.list_profiles()
+
+
+@app.get("/_internal/profiles/{profile_id}")
+async def get_profile(
+    profile_id: str, format: Literal["prof", "text"] = "prof", user: User = Depends(get_admin_user)
+):
+    """
+    Downloads a profile for `pstats` or snakeviz, or with `format=text` shows
+    the functions that took the most time.
+    """
+    path = profiling.profile_path(profile_id)
+    if path is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+
+    if format == "text":
+        return PlainTextResponse(profiling.render_text(path))
+
+    return FileResponse(path, media_type="application/octet-stream", filename=profile_id)
+
+
 @app.get("/_internal/state")
 async def dump_state(
-    user: User = Depends(get_current_user), db: ApplicationState = Depends(database)
+    user: User = Depends(get_current_user), db: ApplicationState = Depends(household_database)
 ):
     # note that this dumps users's password hashes, so it's not really a
     # longterm solution
-    return db
+    return StreamingResponse(export_state(db.snapshot()), media_type="application/json")
 
 
 @app.get("/months/current")
 async def get_monthly_summary(
-    user: User = Depends(get_current_user), db: ApplicationState = Depends(database)
+    request: Request,
+    totals_only: bool = False,
+    user: User = Depends(get_current_user),
+    db: ApplicationState = Depends(household_database),
 ):
-    summary = get_monthly_report(db, db.get_current_state(), datetime.now())
-    return summary
+    # with `totals_only`, the transactions are left to `GET /transactions`
+    report = get_serialized_monthly_report(db, datetime.now(), not totals_only)
+    headers = {"ETag": report.etag, "Cache-Control": "no-cache"}
+    if request.headers.get("If-None-Match") == report.etag:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    return Response(content=report.body, media_type="application/json", headers=headers)
+
+
+@app.get("/months/current/stream")
+async def stream_monthly_totals(user: User = Depends(get_current_user)):
+    """
+    Server-sent events with the totals of the current month, sent whenever
+    they change, so that clients don't have to poll `/months/current`.
+    """
+    subscription = broadcaster.subscribe(user.household)
+    return StreamingResponse(
+        subscription.events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        # in case the response never gets to start the stream
+        background=BackgroundTask(subscription.close),
+    )
+
+
+@app.get("/reports/range", response_model=RangeReport)
+async def get_report_for_range(
+    start: str = Query(..., alias="from", example="01/22"),
+    end: str = Query(..., alias="to", example="12/22"),
+    user: User = Depends(get_current_user),
+    db: ApplicationState = Depends(household_database),
+):
+    """
+    Totals for every month from `from` to `to` (both MM/YY, inclusive) and
+    for the range as a whole, along with year-over-year changes.
+    """
+    try:
+        start_month, end_month = MonthlyState.date_for_key(start), MonthlyState.date_for_key(end)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Months must be MM/YY"
+        )
+    if start_month > end_month:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="from is after to"
+        )
+
+    return get_cached_range_report(
+        db, MonthlyState.key_for_date(start_month), MonthlyState.key_for_date(end_month)
+    )
+
 
 @app.get("/variable_categories")
-async def get_variable_categories(db: ApplicationState = Depends(database)):
+async def get_variable_categories(db: ApplicationState = Depends(household_database)):
     return db.variable_categories
@@ -0,0 +1,199 @@
+"""
+Counters, gauges and latency histograms, served in the Prometheus text format
+by `/_internal/metrics`.
+
+The counters and histograms are defined at the bottom of this module, so
+that this is the one place to look for what is measured; gauges are defined
+next to the state they read.  Metrics are safe to update from any thread.
+"""
+import bisect
+import functools
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator
+
+# tuned for an app whose operations range from microseconds (cache hits) to
+# seconds (loading a large database)
+DEFAULT_BUCKETS = (
+    0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+)
+
+_registry: list = []
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(_label_key(labels), 0)
+
+    def render(self) -> Iterator[str]:
+        yield from _header(self, "counter")
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield f"{self.name}{_format_labels(key)} {_format_value(value)}"
+
+
+class Gauge:
+    """
+    A value that is read when the metrics are scraped, from `get_value`.
+    """
+
+    def __init__(self, name: str, documentation: str, get_value: Callable[[], float]):
+        self.name = name
+        self.documentation = documentation
+        self.get_value = get_value
+        _registry.append(self)
+
+    def render(self) -> Iterator[str]:
+        try:
+            value = self.get_value()
+        except Exception:
+            # e.g. a file that doesn't exist yet; leave the gauge out
+            return
+        yield from _header(self, "gauge")
+        yield f"{self.name} {_format_value(value)}"
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        # label key -> (count per bucket, sum, count)
+        self._values: dict[tuple, tuple[list[int], float, int]] = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value: float, **labels: str):
+        key = _label_key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total, count = self._values.get(key) or ([0] * len(self.buckets), 0.0, 0)
+            if index < len(counts):
+                counts[index] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    @contextmanager
+    def time(self, **labels: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def timed(self, **labels: str):
+        """
+        Decorator version of `time`.
+        """
+
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.time(**labels):
+                    return function(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def count(self, **labels: str) -> int:
+        entry = self._values.get(_label_key(labels))
+        return entry[2] if entry else 0
+
+    def render(self) -> Iterator[str]:
+        yield from _header(self, "histogram")
+        with self._lock:
+            values = [
+                (key, list(counts), total, count)
+                for key, (counts, total, count) in self._values.items()
+            ]
+        for key, counts, total, count in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = (("le", _format_value(bound)),)
+                yield f"{self.name}_bucket{_format_labels(key + le)} {cumulative}"
+            yield f"{self.name}_bucket{_format_labels(key + (('le', '+Inf'),))} {count}"
+            yield f"{self.name}_sum{_format_labels(key)} {_format_value(total)}"
+            yield f"{self.name}_count{_format_labels(key)} {count}"
+
+
+def render() -> str:
+    """
+    Returns every metric in the Prometheus text exposition format.
+    """
+    return "".join(f"{line}\n" for metric in _registry for line in metric.render())
+
+
+def _header(metric, kind: str) -> Iterator[str]:
+    yield f"# HELP {metric.name} {metric.documentation}"
+    yield f"# TYPE {metric.name} {kind}"
+
+
+def _label_key(labels: dict[str, str]) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key: tuple) -> str:
+    if not key:
+        return ""
+
+    def escape(value) -> str:
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in key) + "}"
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+################################################################################
+# Metrics
+################################################################################
+
+REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "Time spent handling requests, by route and status"
+)
+
+DB_LOAD_SECONDS = Histogram("db_load_duration_seconds", "Time spent loading the state")
+DB_SAVE_SECONDS = Histogram(
+    "db_save_duration_seconds", "Time spent writing full snapshots of the state"
+)
+DB_WRITE_SECONDS = Histogram(
+    "db_write_duration_seconds", "Time the background writer spent on each batch"
+)
+DB_WRITES = Counter("db_writes_total", "Changes and snapshots handed to the background writer")
+DB_BYTES_WRITTEN = Counter("db_bytes_written_total", "Bytes written to database files")
+MUTATION_BATCH_SIZE = Histogram(
+    "db_mutation_batch_size",
+    "Changes applied by the single writer per write",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256),
+)
+DB_PERSIST_SKIPPED = Counter(
+    "db_persist_skipped_total", "Requests whose changes weren't saved because they failed"
+)
+
+REPORT_SECONDS = Histogram("report_duration_seconds", "Time spent building reports, by report")
+CACHE_REQUESTS = Counter("cache_requests_total", "Cache lookups, by cache and result")
+
+PASSWORD_HASH_SECONDS = Histogram(
+    "password_hash_duration_seconds", "Time spent in bcrypt, by operation"
+)
+JWT_SECONDS = Histogram("jwt_duration_seconds", "Time spent encoding and verifying JWTs")
@@ -0,0 +1,213 @@
+"""
+The single writer: changes to the state are submitted as functions of the
+state, and one asyncio task applies them one at a time, in the order they
+were submitted.  Everything that queued up while the previous batch was
+being applied is applied as the next batch and handed to the storage backend
+as one write, so a burst of concurrent requests costs a single snapshot (or
+a single append to the change log).
+
+Since every change is applied by the writer, the versions it records are
+assigned in exactly the order the changes were made, and reads, which never
+wait for the writer, always see the state between two changes.
+
+With `config.DB_MULTIPROCESS`, the writer of each process takes the
+database's lock for every batch, catches up with what the other processes
+wrote, and only lets go once the batch is on disk.
+
+If writing a batch fails, its callers get the error, but its changes stay
+applied: the storage backend writes them again along with the next batch
+(or when the writer is closed).
+
+Every household (see `api.households`) has a writer of its own, which is
+dropped once it's idle and there are more than `config.DB_HOUSEHOLD_CACHE_SIZE`
+others.
+"""
+import asyncio
+from collections import OrderedDict
+from typing import Any, Callable, Optional, TypeVar
+
+from api import config, metrics
+from api.broadcast import broadcaster
+from api.domain import ApplicationState
+from api.households import (
+    get_household_backend,
+    get_household_db,
+    persist_household,
+    refresh_household_db,
+)
+
+T = TypeVar("T")
+
+
+class MutationQueue:
+    def __init__(self, max_batch: int, household: Optional[str] = None):
+        self.max_batch = max_batch
+        self.household = household
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._busy = False
+
+    @property
+    def is_idle(self) -> bool:
+        return self._queue is None or (self._queue.empty() and not self._busy)
+
+    async def submit(self, apply: Callable[[ApplicationState], T]) -> T:
+        """
+        Queues `apply` to be called with the state, and returns its result
+        once the change it made is on disk.  If `apply` raises, so does
+        this, and other changes in the same batch are unaffected.
+        """
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._start(loop)
+
+        future = loop.create_future()
+        self._queue.put_nowait((apply, future))
+        return await future
+
+    async def close(self):
+        """
+        Waits until everything submitted so far is on disk, and stops the
+        writer.
+        """
+        try:
+            if self._loop is asyncio.get_running_loop():
+                # a change that changes nothing still makes the backend
+                # write what's left over from failed writes
+                await self.submit(lambda db: None)
+        finally:
+            self._stop()
+
+    def _start(self, loop: asyncio.AbstractEventLoop):
+        # one writer per event loop: the test client runs each request on a
+        # loop of its own, a server only ever has one
+        self._stop()
+        self._loop = loop
+        self._queue = asyncio.Queue()
+        self._task = loop.create_task(self._run())
+
+    def _stop(self):
+        # once its loop is closed, the task can never run again anyway
+        if self._task is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._task.cancel)
+        self._loop = self._queue = self._task = None
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.max_batch and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+
+            if config.DB_MULTIPROCESS:
+                self._busy = True
+                try:
+                    await self._apply_exclusively(batch)
+                finally:
+                    self._busy = False
+                continue
+
+            applied, written = self._apply(batch, get_household_db)
+            # don't wait for the disk before applying the next batch; the
+            # backend writes batches in the order they were handed to it
+            if applied:
+                self._loop.create_task(self._acknowledge(applied, written))
+
+    async def _apply_exclusively(self, batch: list):
+        lock = get_household_backend(self.household).lock
+        await self._loop.run_in_executor(None, lock.acquire)
+        try:
+            applied, written = self._apply(batch, refresh_household_db)
+            if applied:
+                await self._acknowledge(applied, written)
+        finally:
+            lock.release()
+
+    def _apply(self, batch: list, get_db: Callable[[Optional[str]], ApplicationState]):
+        """
+        Applies `batch` and hands it to the backend.  Returns the futures of
+        the changes that were applied along with their results, and the
+        future of the write.
+        """
+        # no awaiting in here, so that nothing else can change the state
+        # until the batch is handed to the backend
+        applied = []
+        try:
+            db = get_db(self.household)
+            for apply, future in batch:
+                try:
+                    applied.append((future, apply(db)))
+                except Exception as e:
+                    _resolve(future, exception=e)
+            written = persist_household(self.household, db)
+        except Exception as e:
+            for _, future in batch:
+                _resolve(future, exception=e)
+            return [], None
+
+        metrics.MUTATION_BATCH_SIZE.observe(len(batch))
+        return applied, written
+
+    async def _acknowledge(self, applied: list[tuple[asyncio.Future, Any]], written):
+        try:
+            await asyncio.wrap_future(written)
+        except Exception as e:
+            for future, _ in applied:
+                _resolve(future, exception=e)
+        else:
+            for future, result in applied:
+                _resolve(future, result)
+            broadcaster.publish(self.household)
+
+
+def _resolve(future: asyncio.Future, result: Any = None, exception: Optional[Exception] = None):
+    # the request may have been cancelled (e.g. the client went away) while
+    # its change was being applied
+    if future.done():
+        return
+    if exception is not None:
+        future.set_exception(exception)
+    else:
+        future.set_result(result)
+
+
+# household -> its writer, None for the main state, least recently used first
+_queues: OrderedDict[Optional[str], MutationQueue] = OrderedDict()
+
+
+async def submit(apply: Callable[[ApplicationState], T], household: Optional[str] = None) -> T:
+    """
+    `MutationQueue.submit` on the writer of `household`.
+    """
+    queue = _queues.get(household)
+    if queue is None:
+        queue = _queues[household] = MutationQueue(config.DB_MUTATION_BATCH_SIZE, household)
+        _drop_idle_writers()
+    else:
+        _queues.move_to_end(household)
+
+    return await queue.submit(apply)
+
+
+def _drop_idle_writers():
+    # the main state's writer is always kept
+    excess = sum(household is not None for household in _queues) - config.DB_HOUSEHOLD_CACHE_SIZE
+    idle = [
+        household
+        for household, queue in list(_queues.items())[:-1]
+        if household is not None and queue.is_idle
+    ]
+    for household in idle[: max(excess, 0)]:
+        _queues.pop(household)._stop()
+
+
+async def close():
+    """
+    `MutationQueue.close` on every writer.
+    """
+    queues = list(_queues.values())
+    _queues.clear()
+    results = await asyncio.gather(*(queue.close() for queue in queues), return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
@@ -0,0 +1,101 @@
+"""
+On-demand profiling of individual requests, see `config.PROFILING`.
+
+Profiles are made with cProfile on the event loop's thread, so work handed
+to other threads (password hashing, disk writes) only shows up as time spent
+waiting for it, and requests running concurrently with a profiled one end up
+in its profile too.  Only one request is profiled at a time.
+"""
+import cProfile
+import io
+import os
+import pstats
+import re
+import threading
+import time
+from datetime import datetime
+from typing import Optional
+
+from pydantic import BaseModel
+
+from api import config
+
+_lock = threading.Lock()
+
+
+class ProfileInfo(BaseModel):
+    id: str
+    size: int
+    created_at: datetime
+
+
+def start() -> Optional[cProfile.Profile]:
+    """
+    Starts profiling, unless another request is being profiled already.
+    """
+    if not _lock.acquire(blocking=False):
+        return None
+
+    profile = cProfile.Profile()
+    profile.enable()
+    return profile
+
+
+def stop(profile: cProfile.Profile, method: str, route: str, duration: float) -> str:
+    """
+    Stops `profile` and saves it, returning the id it can be downloaded with.
+    """
+    profile.disable()
+    _lock.release()
+
+    os.makedirs(config.PROFILE_DIR, exist_ok=True)
+    slug = re.sub(r"[^a-zA-Z0-9]+", "-", route).strip("-") or "root"
+    profile_id = f"{time.time_ns()}-{method.lower()}-{slug}-{round(duration * 1000)}ms.prof"
+    profile.dump_stats(os.path.join(config.PROFILE_DIR, profile_id))
+    _prune()
+
+    return profile_id
+
+
+def list_profiles() -> list[ProfileInfo]:
+    """
+    Returns the saved profiles, newest first.
+    """
+    if not os.path.isdir(config.PROFILE_DIR):
+        return []
+
+    profiles = []
+    for name in os.listdir(config.PROFILE_DIR):
+        if not name.endswith(".prof"):
+            continue
+        stat = os.stat(os.path.join(config.PROFILE_DIR, name))
+        profiles.append(
+            ProfileInfo(
+                id=name, size=stat.st_size, created_at=datetime.fromtimestamp(stat.st_mtime)
+            )
+        )
+
+    return sorted(profiles, key=lambda profile: profile.id, reverse=True)
+
+
+def profile_path(profile_id: str) -> Optional[str]:
+    # only ever names that are actually in the directory, never a path
+    if profile_id not in {profile.id for profile in list_profiles()}:
+        return None
+
+    return os.path.join(config.PROFILE_DIR, profile_id)
+
+
+def render_text(path: str, limit: int = 50) -> str:
+    """
+    Returns the `limit` functions of the profile at `path` with the most
+    cumulative time, as a table.
+    """
+    stream = io.StringIO()
+    pstats.Stats(path, stream=stream).sort_stats("cumulative").print_stats(limit)
+    return stream.getvalue()
+
+
+def _prune():
+    for profile in list_profiles()[config.PROFILE_KEEP:]:
+        os.remove(os.path.join(config.PROFILE_DIR, profile.id))
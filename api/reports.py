@@ -0,0 +1,115 @@
+"""
+Serialized, cached versions of the reports in `api.domain`, for endpoints
+that are polled much more often than the underlying data changes.
+"""
+import hashlib
+from datetime import datetime
+from typing import NamedTuple, Optional
+
+from api import metrics
+from api.domain import (
+    ApplicationState,
+    MonthlyState,
+    MonthlyTotalsUpdate,
+    RangeReport,
+    SpendingTotals,
+    get_month_totals,
+    get_monthly_report,
+    get_previous_month,
+    get_range_report,
+)
+
+
+class SerializedReport(NamedTuple):
+    etag: str
+    body: bytes
+
+
+def get_serialized_monthly_report(
+    db: ApplicationState, end_time: datetime, include_transactions: bool = True
+) -> SerializedReport:
+    """
+    Returns the serialized monthly report for the month containing
+    `end_time`, re-using the previous result for as long as neither that
+    month nor the one before it changed and the report day is the same.
+    Without `include_transactions` only the totals of each category are
+    included, which is much smaller for a busy month.
+    """
+    state = db.get_state_for_date(end_time)
+    month_key = MonthlyState.key_for_date(end_time)
+    previous_month = db.get_month(MonthlyState.key_for_date(get_previous_month(end_time)))
+    cache_key = (
+        state.version,
+        previous_month.version if previous_month else None,
+        end_time.day,
+    )
+
+    cached = db._report_cache.get((month_key, include_transactions))
+    hit = cached is not None and cached[0] == cache_key
+    metrics.CACHE_REQUESTS.inc(cache="report", result="hit" if hit else "miss")
+    if hit:
+        return cached[1]
+
+    with metrics.REPORT_SECONDS.time(report="monthly"):
+        report = get_monthly_report(db, state, end_time, include_transactions)
+        body = (report.json() if include_transactions else report.totals_json()).encode()
+    serialized = SerializedReport(etag=f'"{hashlib.sha1(body).hexdigest()}"', body=body)
+
+    # a report that ends before some of the month's transactions depends on
+    # the exact end time rather than just the day, so it isn't worth keeping
+    if state.latest_created_at is None or state.latest_created_at <= end_time:
+        db._report_cache[(month_key, include_transactions)] = (cache_key, serialized)
+
+    return serialized
+
+
+def get_monthly_totals_update(db: ApplicationState, end_time: datetime) -> MonthlyTotalsUpdate:
+    """
+    The totals of the month containing `end_time` and of each of its
+    categories.
+    """
+    key = MonthlyState.key_for_date(end_time)
+    # a month nobody has used yet isn't created just to report on it
+    state = db.get_month(key) or MonthlyState.new_from_defaults(db.defaults)
+    with metrics.REPORT_SECONDS.time(report="totals_update"):
+        report = get_monthly_report(db, state, end_time, include_transactions=False)
+
+    return MonthlyTotalsUpdate(
+        month=key,
+        totals=report.totals,
+        categories={name: category.total for name, category in report.categories.items()},
+    )
+
+
+def get_cached_month_totals(db: ApplicationState, key: str) -> Optional[SpendingTotals]:
+    """
+    Returns the totals of the month `key`, or None if there is no such
+    month.  The totals are kept until the month changes, so ranges of months
+    that have been evicted from memory can be reported without reloading them.
+    """
+    cached = db._month_totals.get(key)
+    month = db.state.get(key)
+    # the month being in memory allows for a check against changes that
+    # bypassed `mark_dirty`
+    hit = cached is not None and (month is None or month.version == cached[0])
+    metrics.CACHE_REQUESTS.inc(cache="month_totals", result="hit" if hit else "miss")
+    if hit:
+        return cached[1]
+
+    month = db.get_month(key)
+    if month is None:
+        return None
+
+    totals = get_month_totals(month)
+    db._month_totals[key] = (month.version, totals)
+    return totals
+
+
+def get_cached_range_report(db: ApplicationState, start: str, end: str) -> RangeReport:
+    # listed once up front, so that months that don't exist (which is most
+    # of them, for year-over-year comparisons early on) are never looked up
+    existing = set(db.month_keys())
+    with metrics.REPORT_SECONDS.time(report="range"):
+        return get_range_report(
+            start, end, lambda key: get_cached_month_totals(db, key) if key in existing else None
+        )
@@ -0,0 +1,140 @@
+"""
+Sharded JSON storage backend, selected with `DB_BACKEND=sharded`.
+
+The state is split into one file per month (named after its month key) and
+one file for everything else, all under DB_SHARD_DIR.  Months are loaded the
+first time they are used, and only the files that changed are rewritten.
+
+Run `python -m api.db --backend sharded` (or `./x.py migrate`) to split an
+existing JSON database into shards.
+"""
+import json
+import os
+import threading
+from concurrent.futures import Future
+from typing import Iterable, Optional
+
+from api import config
+from api.db import (
+    PersistenceWriter,
+    atomic_write,
+    default_state,
+    file_sizes,
+    resolved_future,
+)
+from api.domain import ApplicationState, MonthlyState
+
+
+class ShardedBackend:
+    def __init__(self, path: str):
+        self.path = path
+        self.months_path = os.path.join(path, "months")
+        self.state_path = os.path.join(path, "state.json")
+        self.fsync = config.DB_DURABILITY == "fsync"
+
+        os.makedirs(self.months_path, exist_ok=True)
+        # files whose write failed, written again with the next batch
+        self._failed: dict[str, Optional[str]] = {}
+        self._failed_lock = threading.Lock()
+        self._writer = PersistenceWriter(self._write, config.DB_FLUSH_INTERVAL)
+
+    def load(self) -> ApplicationState:
+        if not os.path.exists(self.state_path):
+            atomic_write(self.state_path, json.dumps(default_state), self.fsync)
+
+        with open(self.state_path, "r") as file:
+            json_object = json.loads(file.read())
+
+        # any months in an old-style document are ignored, they live in their
+        # own files here
+        db = ApplicationState(**{**json_object, "state": {}})
+        db.set_month_loader(self.load_month, self.month_keys, config.DB_MONTH_CACHE_SIZE)
+
+        return db
+
+    def load_month(self, key: str) -> Optional[MonthlyState]:
+        # an evicted month may still have writes in flight
+        if not self._writer.is_idle:
+            self._writer.flush().result()
+
+        try:
+            with open(self._month_path(key), "r") as file:
+                return MonthlyState(**json.loads(file.read()))
+        except FileNotFoundError:
+            return None
+
+    def month_keys(self) -> Iterable[str]:
+        keys = [
+            name[: -len(".json")].replace("-", "/")
+            for name in os.listdir(self.months_path)
+            if name.endswith(".json")
+        ]
+        return sorted(keys, key=MonthlyState.date_for_key)
+
+    def save(self, state: ApplicationState) -> Future:
+        state.load_all_months()
+        files = {self.state_path: state.json(exclude={"state"})}
+        for key, month in state.state.items():
+            files[self._month_path(key)] = month.json()
+        for key in set(self.month_keys()) - state.state.keys():
+            files[self._month_path(key)] = None
+
+        state.pop_changes()
+        state.mark_clean()
+
+        return self._writer.submit(files)
+
+    def persist(self, db: ApplicationState) -> Future:
+        # the dirty flags say everything this backend needs to know
+        db.pop_changes()
+        if not db.is_dirty:
+            # gives a failed write another try
+            return self._writer.flush() if self.has_failed_changes else resolved_future()
+
+        # the version changes with every change, so the global file is always
+        # rewritten; it's small compared to a month
+        files = {self.state_path: db.json(exclude={"state"})}
+        for key in db.dirty_months:
+            files[self._month_path(key)] = db.state[key].json()
+        db.mark_clean()
+
+        return self._writer.submit(files)
+
+    def flush(self) -> Future:
+        return self._writer.flush()
+
+    @property
+    def has_failed_changes(self) -> bool:
+        with self._failed_lock:
+            return bool(self._failed)
+
+    def close(self):
+        self._writer.close()
+
+    def disk_usage(self) -> int:
+        months = [os.path.join(self.months_path, name) for name in os.listdir(self.months_path)]
+        return file_sizes([self.state_path, *months])
+
+    def _month_path(self, key: str) -> str:
+        return os.path.join(self.months_path, f"{key.replace('/', '-')}.json")
+
+    def _write(self, batch: list[dict[str, Optional[str]]]):
+        # only the latest contents of each file need to be written
+        with self._failed_lock:
+            files, self._failed = self._failed, {}
+        for item in batch:
+            files.update(item)
+
+        written = set()
+        try:
+            for path, contents in files.items():
+                if contents is None:
+                    if os.path.exists(path):
+                        os.remove(path)
+                else:
+                    atomic_write(path, contents, self.fsync)
+                written.add(path)
+        except Exception:
+            with self._failed_lock:
+                self._failed = {p: c for p, c in files.items() if p not in written}
+            raise
@@ -0,0 +1,145 @@
+"""
+Compact snapshot format for the JSON backend, selected with
+`DB_SNAPSHOT_FORMAT=binary`.
+
+A snapshot is a short header (magic bytes, format version, payload length and
+a CRC32 of the payload) followed by a zlib-compressed JSON payload in which
+every month is stored column by column, with categories and users replaced by
+indexes into a per-month string table.  Snapshots are only ever written by
+this application, so they are loaded without pydantic validation.  A
+truncated or corrupted snapshot fails the checksum and raises
+`SnapshotError`, rather than being loaded.
+"""
+import json
+import struct
+import zlib
+from datetime import datetime
+
+from api.domain import (
+    ApplicationState,
+    FixedExpense,
+    MonthlyState,
+    StateDefaults,
+    Transaction,
+    User,
+)
+
+MAGIC = b"BDGT"
+FORMAT_VERSION = 1
+HEADER = struct.Struct(">4sHQI")
+
+TRANSACTION_COLUMNS = ["category", "amount", "created_at", "user", "title", "notes"]
+
+
+class SnapshotError(ValueError):
+    pass
+
+
+def is_snapshot(data: bytes) -> bool:
+    return data[: len(MAGIC)] == MAGIC
+
+
+def encode_snapshot(state: ApplicationState) -> bytes:
+    """
+    Encodes `state`, re-using the encoded form of every month that hasn't
+    changed since the last snapshot.
+    """
+    cache = state._serialized_months.setdefault("columnar", {})
+    for key in state.dirty_months | (state.state.keys() - cache.keys()):
+        cache[key] = encode_month(state.state[key])
+    for key in cache.keys() - state.state.keys():
+        del cache[key]
+
+    months = ",".join(f"{json.dumps(key)}:{cache[key]}" for key in state.state)
+    document = state.json(exclude={"state"})
+    payload = zlib.compress(f'{document[:-1]}, "state": {{{months}}}}}'.encode(), 1)
+
+    return HEADER.pack(MAGIC, FORMAT_VERSION, len(payload), zlib.crc32(payload)) + payload
+
+
+def decode_snapshot(data: bytes) -> ApplicationState:
+    if len(data) < HEADER.size or not is_snapshot(data):
+        raise SnapshotError("Not a snapshot")
+
+    _, version, length, checksum = HEADER.unpack_from(data)
+    if version != FORMAT_VERSION:
+        raise SnapshotError(f"Unsupported snapshot version: {version}")
+
+    payload = data[HEADER.size:]
+    if len(payload) != length or zlib.crc32(payload) != checksum:
+        raise SnapshotError("Snapshot is corrupted")
+
+    document = json.loads(zlib.decompress(payload))
+    defaults = document["defaults"]
+    return ApplicationState.construct(
+        users=[User.construct(**user) for user in document["users"]],
+        last_accessed=datetime.fromisoformat(document["last_accessed"]),
+        defaults=StateDefaults.construct(
+            monthly_income=defaults["monthly_income"],
+            fixed_expenses=_decode_fixed_expenses(defaults["fixed_expenses"]),
+        ),
+        variable_categories=document["variable_categories"],
+        fixed_categories=document["fixed_categories"],
+        state={key: decode_month(month) for key, month in document["state"].items()},
+        version=document["version"],
+    )
+
+
+def encode_month(month: MonthlyState) -> str:
+    strings: dict[str, int] = {}
+    columns: dict[str, list] = {name: [] for name in TRANSACTION_COLUMNS}
+    for transaction in month.transactions:
+        columns["category"].append(strings.setdefault(transaction.category, len(strings)))
+        columns["amount"].append(transaction.amount)
+        columns["created_at"].append(transaction.created_at.isoformat())
+        columns["user"].append(strings.setdefault(transaction.user, len(strings)))
+        columns["title"].append(transaction.title)
+        columns["notes"].append(transaction.notes)
+
+    return json.dumps(
+        {
+            "monthly_income": month.monthly_income,
+            "fixed_expenses": [[e.category, e.amount] for e in month.fixed_expenses],
+            "strings": list(strings),
+            "transactions": columns,
+        },
+        separators=(",", ":"),
+    )
+
+
+def decode_month(data: dict) -> MonthlyState:
+    strings, columns = data["strings"], data["transactions"]
+    from_iso, construct = datetime.fromisoformat, Transaction.construct
+    transactions = [
+        construct(
+            category=strings[category],
+            amount=amount,
+            created_at=from_iso(created_at),
+            user=strings[user],
+            title=title,
+            notes=notes,
+        )
+        for category, amount, created_at, user, title, notes in zip(
+            *(columns[name] for name in TRANSACTION_COLUMNS)
+        )
+    ]
+
+    month = MonthlyState.construct(
+        monthly_income=data["monthly_income"],
+        fixed_expenses=_decode_fixed_expenses(data["fixed_expenses"]),
+        transactions=transactions,
+    )
+    # `construct` skips `__init__`, which is where the aggregates are built
+    month.rebuild_aggregates()
+    return month
+
+
+def _decode_fixed_expenses(expenses: list) -> list[FixedExpense]:
+    # months store pairs, the defaults (serialized as part of the document)
+    # store objects
+    return [
+        FixedExpense.construct(**e)
+        if isinstance(e, dict)
+        else FixedExpense.construct(category=e[0], amount=e[1])
+        for e in expenses
+    ]
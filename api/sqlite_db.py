@@ -0,0 +1,297 @@
+"""
+SQLite storage backend, selected with `DB_BACKEND=sqlite`.
+
+Users, defaults, months and transactions live in indexed tables.  Only the
+small, global parts of the state are loaded up front; months are loaded the
+first time they are used, and changes are written as individual rows rather
+than by rewriting everything.
+
+Run `python -m api.db --backend sqlite` (or `./x.py migrate`) to copy an
+existing JSON database into SQLite.
+"""
+import json
+import sqlite3
+import threading
+from concurrent.futures import Future
+from typing import Any, Iterable, Optional
+
+from api import config
+from api.db import (
+    PersistenceWriter,
+    default_state,
+    file_sizes,
+    resolved_future,
+    serialize_state,
+)
+from api.domain import ApplicationState, MonthlyState, Transaction, User
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    email TEXT NOT NULL,
+    password_hash TEXT,
+    household TEXT,
+    household_invite TEXT
+);
+CREATE INDEX IF NOT EXISTS users_email ON users (email);
+CREATE TABLE IF NOT EXISTS months (
+    key TEXT PRIMARY KEY,
+    monthly_income INTEGER NOT NULL,
+    fixed_expenses TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS transactions (
+    id INTEGER PRIMARY KEY,
+    month_key TEXT NOT NULL REFERENCES months (key),
+    category TEXT NOT NULL,
+    amount INTEGER NOT NULL,
+    created_at TEXT NOT NULL,
+    user TEXT NOT NULL,
+    title TEXT,
+    notes TEXT
+);
+CREATE INDEX IF NOT EXISTS transactions_month ON transactions (month_key);
+CREATE INDEX IF NOT EXISTS transactions_category ON transactions (month_key, category);
+CREATE INDEX IF NOT EXISTS transactions_created_at ON transactions (created_at);
+"""
+
+# columns added since the first version of the schema, and their types
+ADDED_USER_COLUMNS = {"household": "TEXT", "household_invite": "TEXT"}
+
+# parts of the state that are stored as JSON values in the meta table
+META_KEYS = ["last_accessed", "defaults", "variable_categories", "fixed_categories", "version"]
+
+
+class SqliteBackend:
+    def __init__(self, path: str):
+        self.path = path
+        self.fsync = config.DB_DURABILITY == "fsync"
+
+        # reads happen on whichever thread needs a month, writes only on the
+        # writer thread; WAL mode lets them proceed concurrently
+        self._read_conn = self._connect()
+        self._read_lock = threading.Lock()
+        self._write_conn = self._connect()
+        with self._write_conn:
+            self._write_conn.executescript(SCHEMA)
+            columns = {row[1] for row in self._write_conn.execute("PRAGMA table_info(users)")}
+            for name, type in ADDED_USER_COLUMNS.items():
+                if name not in columns:
+                    self._write_conn.execute(f"ALTER TABLE users ADD COLUMN {name} {type}")
+            if not self._write_conn.execute("SELECT 1 FROM meta").fetchone():
+                self._replace_all(default_state)
+
+        # items of batches whose write failed, written again ahead of the
+        # next batch
+        self._failed: list[tuple[str, Any]] = []
+        self._failed_lock = threading.Lock()
+        self._writer = PersistenceWriter(self._write, config.DB_FLUSH_INTERVAL)
+
+    def load(self) -> ApplicationState:
+        with self._read_lock:
+            meta = dict(self._read_conn.execute("SELECT key, value FROM meta"))
+            users = self._read_conn.execute(
+                "SELECT name, email, password_hash, household, household_invite "
+                "FROM users ORDER BY id"
+            ).fetchall()
+
+        db = ApplicationState(
+            users=[
+                User(
+                    name=name,
+                    email=email,
+                    password_hash=pw,
+                    household=household,
+                    household_invite=invite,
+                )
+                for name, email, pw, household, invite in users
+            ],
+            state={},
+            **{key: json.loads(meta[key]) for key in META_KEYS if key in meta},
+        )
+        db.set_month_loader(self.load_month, self.month_keys, config.DB_MONTH_CACHE_SIZE)
+
+        return db
+
+    def load_month(self, key: str) -> Optional[MonthlyState]:
+        # an evicted month may still have writes in flight
+        if not self._writer.is_idle:
+            self._writer.flush().result()
+
+        with self._read_lock:
+            month = self._read_conn.execute(
+                "SELECT monthly_income, fixed_expenses FROM months WHERE key = ?", (key,)
+            ).fetchone()
+            if not month:
+                return None
+
+            transactions = self._read_conn.execute(
+                "SELECT category, amount, created_at, user, title, notes "
+                "FROM transactions WHERE month_key = ? ORDER BY id",
+                (key,),
+            ).fetchall()
+
+        return MonthlyState(
+            monthly_income=month[0],
+            fixed_expenses=json.loads(month[1]),
+            transactions=[
+                Transaction(
+                    category=category,
+                    amount=amount,
+                    created_at=created_at,
+                    user=user,
+                    title=title,
+                    notes=notes,
+                )
+                for category, amount, created_at, user, title, notes in transactions
+            ],
+        )
+
+    def month_keys(self) -> Iterable[str]:
+        with self._read_lock:
+            rows = self._read_conn.execute("SELECT key FROM months ORDER BY rowid").fetchall()
+
+        return [key for key, in rows]
+
+    def save(self, state: ApplicationState) -> Future:
+        state.load_all_months()
+        document = serialize_state(state)
+        state.pop_changes()
+        state.mark_clean()
+
+        return self._writer.submit(("document", document))
+
+    def persist(self, db: ApplicationState) -> Future:
+        changes = db.pop_changes()
+        db.mark_clean()
+        if not changes:
+            # gives a failed write another try
+            return self._writer.flush() if self.has_failed_changes else resolved_future()
+
+        return self._writer.submit(("records", changes))
+
+    def flush(self) -> Future:
+        return self._writer.flush()
+
+    @property
+    def has_failed_changes(self) -> bool:
+        with self._failed_lock:
+            return bool(self._failed)
+
+    def close(self):
+        self._writer.close()
+        self._read_conn.close()
+        self._write_conn.close()
+
+    def disk_usage(self) -> int:
+        return file_sizes([self.path, f"{self.path}-wal"])
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute(f"PRAGMA synchronous = {'FULL' if self.fsync else 'NORMAL'}")
+        return conn
+
+    def _write(self, batch: list[tuple[str, Any]]):
+        with self._failed_lock:
+            batch, self._failed = self._failed + batch, []
+
+        # the whole batch is one transaction, and therefore one fsync; if it
+        # fails, none of it is written and all of it is tried again
+        try:
+            with self._write_conn:
+                for kind, payload in batch:
+                    if kind == "document":
+                        self._replace_all(json.loads(payload))
+                    else:
+                        for record in payload:
+                            self._apply_record(json.loads(record))
+        except Exception:
+            with self._failed_lock:
+                self._failed = batch
+            raise
+
+    def _replace_all(self, document: dict):
+        conn = self._write_conn
+        for table in ["meta", "users", "months", "transactions"]:
+            conn.execute(f"DELETE FROM {table}")
+
+        conn.executemany(
+            "INSERT INTO meta (key, value) VALUES (?, ?)",
+            [(key, json.dumps(document.get(key, 0))) for key in META_KEYS],
+        )
+        for user in document["users"]:
+            self._insert_user(user)
+        for key, month in document["state"].items():
+            self._insert_month(key, month)
+
+    def _apply_record(self, record: dict):
+        op = record["op"]
+        if op == "add_user":
+            self._insert_user(record["user"])
+        elif op == "set_password_hash":
+            self._write_conn.execute(
+                "UPDATE users SET password_hash = ? WHERE email = ?",
+                (record["password_hash"], record["email"]),
+            )
+        elif op in ("set_household", "set_household_invite"):
+            column = op.removeprefix("set_")
+            self._write_conn.execute(
+                f"UPDATE users SET {column} = ? WHERE email = ?",
+                (record["household"], record["email"]),
+            )
+        elif op == "add_month":
+            self._write_conn.execute(
+                "DELETE FROM transactions WHERE month_key = ?", (record["key"],)
+            )
+            self._insert_month(record["key"], record["month"])
+        elif op == "add_transaction":
+            self._insert_transaction(record["key"], record["transaction"])
+        else:
+            raise ValueError(f"Unknown log record: {op}")
+
+        self._write_conn.execute(
+            "UPDATE meta SET value = ? WHERE key = 'version'", (json.dumps(record["version"]),)
+        )
+
+    def _insert_user(self, user: dict):
+        self._write_conn.execute(
+            "INSERT INTO users (name, email, password_hash, household, household_invite) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (
+                user["name"],
+                user["email"],
+                user.get("password_hash"),
+                user.get("household"),
+                user.get("household_invite"),
+            ),
+        )
+
+    def _insert_month(self, key: str, month: dict):
+        self._write_conn.execute(
+            "INSERT OR REPLACE INTO months (key, monthly_income, fixed_expenses) "
+            "VALUES (?, ?, ?)",
+            (key, month["monthly_income"], json.dumps(month["fixed_expenses"])),
+        )
+        for transaction in month["transactions"]:
+            self._insert_transaction(key, transaction)
+
+    def _insert_transaction(self, key: str, transaction: dict):
+        self._write_conn.execute(
+            "INSERT INTO transactions "
+            "(month_key, category, amount, created_at, user, title, notes) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                key,
+                transaction["category"],
+                transaction["amount"],
+                transaction["created_at"],
+                transaction["user"],
+                transaction.get("title"),
+                transaction.get("notes"),
+            ),
+        )
@@ -15,3 +15,10 @@ def reset_database_after_tests():
     yield
     # when tests are done, remove the database so each test run starts with a new state
     reset_db()
+
+
+@pytest.fixture
+def clean_db():
+    reset_db()
+    yield
+    reset_db()
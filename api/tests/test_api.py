@@ -2,13 +2,16 @@ import json
 import os
 
 import pytest
-from api.auth import AuthProvider
+from api import config, metrics
+from api.auth import AuthProvider, hashing_pool
+from api.config import DB_PATH
 from api.db import (
     get_db_instance,
     get_user_with_email,
     save_state_to_file,
     _delete_db_singleton,
 )
+from api.households import get_household_db
 from api.main import app
 from api.domain import ApplicationState
 from fastapi import status
@@ -109,10 +112,370 @@ def test_get_summary(auth_token):
         with open(
             os.path.join(test_dir, "fixtures", "report_snapshot.json")
         ) as response_file:
-            user, token = auth_token
+            # tokens are only valid for users in the database, and the
+            # fixture replaced it
+            token = AuthProvider(db).create_jwt_for_user(db.users[0])
             response = client.get("/months/current", cookies={"auth_token": token})
 
 
             assert response.status_code == status.HTTP_200_OK
             expected_response = json.loads(response_file.read())
             assert response.json() == expected_response
+
+
+def test_read_only_requests_do_not_write_state(auth_token):
+    user, token = auth_token
+    # the first report of a month creates (and saves) the month itself
+    client.get("/months/current", cookies={"auth_token": token})
+    mtime = os.stat(DB_PATH).st_mtime_ns
+
+    for path in ["/accounts/me", "/months/current", "/variable_categories"]:
+        response = client.get(path, cookies={"auth_token": token})
+        assert response.status_code == status.HTTP_200_OK
+
+    assert os.stat(DB_PATH).st_mtime_ns == mtime
+
+
+def test_get_summary_is_cached_until_month_changes(auth_token):
+    user, token = auth_token
+    cookies = {"auth_token": token}
+
+    response = client.get("/months/current", cookies=cookies)
+    etag = response.headers["ETag"]
+    assert etag
+
+    response = client.get("/months/current", cookies=cookies, headers={"If-None-Match": etag})
+    assert response.status_code == status.HTTP_304_NOT_MODIFIED
+    assert response.content == b""
+
+    body = {"category": "Gas", "amount": 100}
+    client.post("/transactions", cookies=cookies, json=body)
+
+    response = client.get("/months/current", cookies=cookies, headers={"If-None-Match": etag})
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["ETag"] != etag
+    assert response.json()["categories"]["Gas"]["total"] >= 100
+
+
+def test_login_returns_503_when_hashing_pool_is_full(monkeypatch):
+    util_create_user(name="Busy", email="busy@example.com", password="1234")
+    monkeypatch.setattr(hashing_pool, "max_pending", 0)
+
+    response = client.post(
+        "/accounts/login", json={"email": "busy@example.com", "password": "1234"}
+    )
+    assert response.status_code == status.HTTP_503_SERVICE_UNAVAILABLE
+    assert response.headers["Retry-After"] == "1"
+
+
+def test_accounts_create_rejects_duplicate_email():
+    body = {"name": "dup", "email": "dup@example.com", "password": "1234"}
+    assert client.post("/accounts/create", json=body).status_code == status.HTTP_201_CREATED
+
+    body["email"] = "Dup@Example.com"
+    response = client.post("/accounts/create", json=body)
+    assert response.status_code == status.HTTP_409_CONFLICT
+    assert len([u for u in get_db_instance().users if u.email.lower() == "dup@example.com"]) == 1
+
+
+def test_batch_transactions_reports_invalid_rows(auth_token):
+    user, token = auth_token
+    rows = [
+        {"category": "Gas", "amount": 100, "created_at": "2021-03-04T10:00:00"},
+        {"category": "Not a category", "amount": 100},
+        {"category": "Mortgage", "amount": "lots"},
+        {"category": "Grocery", "amount": 250, "title": "Market"},
+    ]
+    response = client.post("/transactions/batch", cookies={"auth_token": token}, json=rows)
+
+    assert response.status_code == status.HTTP_201_CREATED
+    report = response.json()
+    assert report["imported"] == 2
+    assert [error["row"] for error in report["errors"]] == [2, 3]
+
+    db = get_db_instance()
+    assert db.get_month("03/21").transactions[-1].user == user.email
+    assert db.get_current_state().transactions[-1].title == "Market"
+
+
+def test_import_transactions_from_csv(auth_token):
+    user, token = auth_token
+    before = len(get_db_instance().get_current_state().transactions)
+    body = (
+        "category,amount,title,notes\n"
+        'Gas,1200,Fill up,"two\nlines"\n'
+        "Grocery,oops,,\n"
+        "Utilities,4000,,\n"
+    )
+    response = client.post(
+        "/transactions/import",
+        cookies={"auth_token": token},
+        headers={"Content-Type": "text/csv"},
+        data=body.encode(),
+    )
+
+    assert response.status_code == status.HTTP_201_CREATED
+    assert response.json()["imported"] == 2
+    assert [error["row"] for error in response.json()["errors"]] == [2]
+
+    transactions = get_db_instance().get_current_state().transactions
+    assert len(transactions) == before + 2
+    assert transactions[-2].notes == "two\nlines"
+
+
+def test_import_transactions_rejects_upload_without_valid_rows(auth_token):
+    user, token = auth_token
+    response = client.post(
+        "/transactions/import?format=ndjson",
+        cookies={"auth_token": token},
+        data=b'{"category": "Gas"}\nnot json\n',
+    )
+
+    assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+    assert response.json()["imported"] == 0
+    assert len(response.json()["errors"]) == 2
+
+
+def test_export_transactions(auth_token):
+    user, token = auth_token
+    rows = [{"category": "Gas", "amount": 700, "created_at": "2019-02-03T10:00:00"}]
+    client.post("/transactions/batch", cookies={"auth_token": token}, json=rows)
+
+    response = client.get(
+        "/transactions/export?from=2019-02-01&to=2019-02-28&format=ndjson",
+        cookies={"auth_token": token},
+    )
+
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["Content-Type"] == "application/x-ndjson"
+    assert [json.loads(line)["amount"] for line in response.text.splitlines()] == [700]
+
+
+def test_range_report_is_recomputed_only_for_changed_months(auth_token):
+    user, token = auth_token
+    cookies = {"auth_token": token}
+    rows = [
+        {"category": "Gas", "amount": 100, "created_at": "2017-03-01T10:00:00"},
+        {"category": "Gas", "amount": 300, "created_at": "2018-03-01T10:00:00"},
+    ]
+    client.post("/transactions/batch", cookies=cookies, json=rows)
+
+    response = client.get("/reports/range?from=01/18&to=03/18", cookies=cookies)
+    assert response.status_code == status.HTTP_200_OK
+    march = response.json()["months"][-1]
+    assert march["month"] == "03/18"
+    assert march["vs_previous_year"]["categories"]["Gas"] == 200
+
+    db = get_db_instance()
+    cached = db._month_totals["03/17"]
+    rows = [{"category": "Gas", "amount": 50, "created_at": "2018-03-02T10:00:00"}]
+    client.post("/transactions/batch", cookies=cookies, json=rows)
+
+    response = client.get("/reports/range?from=01/18&to=03/18", cookies=cookies)
+    assert response.json()["months"][-1]["vs_previous_year"]["categories"]["Gas"] == 250
+    assert db._month_totals["03/17"] is cached
+
+
+def test_range_report_rejects_invalid_months(auth_token):
+    user, token = auth_token
+    for query in ["from=2022-01&to=03/22", "from=04/22&to=03/22"]:
+        response = client.get(f"/reports/range?{query}", cookies={"auth_token": token})
+        assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+
+
+def test_list_transactions(auth_token):
+    user, token = auth_token
+    cookies = {"auth_token": token}
+    rows = [
+        {"category": "Gas", "amount": amount, "created_at": f"2016-07-0{day}T10:00:00"}
+        for day, amount in [(1, 10), (2, 20), (3, 30)]
+    ]
+    client.post("/transactions/batch", cookies=cookies, json=rows)
+
+    response = client.get("/transactions?month=07/16&limit=2", cookies=cookies)
+    assert response.status_code == status.HTTP_200_OK
+    page = response.json()
+    assert [t["amount"] for t in page["transactions"]] == [30, 20]
+
+    response = client.get(
+        "/transactions", params={"month": "07/16", "cursor": page["next_cursor"]}, cookies=cookies
+    )
+    assert [t["amount"] for t in response.json()["transactions"]] == [10]
+    assert response.json()["next_cursor"] is None
+
+    response = client.get("/transactions?cursor=nope", cookies=cookies)
+    assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+
+
+def test_get_summary_totals_only(auth_token):
+    user, token = auth_token
+    cookies = {"auth_token": token}
+    client.post("/transactions", cookies=cookies, json={"category": "Gas", "amount": 100})
+
+    full = client.get("/months/current", cookies=cookies)
+    totals = client.get("/months/current?totals_only=true", cookies=cookies)
+
+    assert full.json()["categories"]["Gas"]["transactions"]
+    assert "transactions" not in totals.json()["categories"]["Gas"]
+    assert totals.json()["categories"]["Gas"]["total"] == full.json()["categories"]["Gas"]["total"]
+    assert totals.headers["ETag"] != full.headers["ETag"]
+
+
+def test_metrics_endpoint(auth_token, monkeypatch):
+    user, token = auth_token
+    monkeypatch.setattr(config, "ADMIN_EMAILS", {"foo@bar.com"})
+    before = metrics.REQUEST_SECONDS.count(
+        method="GET", route="/months/current", status="200"
+    )
+    client.get("/months/current", cookies={"auth_token": token})
+
+    response = client.get("/_internal/metrics", cookies={"auth_token": token})
+
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["Content-Type"].startswith("text/plain")
+    assert (
+        metrics.REQUEST_SECONDS.count(method="GET", route="/months/current", status="200")
+        == before + 1
+    )
+    assert "# TYPE http_request_duration_seconds histogram" in response.text
+    assert "db_transactions_in_memory " in response.text
+    assert 'cache_requests_total{cache="token",result=' in response.text
+
+
+def test_metrics_endpoint_needs_an_admin_or_the_token(auth_token, monkeypatch):
+    user, token = auth_token
+    monkeypatch.setattr(config, "METRICS_TOKEN", "scrape")
+
+    assert client.get("/_internal/metrics").status_code == 401
+    assert client.get("/_internal/metrics", cookies={"auth_token": token}).status_code == 403
+    wrong = client.get("/_internal/metrics", headers={"Authorization": "Bearer guess"})
+    assert wrong.status_code == 401
+
+    response = client.get("/_internal/metrics", headers={"Authorization": "Bearer scrape"})
+    assert response.status_code == 200
+
+
+@pytest.fixture
+def profiling_enabled(monkeypatch, tmp_path):
+    monkeypatch.setattr(config, "PROFILING", True)
+    monkeypatch.setattr(config, "PROFILE_DIR", str(tmp_path))
+    monkeypatch.setattr(config, "ADMIN_EMAILS", {"foo@bar.com"})
+
+
+def test_profiling_admin_request(auth_token, profiling_enabled):
+    user, token = auth_token
+    cookies = {"auth_token": token}
+
+    response = client.get("/months/current", cookies=cookies, headers={"X-Profile": "1"})
+    profile_id = response.headers["X-Profile-Id"]
+    assert "-get-months-current-" in profile_id
+
+    profiles = client.get("/_internal/profiles", cookies=cookies).json()
+    assert [profile["id"] for profile in profiles] == [profile_id]
+
+    download = client.get(f"/_internal/profiles/{profile_id}", cookies=cookies)
+    assert download.status_code == status.HTTP_200_OK
+    text = client.get(f"/_internal/profiles/{profile_id}?format=text", cookies=cookies)
+    assert "cumulative" in text.text
+
+    missing = client.get("/_internal/profiles/..%2Fdb.json", cookies=cookies)
+    assert missing.status_code == status.HTTP_404_NOT_FOUND
+
+
+def test_profiling_is_admin_only(auth_token, profiling_enabled, monkeypatch):
+    user, token = auth_token
+    cookies = {"auth_token": token}
+    monkeypatch.setattr(config, "ADMIN_EMAILS", set())
+
+    response = client.get("/months/current", cookies=cookies, headers={"X-Profile": "1"})
+
+    assert "X-Profile-Id" not in response.headers
+    assert client.get("/_internal/profiles", cookies=cookies).status_code == 403
+
+
+def test_profiling_needs_the_header_to_be_1(auth_token, profiling_enabled):
+    user, token = auth_token
+    cookies = {"auth_token": token}
+
+    for value in ["0", "false"]:
+        response = client.get("/months/current", cookies=cookies, headers={"X-Profile": value})
+        assert "X-Profile-Id" not in response.headers
+
+
+def test_profiling_disabled(auth_token, profiling_enabled, monkeypatch):
+    user, token = auth_token
+    monkeypatch.setattr(config, "PROFILING", False)
+
+    response = client.get(
+        "/months/current", cookies={"auth_token": token}, headers={"X-Profile": "1"}
+    )
+
+    assert "X-Profile-Id" not in response.headers
+
+
+def test_households_have_their_own_transactions(auth_token):
+    user, token = auth_token
+    spouse = util_create_user(name="Baz", email="baz@bar.com", password="1234")
+    spouse_token = AuthProvider(get_db_instance()).create_jwt_for_user(spouse)
+    cookies, spouse_cookies = {"auth_token": token}, {"auth_token": spouse_token}
+
+    response = client.post("/households", cookies=cookies)
+    assert response.status_code == status.HTTP_201_CREATED
+    household = response.json()
+    assert household["members"] == ["foo@bar.com"]
+
+    client.post("/transactions", cookies=cookies, json={"category": "Gas", "amount": 4321})
+
+    def gas_total(cookies):
+        report = client.get("/months/current?totals_only=true", cookies=cookies).json()
+        return report["categories"].get("Gas", {}).get("total", 0)
+
+    assert gas_total(cookies) == 4321
+    assert gas_total(spouse_cookies) != 4321
+    assert client.get("/households/current", cookies=spouse_cookies).status_code == 404
+
+    response = client.post(
+        "/households/current/members", cookies=cookies, json={"email": "Baz@bar.com"}
+    )
+    assert response.json()["invited"] == ["baz@bar.com"]
+    # nothing changes until the invite is accepted
+    assert gas_total(spouse_cookies) != 4321
+
+    response = client.post(f"/households/{household['id']}/join", cookies=spouse_cookies)
+    assert response.json()["members"] == ["foo@bar.com", "baz@bar.com"]
+    assert response.json()["invited"] == []
+    assert gas_total(spouse_cookies) == 4321
+    assert client.get("/households/current", cookies=spouse_cookies).json() == response.json()
+
+    response = client.post("/households/current/leave", cookies=spouse_cookies)
+    assert response.status_code == status.HTTP_204_NO_CONTENT
+    assert gas_total(spouse_cookies) != 4321
+    assert client.get("/households/current", cookies=spouse_cookies).status_code == 404
+
+
+def test_users_cannot_be_pulled_into_a_household(auth_token):
+    user, token = auth_token
+    other = util_create_user(name="Baz", email="baz@bar.com", password="1234")
+    other_cookies = {"auth_token": AuthProvider(get_db_instance()).create_jwt_for_user(other)}
+    cookies = {"auth_token": token}
+    household = client.post("/households", cookies=cookies).json()
+
+    # neither joining without an invite, e.g. with a guessed id...
+    response = client.post(f"/households/{household['id']}/join", cookies=other_cookies)
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+    # ...nor inviting moves anybody
+    client.post("/households/current/members", cookies=cookies, json={"email": "baz@bar.com"})
+
+    assert get_user_with_email(get_db_instance(), "baz@bar.com").household is None
+    members = client.get("/households/current", cookies=cookies).json()["members"]
+    assert members == ["foo@bar.com"]
+
+
+def test_variable_categories_are_the_households(auth_token):
+    user, token = auth_token
+    cookies = {"auth_token": token}
+    household = client.post("/households", cookies=cookies).json()
+    get_household_db(household["id"]).variable_categories = ["Diapers"]
+
+    response = client.get("/variable_categories", cookies=cookies)
+    assert response.json() == ["Diapers"]
@@ -1,9 +1,15 @@
-from types import SimpleNamespace
+import asyncio
+import time
+from datetime import datetime
 from unittest.mock import patch
 
 import bcrypt
-from api.auth import AuthProvider
-from api.domain import User
+import jwt
+import pytest
+from api import config, mutations
+from api.auth import AuthProvider, HashingPool, HashingPoolFull, TokenCache, get_hash_rounds
+from api.db import _delete_db_singleton, get_db_instance
+from api.domain import ApplicationState, User
 
 
 def test_can_create_and_validate_jwt():
@@ -19,10 +25,115 @@ def test_given_invalid_token_validate_returns_none():
     assert auth.validate_token("blah") is None
 
 
+def make_db(users: list[User]) -> ApplicationState:
+    return ApplicationState(
+        users=users,
+        last_accessed=datetime.now(),
+        defaults={"monthly_income": 0, "fixed_expenses": []},
+        variable_categories=[],
+        fixed_categories=[],
+        state={},
+    )
+
+
 def test_given_user_in_db_can_sign_in_with_email_and_password():
     passwd_hash = bcrypt.hashpw("asdf".encode(), bcrypt.gensalt())
     user = User(name="Eyore", email="eyore@example.com", password_hash=passwd_hash)
-    auth = AuthProvider(db=SimpleNamespace(users=[user]))
+    auth = AuthProvider(db=make_db([user]))
 
     user = auth.check_password("eyore@example.com", "1234")
     assert user == user
+
+
+def test_validated_tokens_are_cached():
+    auth = AuthProvider(None)
+    token = auth.create_jwt_for_user(User(name="Cached", email="cached@example.com"))
+
+    assert auth.validate_token(token).email == "cached@example.com"
+    with patch("jwt.decode") as decode:
+        assert auth.validate_token(token).email == "cached@example.com"
+        decode.assert_not_called()
+
+
+def test_expired_tokens_are_rejected():
+    token = jwt.encode(
+        {"name": "Old", "email": "old@example.com", "exp": int(time.time()) - 10},
+        config.AUTH_SECRET_KEY,
+        algorithm="HS256",
+    )
+    assert AuthProvider(None).validate_token(token) is None
+
+
+def test_tokens_without_expiry_are_rejected():
+    token = jwt.encode(
+        {"name": "Forever", "email": "forever@example.com"},
+        config.AUTH_SECRET_KEY,
+        algorithm="HS256",
+    )
+    assert AuthProvider(None).validate_token(token) is None
+
+
+def test_token_cache_evicts_expired_and_least_recently_used():
+    cache = TokenCache(max_size=2)
+    user = User(name="A", email="a@example.com")
+
+    cache.put("expired", user, time.time() - 1)
+    assert cache.get("expired") is None
+
+    cache.put("a", user, time.time() + 60)
+    cache.put("b", user, time.time() + 60)
+    cache.get("a")
+    cache.put("c", user, time.time() + 60)
+    assert cache.get("b") is None
+    assert cache.get("a") == user
+    assert cache.get("c") == user
+
+
+def test_given_wrong_password_or_unknown_user_check_password_returns_none():
+    passwd_hash = bcrypt.hashpw("asdf".encode(), bcrypt.gensalt(4))
+    user = User(name="Eyore", email="eyore@example.com", password_hash=passwd_hash)
+    auth = AuthProvider(db=make_db([user]))
+
+    assert auth.check_password("eyore@example.com", "asdf") == user
+    assert auth.check_password("Eyore@Example.com", "asdf") == user
+    assert auth.check_password("eyore@example.com", "1234") is None
+    assert auth.check_password("piglet@example.com", "asdf") is None
+
+
+@pytest.mark.usefixtures("clean_db")
+def test_login_rehashes_password_when_cost_changes():
+    passwd_hash = bcrypt.hashpw("asdf".encode(), bcrypt.gensalt(5)).decode()
+    db = get_db_instance()
+    db.add_user(User(name="Eyore", email="eyore@example.com", password_hash=passwd_hash))
+    auth = AuthProvider(db)
+
+    async def login(password):
+        try:
+            return await auth.login("eyore@example.com", password)
+        finally:
+            await mutations.close()
+
+    assert asyncio.run(login("wrong")) is None
+    assert db.get_user("eyore@example.com").password_hash == passwd_hash
+
+    assert asyncio.run(login("asdf")).email == "eyore@example.com"
+
+    # the new hash is written through the writer, so it is on disk as well
+    _delete_db_singleton()
+    password_hash = get_db_instance().get_user("eyore@example.com").password_hash
+    assert get_hash_rounds(password_hash) == config.AUTH_BCRYPT_ROUNDS
+    assert bcrypt.checkpw("asdf".encode(), password_hash.encode())
+
+
+def test_hashing_pool_rejects_calls_when_full():
+    pool = HashingPool(workers=1, max_pending=0)
+    with pytest.raises(HashingPoolFull):
+        asyncio.run(pool.run(bcrypt.gensalt))
+
+
+def test_tokens_of_users_no_longer_in_db_are_rejected():
+    user = User(name="Eyore", email="eyore@example.com")
+    token = AuthProvider(None).create_jwt_for_user(user)
+
+    assert AuthProvider(make_db([user])).validate_token(token).email == user.email
+    assert AuthProvider(make_db([])).validate_token(token) is None
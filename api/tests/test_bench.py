@@ -0,0 +1,57 @@
+import argparse
+import json
+from datetime import datetime
+
+import pytest
+from api.bench.generate import generate_state
+from api.bench.load import Sample, parse_mix, summarize
+from api.db import serialize_state
+from api.domain import ApplicationState
+
+
+def test_generate_state_is_valid_and_skewed():
+    end = datetime(2022, 6, 15)
+    state = generate_state(users=2, years=1, per_month=200, end=end)
+
+    # survives a round trip through validation
+    ApplicationState(**json.loads(serialize_state(state)))
+
+    months = [f"{m:02}/21" for m in range(7, 13)] + [f"{m:02}/22" for m in range(1, 7)]
+    assert list(state.state) == months
+    assert all(len(month.transactions) == 200 for month in state.state.values())
+    assert state.state["06/22"].latest_created_at <= end
+    assert {t.user for t in state.state["06/22"].transactions} == {u.email for u in state.users}
+
+    counts = {}
+    for month in state.state.values():
+        for t in month.transactions:
+            counts[t.category] = counts.get(t.category, 0) + 1
+    assert counts[state.variable_categories[0]] > 3 * counts[state.fixed_categories[-1]]
+
+
+def test_generate_state_is_deterministic():
+    end = datetime(2022, 6, 15)
+    first = generate_state(users=1, years=1, per_month=10, end=end)
+    second = generate_state(users=1, years=1, per_month=10, end=end)
+
+    assert first.state == second.state
+
+
+def test_load_results_are_summarized_per_operation():
+    samples = [Sample("post", i / 100, i != 3) for i in range(1, 101)] + [
+        Sample("report", 0.5, True)
+    ]
+
+    results = summarize(samples, duration=10)
+
+    assert results["post"]["requests"] == 100
+    assert results["post"]["errors"] == 1
+    assert results["post"]["p50"] == 0.5
+    assert results["post"]["p99"] == 0.99
+    assert results["total"]["throughput"] == 10.1
+
+
+def test_parse_mix():
+    assert parse_mix("post=5,report") == {"post": 5, "report": 1}
+    with pytest.raises(argparse.ArgumentTypeError):
+        parse_mix("delete=1")
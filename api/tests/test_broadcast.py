@@ -0,0 +1,168 @@
+import asyncio
+import json
+from datetime import datetime
+
+import pytest
+from api import config, mutations
+from api.auth import AuthProvider
+from api.broadcast import TooManySubscribers, broadcaster
+from api.db import get_db_instance
+from api.domain import Transaction
+from api.main import app
+
+from .utils import util_create_user
+
+pytestmark = pytest.mark.usefixtures("clean_db")
+
+
+def parse(event: str) -> tuple[str, dict]:
+    name, data = event.strip().split("\n")
+    return name.removeprefix("event: "), json.loads(data.removeprefix("data: "))
+
+
+async def add(category: str, amount: int):
+    transaction = Transaction(
+        category=category, amount=amount, created_at=datetime.now(), user="a@example.com"
+    )
+    await mutations.submit(lambda db: db.add_transaction(transaction))
+
+
+def test_stream_sends_snapshot_then_changed_categories():
+    async def run():
+        await add("Grocery", 500)
+        events = broadcaster.subscribe(None).events()
+        snapshot = parse(await events.__anext__())
+
+        await add("Gas", 100)
+        delta = parse(await events.__anext__())
+
+        # a client that falls behind gets the changes together
+        await add("Gas", 50)
+        await add("Utilities", 25)
+        coalesced = parse(await events.__anext__())
+
+        await events.aclose()
+        return snapshot, delta, coalesced
+
+    snapshot, delta, coalesced = asyncio.run(run())
+
+    assert snapshot[0] == "snapshot"
+    assert snapshot[1]["categories"] == {"Grocery": 500}
+    assert delta == (
+        "delta",
+        {"month": snapshot[1]["month"], "totals": delta[1]["totals"], "categories": {"Gas": 100}},
+    )
+    assert delta[1]["totals"]["spent"] == 600
+    assert coalesced[1]["categories"] == {"Gas": 150, "Utilities": 25}
+    assert coalesced[1]["totals"]["spent"] == 675
+    assert broadcaster.subscriber_count == 0
+
+
+def test_stream_keeps_idle_connections_alive(monkeypatch):
+    monkeypatch.setattr(config, "STREAM_KEEPALIVE_SECONDS", 0.01)
+
+    async def run():
+        events = broadcaster.subscribe(None).events()
+        await events.__anext__()
+        keepalive = await events.__anext__()
+        await events.aclose()
+        return keepalive
+
+    assert asyncio.run(run()) == ": keepalive\n\n"
+
+
+def test_subscribers_take_a_slot_until_closed(monkeypatch):
+    monkeypatch.setattr(broadcaster, "max_subscribers", 1)
+
+    subscription = broadcaster.subscribe(None)
+    with pytest.raises(TooManySubscribers):
+        broadcaster.subscribe(None)
+
+    subscription.close()
+    subscription.close()
+    assert broadcaster.subscriber_count == 0
+    broadcaster.subscribe(None).close()
+
+
+class StreamRequest:
+    """
+    Calls the app directly, since the test client waits for the whole
+    response, which a stream never finishes.
+    """
+
+    def __init__(self, token: str):
+        self.messages: asyncio.Queue = asyncio.Queue()
+        self.disconnected = asyncio.Event()
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": "GET",
+            "scheme": "http",
+            "path": "/months/current/stream",
+            "raw_path": b"/months/current/stream",
+            "query_string": b"",
+            "root_path": "",
+            "headers": [(b"host", b"testserver"), (b"cookie", f"auth_token={token}".encode())],
+            "client": ("testclient", 50000),
+            "server": ("testserver", 80),
+        }
+        self.task = asyncio.create_task(app(scope, self.receive, self.messages.put))
+
+    async def receive(self):
+        await self.disconnected.wait()
+        return {"type": "http.disconnect"}
+
+    async def status(self) -> int:
+        return (await self.messages.get())["status"]
+
+    async def body(self) -> str:
+        return (await self.messages.get())["body"].decode()
+
+    async def disconnect(self):
+        self.disconnected.set()
+        await self.task
+
+
+def make_token() -> str:
+    user = util_create_user(name="Foo", email="foo@bar.com", password="1234")
+    return AuthProvider(get_db_instance()).create_jwt_for_user(user)
+
+
+def test_stream_endpoint_sends_events_until_the_client_goes_away():
+    token = make_token()
+
+    async def run():
+        request = StreamRequest(token)
+        status = await request.status()
+        snapshot = parse(await request.body())
+        await add("Gas", 100)
+        delta = parse(await request.body())
+        await request.disconnect()
+        return status, snapshot, delta
+
+    status, snapshot, delta = asyncio.run(run())
+
+    assert status == 200
+    assert snapshot[0] == "snapshot"
+    assert delta[0] == "delta"
+    assert delta[1]["categories"] == {"Gas": 100}
+    assert broadcaster.subscriber_count == 0
+
+
+def test_stream_endpoint_turns_away_clients_beyond_the_limit(monkeypatch):
+    monkeypatch.setattr(broadcaster, "max_subscribers", 2)
+    token = make_token()
+
+    async def run():
+        # all at once, before any of them has started streaming
+        requests = [StreamRequest(token) for _ in range(3)]
+        statuses = [await request.status() for request in requests]
+        for request in requests:
+            await request.disconnect()
+        return statuses
+
+    statuses = asyncio.run(run())
+
+    assert sorted(statuses) == [200, 200, 503]
+    assert broadcaster.subscriber_count == 0
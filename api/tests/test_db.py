@@ -1,16 +1,25 @@
 import json
 import os
-from datetime import datetime
+from datetime import date, datetime
 
 import pytest
-from api.config import BASE_DIR, DB_PATH
+from api import config
+from api.config import BASE_DIR, DB_LOG_PATH, DB_PATH
 from api.db import (
+    default_state,
     ensure_exists,
     get_db_instance,
     save_state_to_file,
     maybe_rollover_month,
+    persist_changes,
+    JsonBackend,
+    PersistenceWriter,
+    serialize_state,
+    get_user_with_email,
+    list_transactions,
+    _delete_db_singleton,
 )
-from api.domain import ApplicationState, User
+from api.domain import ApplicationState, DuplicateUserError, MonthlyState, Transaction, User
 
 from .utils import reset_db
 
@@ -73,3 +82,325 @@ def test_rollsover_month_when_month_is_completed():
 
     maybe_rollover_month(db, lambda: now)
     assert db.state.get("07/22") == {**db.defaults.dict(), "transactions": []}
+
+
+def test_log_mode_appends_changes_and_replays_them(monkeypatch):
+    monkeypatch.setattr(config, "DB_MODE", "log")
+    reset_db()
+
+    db = get_db_instance()
+    db.add_user(User(name="Log", email="log@example.com", password_hash="asdf"))
+    db.add_transaction(
+        Transaction(category="Gas", amount=100, created_at=datetime(2022, 6, 2), user="log")
+    )
+    persist_changes(db).result()
+
+    with open(DB_LOG_PATH, "r") as log_file:
+        ops = [json.loads(line)["op"] for line in log_file]
+    assert ops == ["add_user", "add_month", "add_transaction"]
+
+    with open(DB_PATH, "r") as db_file:
+        assert json.loads(db_file.read())["users"] == []
+
+    _delete_db_singleton()
+    db = get_db_instance()
+    assert db.users[0].email == "log@example.com"
+    assert db.state["06/22"].transactions[0].amount == 100
+
+
+def test_log_mode_compacts_into_snapshot(monkeypatch):
+    monkeypatch.setattr(config, "DB_MODE", "log")
+    monkeypatch.setattr(config, "DB_COMPACT_THRESHOLD", 2)
+    reset_db()
+
+    db = get_db_instance()
+    db.add_user(User(name="A", email="a@example.com"))
+    persist_changes(db).result()
+    db.add_user(User(name="B", email="b@example.com"))
+    persist_changes(db).result()
+
+    assert os.stat(DB_LOG_PATH).st_size == 0
+    with open(DB_PATH, "r") as db_file:
+        assert len(json.loads(db_file.read())["users"]) == 2
+
+    _delete_db_singleton()
+    assert len(get_db_instance().users) == 2
+
+
+def test_replay_drops_torn_record(monkeypatch):
+    monkeypatch.setattr(config, "DB_MODE", "log")
+    reset_db()
+
+    db = get_db_instance()
+    db.add_user(User(name="A", email="a@example.com"))
+    persist_changes(db).result()
+    with open(DB_LOG_PATH, "a") as log_file:
+        log_file.write('{"op": "add_user", "vers')
+
+    _delete_db_singleton()
+    db = get_db_instance()
+    assert [user.email for user in db.users] == ["a@example.com"]
+
+    db.add_user(User(name="B", email="b@example.com"))
+    persist_changes(db).result()
+    _delete_db_singleton()
+    assert [user.email for user in get_db_instance().users] == ["a@example.com", "b@example.com"]
+
+
+def gas(amount: int) -> Transaction:
+    return Transaction(category="Gas", amount=amount, created_at=datetime(2022, 6, 2), user="a")
+
+
+def fail(*args):
+    raise OSError("No space left on device")
+
+
+def test_failed_write_is_retried_with_the_next_one(monkeypatch):
+    monkeypatch.setattr(config, "DB_MODE", "log")
+    reset_db()
+
+    db = get_db_instance()
+    db.add_transaction(gas(100))
+    with monkeypatch.context() as patch:
+        patch.setattr(JsonBackend, "_sync", fail)
+        with pytest.raises(OSError):
+            persist_changes(db).result()
+
+    db.add_transaction(gas(200))
+    persist_changes(db).result()
+
+    _delete_db_singleton()
+    assert [t.amount for t in get_db_instance().state["06/22"].transactions] == [100, 200]
+
+
+def test_failed_snapshot_is_retried_with_the_next_write(monkeypatch):
+    reset_db()
+
+    db = get_db_instance()
+    db.add_transaction(gas(100))
+    with monkeypatch.context() as patch:
+        patch.setattr("api.db.atomic_write", fail)
+        with pytest.raises(OSError):
+            persist_changes(db).result()
+
+    assert not db.is_dirty
+    persist_changes(db).result()
+
+    _delete_db_singleton()
+    assert [t.amount for t in get_db_instance().state["06/22"].transactions] == [100]
+
+
+def test_failed_compaction_is_retried_with_the_next_write(monkeypatch):
+    monkeypatch.setattr(config, "DB_MODE", "log")
+    monkeypatch.setattr(config, "DB_COMPACT_THRESHOLD", 3)
+    reset_db()
+
+    db = get_db_instance()
+    persist_changes(db).result()
+    db.add_transaction(gas(100))
+    persist_changes(db).result()
+
+    db.add_transaction(gas(200))
+    with monkeypatch.context() as patch:
+        patch.setattr("api.db.atomic_write", fail)
+        with pytest.raises(OSError):
+            persist_changes(db).result()
+
+    db.add_transaction(gas(300))
+    persist_changes(db).result()
+
+    _delete_db_singleton()
+    amounts = [t.amount for t in get_db_instance().state["06/22"].transactions]
+    assert amounts == [100, 200, 300]
+
+
+def test_serialize_state_matches_full_serialization():
+    db = get_db_instance()
+    db.add_transaction(
+        Transaction(category="Gas", amount=100, created_at=datetime(2022, 6, 2), user="a")
+    )
+    save_state_to_file(db)
+
+    db.add_transaction(
+        Transaction(category="Gas", amount=200, created_at=datetime(2022, 6, 3), user="a")
+    )
+    assert db.dirty_months == {"06/22"}
+    assert json.loads(serialize_state(db)) == json.loads(db.json())
+
+
+def test_persist_changes_skips_write_when_clean():
+    reset_db()
+    db = get_db_instance()
+    save_state_to_file(db)
+    mtime = os.stat(DB_PATH).st_mtime_ns
+
+    assert not db.is_dirty
+    persist_changes(db).result()
+    assert os.stat(DB_PATH).st_mtime_ns == mtime
+
+    db.add_user(User(name="A", email="a@example.com"))
+    assert db.is_dirty
+    persist_changes(db).result()
+    assert not db.is_dirty
+    with open(DB_PATH, "r") as db_file:
+        assert json.loads(db_file.read())["users"][0]["email"] == "a@example.com"
+
+
+def test_writer_coalesces_pending_writes():
+    batches = []
+    writer = PersistenceWriter(batches.append, flush_interval=0.05)
+
+    futures = [writer.submit(1), writer.submit(2), writer.submit(3)]
+    writer.flush().result()
+    writer.close()
+
+    assert all(future.done() for future in futures)
+    assert batches == [[1, 2, 3]]
+
+
+def test_json_backend_snapshot_supersedes_earlier_writes(tmp_path):
+    db_path, log_path = str(tmp_path / "db.json"), str(tmp_path / "db.json.log")
+    backend = JsonBackend(db_path, log_path)
+    backend._write([(None, ["1"]), ("{}", []), (None, ["2", "3"])])
+    backend.close()
+
+    with open(db_path, "r") as db_file:
+        assert db_file.read() == "{}"
+    with open(log_path, "r") as log_file:
+        assert log_file.read() == "2\n3\n"
+    assert not os.path.exists(f"{db_path}.tmp")
+
+
+def shared_backends(tmp_path, monkeypatch) -> tuple[JsonBackend, JsonBackend]:
+    monkeypatch.setattr(config, "DB_MULTIPROCESS", True)
+    monkeypatch.setattr(config, "DB_MODE", "log")
+    paths = [str(tmp_path / "db.json"), str(tmp_path / "db.json.log")]
+    return JsonBackend(*paths), JsonBackend(*paths)
+
+
+def test_refresh_reads_only_new_changes_of_other_processes(tmp_path, monkeypatch):
+    first, second = shared_backends(tmp_path, monkeypatch)
+    a, b = first.load(), second.load()
+
+    with first.lock:
+        a.add_transaction(gas(100))
+        first.persist(a).result()
+
+    assert second.refresh(b) is b
+    assert [t.amount for t in b.state["06/22"].transactions] == [100]
+    assert b.version == a.version
+    assert second.refresh(b) is b
+
+    first.close()
+    second.close()
+
+
+def test_refresh_keeps_pending_changes_after_changes_of_others(tmp_path, monkeypatch):
+    first, second = shared_backends(tmp_path, monkeypatch)
+    a, b = first.load(), second.load()
+    with first.lock:
+        a.add_transaction(gas(100))
+        first.persist(a).result()
+    # e.g. a month created by a report, not persisted yet
+    b.add_month("07/22", MonthlyState(monthly_income=1, fixed_expenses=[], transactions=[]))
+
+    with second.lock:
+        b = second.refresh(b)
+        second.persist(b).result()
+
+    records = [json.loads(line) for line in open(tmp_path / "db.json.log")]
+    assert [(r["op"], r["version"]) for r in records] == [
+        ("add_month", 1),
+        ("add_transaction", 2),
+        ("add_month", 3),
+    ]
+    assert second.refresh(b) is b
+    assert set(first.refresh(a).state) == {"06/22", "07/22"}
+
+    first.close()
+    second.close()
+
+
+def test_refresh_reloads_compacted_snapshot(tmp_path, monkeypatch):
+    first, second = shared_backends(tmp_path, monkeypatch)
+    a, b = first.load(), second.load()
+    with first.lock:
+        a.add_transaction(gas(100))
+        first.save(a).result()
+
+    refreshed = second.refresh(b)
+
+    assert refreshed is not b
+    assert [t.amount for t in refreshed.state["06/22"].transactions] == [100]
+
+    first.close()
+    second.close()
+
+
+def test_user_lookup_is_case_insensitive_and_unique():
+    db = get_db_instance()
+    db.add_user(User(name="Case", email="Case@Example.com"))
+
+    assert get_user_with_email(db, "case@example.com").name == "Case"
+    with pytest.raises(DuplicateUserError):
+        db.add_user(User(name="Other", email="case@example.COM "))
+
+    # the index notices users being replaced directly
+    db.users = [User(name="New", email="new@example.com")]
+    assert get_user_with_email(db, "case@example.com") is None
+    assert get_user_with_email(db, "NEW@example.com").name == "New"
+
+
+def listing_db() -> ApplicationState:
+    db = ApplicationState(**{**json.loads(json.dumps(default_state)), "state": {}})
+    # deliberately out of order, and spread over two months
+    for day, month, user in [(3, 5, "a"), (1, 5, "b"), (2, 6, "a"), (1, 6, "a"), (2, 5, "a")]:
+        db.add_transaction(
+            Transaction(
+                category="Gas" if day % 2 else "Grocery",
+                amount=day * 100 + month,
+                created_at=datetime(2022, month, day),
+                user=user,
+            )
+        )
+    return db
+
+
+def test_list_transactions_pages_newest_first():
+    db = listing_db()
+
+    amounts, cursor = [], None
+    while True:
+        page = list_transactions(db, cursor=cursor, limit=2)
+        amounts.append([t.amount for t in page.transactions])
+        cursor = page.next_cursor
+        if cursor is None:
+            break
+
+    assert amounts == [[206, 106], [305, 205], [105]]
+
+
+def test_list_transactions_filters():
+    db = listing_db()
+
+    def amounts(**filters):
+        return [t.amount for t in list_transactions(db, **filters).transactions]
+
+    assert amounts(month="05/22") == [305, 205, 105]
+    assert amounts(category="Gas", user="a") == [106, 305]
+    assert amounts(start=date(2022, 5, 2), end=date(2022, 6, 1)) == [106, 305, 205]
+
+
+def test_list_transactions_cursor_is_stable_across_new_transactions():
+    db = listing_db()
+    page = list_transactions(db, limit=2)
+
+    db.add_transaction(
+        Transaction(category="Gas", amount=1, created_at=datetime(2022, 6, 5), user="a")
+    )
+
+    page = list_transactions(db, cursor=page.next_cursor, limit=2)
+    assert [t.amount for t in page.transactions] == [305, 205]
+
+    with pytest.raises(ValueError):
+        list_transactions(db, cursor="garbage")
@@ -0,0 +1,232 @@
+import gc
+import json
+import os
+from datetime import datetime
+
+import pytest
+from api.db import default_state
+from api.domain import (
+    ApplicationState,
+    MonthlyState,
+    SpendingTotals,
+    Transaction,
+    get_monthly_report,
+    get_range_report,
+    month_keys_between,
+)
+
+
+@pytest.fixture
+def db():
+    fixture = os.path.join(os.path.dirname(__file__), "fixtures", "test_db_state.json")
+    with open(fixture, "r") as fixture_file:
+        return ApplicationState(**json.loads(fixture_file.read()))
+
+
+def transaction(category: str, amount: int, day: int) -> Transaction:
+    return Transaction(
+        category=category, amount=amount, created_at=datetime(2022, 6, day), user="a"
+    )
+
+
+def test_monthly_report_matches_snapshot(db):
+    snapshot = os.path.join(os.path.dirname(__file__), "fixtures", "report_snapshot.json")
+    with open(snapshot, "r") as snapshot_file:
+        expected = json.loads(snapshot_file.read())
+
+    report = get_monthly_report(db, db.state["06/22"], datetime(2022, 6, 20))
+    actual = json.loads(report.json())
+    del actual["totals"]["unallocated"]
+
+    assert actual == expected
+
+
+def test_aggregates_are_maintained_on_append():
+    state = MonthlyState(monthly_income=100, fixed_expenses=[], transactions=[])
+    state.add_transaction(transaction("Gas", 10, 1))
+    state.add_transaction(transaction("Grocery", 20, 1))
+    state.add_transaction(transaction("Gas", 5, 3))
+
+    assert state.total_spent == 35
+    assert state.category_totals == {"Gas": 15, "Grocery": 20}
+    assert state.category_count("Gas") == 2
+    assert state.category_day_totals("Gas") == {1: 10, 3: 5}
+
+
+def test_aggregates_are_rebuilt_when_out_of_sync():
+    state = MonthlyState(
+        monthly_income=100, fixed_expenses=[], transactions=[transaction("Gas", 10, 1)]
+    )
+    assert state.total_spent == 10
+
+    state.transactions.append(transaction("Gas", 5, 2))
+    assert state.total_spent == 15
+    assert state.category_totals == {"Gas": 15}
+
+
+def test_monthly_report_excludes_transactions_after_end_time(db):
+    state = db.state["06/22"]
+    state.add_transaction(transaction("Grocery", 500, 25))
+
+    report = get_monthly_report(db, state, datetime(2022, 6, 20))
+    assert report.totals.spent == 2500
+    assert report.categories["Grocery"].total == 1000
+    assert len(report.categories["Grocery"].transactions) == 1
+
+    report = get_monthly_report(db, state, datetime(2022, 6, 30))
+    assert report.categories["Grocery"].total == 1500
+    assert len(report.categories["Grocery"].transactions) == 2
+
+
+def test_category_total_until_day_ignores_insertion_order():
+    state = MonthlyState(monthly_income=100, fixed_expenses=[], transactions=[])
+    for category, amount, day in [("Gas", 1, 20), ("Gas", 2, 3), ("Grocery", 4, 3), ("Gas", 8, 10)]:
+        state.add_transaction(transaction(category, amount, day))
+
+    assert state.category_total_until_day("Gas", 2) == 0
+    assert state.category_total_until_day("Gas", 10) == 10
+    assert state.category_total_until_day("Gas", 31) == 11
+    assert state.category_total_until_day("Unknown", 31) == 0
+
+    state.add_transaction(transaction("Gas", 16, 5))
+    assert state.category_total_until_day("Gas", 10) == 26
+
+
+def test_monthly_report_compares_january_with_previous_december():
+    db = ApplicationState(
+        users=[],
+        last_accessed=datetime(2023, 1, 1),
+        defaults={"monthly_income": 100, "fixed_expenses": []},
+        variable_categories=[],
+        fixed_categories=[],
+        state={},
+    )
+    db.add_transaction(
+        Transaction(category="Gas", amount=50, created_at=datetime(2022, 12, 2), user="a")
+    )
+    db.add_transaction(
+        Transaction(category="Gas", amount=100, created_at=datetime(2023, 1, 2), user="a")
+    )
+
+    report = get_monthly_report(db, db.get_month("01/23"), datetime(2023, 1, 3))
+    assert report.categories["Gas"].vs_previous_month == 100
+
+
+def test_month_keys_between_crosses_years():
+    assert month_keys_between("11/21", "02/22") == ["11/21", "12/21", "01/22", "02/22"]
+
+
+def test_range_report_merges_months_and_compares_years():
+    def month(income: int, **categories: int) -> SpendingTotals:
+        spent = sum(categories.values())
+        return SpendingTotals(income=income, spent=spent, net=income - spent, categories=categories)
+
+    totals = {
+        "01/21": month(100, Gas=10),
+        "01/22": month(100, Gas=30, Grocery=5),
+        "02/22": month(200, Grocery=20),
+    }
+    report = get_range_report("01/22", "03/22", totals.get)
+
+    assert [m.month for m in report.months] == ["01/22", "02/22"]
+    assert report.totals.income == 300
+    assert report.totals.categories == {"Gas": 30, "Grocery": 25}
+    assert report.months[0].vs_previous_year.categories == {"Gas": 20, "Grocery": 5}
+    assert report.months[1].vs_previous_year is None
+    # only January has a month to compare with
+    assert report.vs_previous_year.spent == 25
+
+
+def test_ordered_positions_follow_created_at():
+    state = MonthlyState(monthly_income=100, fixed_expenses=[], transactions=[])
+    state.add_transaction(transaction("Gas", 10, 2))
+    state.add_transaction(transaction("Grocery", 20, 3))
+    assert [i for _, i in state.ordered_positions()] == [0, 1]
+    assert [i for _, i in state.ordered_positions(category="Gas")] == [0]
+
+    # in order, so the indexes are extended
+    state.add_transaction(transaction("Gas", 5, 4))
+    assert [i for _, i in state.ordered_positions(category="Gas")] == [0, 2]
+
+    # out of order, so they are rebuilt
+    state.add_transaction(transaction("Gas", 1, 1))
+    assert [i for _, i in state.ordered_positions(category="Gas", user="a")] == [3, 0, 2]
+    assert state.ordered_positions(user="b") == []
+
+
+def test_snapshot_shares_months_until_they_change():
+    db = ApplicationState(**default_state)
+    db.add_transaction(transaction("Gas", 10, 2))
+    db.add_month("05/22", MonthlyState(monthly_income=100, fixed_expenses=[], transactions=[]))
+
+    snapshot = db.snapshot()
+    assert snapshot.state["06/22"] is db.state["06/22"]
+
+    db.add_transaction(transaction("Grocery", 20, 3))
+
+    assert snapshot.version < db.version
+    assert [t.amount for t in snapshot.state["06/22"].transactions] == [10]
+    assert snapshot.state["06/22"].category_totals == {"Gas": 10}
+    assert db.state["06/22"].category_totals == {"Gas": 10, "Grocery": 20}
+    # only the changed month was copied
+    assert snapshot.state["05/22"] is db.state["05/22"]
+
+    with pytest.raises(TypeError):
+        snapshot.add_transaction(transaction("Gas", 1, 4))
+
+
+def test_snapshot_keeps_months_that_were_not_loaded_as_they_were():
+    def empty_month():
+        return MonthlyState(monthly_income=100, fixed_expenses=[], transactions=[])
+
+    # stands in for the storage backend
+    stored = {"05/22": empty_month(), "06/22": empty_month()}
+
+    def persist(key):
+        stored[key] = db.state[key].copy(deep=True)
+        db.mark_clean()
+
+    db = ApplicationState(**default_state)
+    db.set_month_loader(
+        lambda key: stored[key].copy(deep=True) if key in stored else None,
+        lambda: list(stored),
+        cache_size=1,
+    )
+    snapshot = db.snapshot()
+
+    db.add_transaction(
+        Transaction(category="Gas", amount=10, created_at=datetime(2022, 5, 2), user="a")
+    )
+    persist("05/22")
+    db.add_transaction(transaction("Gas", 20, 2))
+    persist("06/22")
+    db.add_month("07/22", empty_month())
+    persist("07/22")
+    # evicted, and loaded again from what was persisted
+    assert "05/22" not in db.state
+    assert len(db.get_month("05/22").transactions) == 1
+
+    assert snapshot.month_keys() == ["05/22", "06/22"]
+    assert snapshot.get_month("05/22").transactions == []
+    assert snapshot.get_month("06/22").transactions == []
+    assert snapshot.get_month("07/22") is None
+
+
+def test_snapshot_does_not_keep_the_months_it_loads():
+    stored = {
+        f"{month:02}/22": MonthlyState(monthly_income=month, fixed_expenses=[], transactions=[])
+        for month in range(1, 13)
+    }
+    db = ApplicationState(**default_state)
+    db.set_month_loader(lambda key: stored.get(key), lambda: list(stored), cache_size=2)
+
+    snapshot = db.snapshot()
+    for _ in range(2):
+        incomes = [snapshot.get_month(key).monthly_income for key in snapshot.month_keys()]
+        assert incomes == list(range(1, 13))
+    assert snapshot.state == {}
+
+    # nor does the state keep the snapshot
+    del snapshot
+    gc.collect()
+    assert len(db._snapshot_loaders) == 0
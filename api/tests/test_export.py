@@ -0,0 +1,77 @@
+import asyncio
+import json
+from datetime import date, datetime
+
+from api import export
+from api.db import default_state
+from api.domain import ApplicationState, Transaction
+from api.export import export_csv, export_ndjson, iter_transactions
+
+
+def make_db(*days: datetime) -> ApplicationState:
+    db = ApplicationState(**default_state)
+    for i, day in enumerate(days):
+        db.add_transaction(
+            Transaction(category="Gas", amount=i, created_at=day, user="a@example.com")
+        )
+    return db
+
+
+async def collect(chunks):
+    return [chunk async for chunk in chunks]
+
+
+def test_iter_transactions_is_chronological_across_months():
+    db = make_db(datetime(2022, 6, 3), datetime(2021, 12, 31), datetime(2022, 6, 1))
+
+    days = [t.created_at.day for t in iter_transactions(db)]
+    assert days == [31, 1, 3]
+
+
+def test_iter_transactions_filters_by_inclusive_dates():
+    db = make_db(
+        datetime(2022, 4, 30, 12),
+        datetime(2022, 5, 1),
+        datetime(2022, 5, 31, 23),
+        datetime(2022, 6, 1),
+    )
+
+    transactions = iter_transactions(db, date(2022, 5, 1), date(2022, 5, 31))
+    assert [t.amount for t in transactions] == [1, 2]
+
+
+def test_export_csv_sends_header_first_and_chunks_rows(monkeypatch):
+    monkeypatch.setattr(export, "EXPORT_CHUNK_SIZE", 2)
+    db = make_db(*[datetime(2022, 6, day) for day in range(1, 6)])
+
+    chunks = asyncio.run(collect(export_csv(db)))
+
+    assert chunks[0] == "created_at,category,amount,title,notes,user\r\n"
+    assert len(chunks) == 4
+    assert chunks[1].startswith("2022-06-01T00:00:00,Gas,0,,,a@example.com\r\n")
+
+
+def test_export_ndjson_has_one_transaction_per_line():
+    db = make_db(datetime(2022, 6, 1), datetime(2022, 6, 2))
+
+    lines = "".join(asyncio.run(collect(export_ndjson(db)))).splitlines()
+
+    assert [json.loads(line)["amount"] for line in lines] == [0, 1]
+    assert "password_hash" not in lines[0]
+
+
+def test_export_of_snapshot_leaves_out_later_transactions(monkeypatch):
+    monkeypatch.setattr(export, "EXPORT_CHUNK_SIZE", 1)
+    db = make_db(datetime(2022, 6, 1), datetime(2022, 7, 1))
+
+    async def run():
+        chunks = export_ndjson(db.snapshot())
+        first = await chunks.__anext__()
+        db.add_transaction(
+            Transaction(
+                category="Gas", amount=9, created_at=datetime(2022, 7, 2), user="a@example.com"
+            )
+        )
+        return [first] + await collect(chunks)
+
+    assert len(asyncio.run(run())) == 2
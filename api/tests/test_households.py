@@ -0,0 +1,84 @@
+import json
+import os
+import time
+from datetime import datetime
+
+import pytest
+from api import config
+from api.domain import Transaction
+from api.households import HouseholdPool, UnknownHousehold
+
+
+@pytest.fixture
+def pool(tmp_path):
+    pool = HouseholdPool(str(tmp_path), max_size=2)
+    yield pool
+    pool.close()
+
+
+def gas(amount: int) -> Transaction:
+    return Transaction(category="Gas", amount=amount, created_at=datetime.now(), user="a")
+
+
+def test_households_have_separate_states(pool):
+    first, second = pool.create(), pool.create()
+
+    pool.get(first).db.add_transaction(gas(100))
+
+    assert pool.get(first).db.get_current_state().total_spent == 100
+    assert pool.get(second).db.get_current_state().total_spent == 0
+
+
+def test_least_recently_used_household_is_flushed_and_evicted(pool, tmp_path):
+    first, second = pool.create(), pool.create()
+    household = pool.get(first)
+    # changed, but not persisted yet
+    household.db.add_transaction(gas(100))
+    pool.get(second)
+
+    pool.create()
+
+    assert len(pool) == 2
+    # written in the background
+    household.backend.close()
+    with open(tmp_path / f"{first}.json") as file:
+        months = json.loads(file.read())["state"]
+    assert [t["amount"] for month in months.values() for t in month["transactions"]] == [100]
+    # loaded again on demand
+    assert pool.get(first).db.get_current_state().total_spent == 100
+
+
+def test_unknown_households_are_not_created(pool, tmp_path):
+    with pytest.raises(UnknownHousehold):
+        pool.get("0123456789abcdef")
+    with pytest.raises(UnknownHousehold):
+        pool.get("../db")
+
+    assert os.listdir(tmp_path) == []
+
+
+def test_eviction_does_not_wait_for_the_disk(pool, monkeypatch):
+    monkeypatch.setattr(config, "DB_FLUSH_INTERVAL", 0.5)
+    first = pool.create()
+    pool.get(first).db.add_transaction(gas(100))
+    pool.create()
+
+    start = time.perf_counter()
+    pool.create()
+    assert time.perf_counter() - start < 0.25
+    assert len(pool) == 2
+
+    # loading it again waits for its changes to be written
+    assert pool.get(first).db.get_current_state().total_spent == 100
+
+
+def test_evicted_states_are_not_loaded(pool):
+    first = pool.create()
+    db = pool.get(first).db
+    pool.create()
+    pool.create()
+
+    assert pool.loaded(first) is None
+    # loading it again makes a new state, so the evicted one must not be saved
+    assert pool.get(first).db is not db
+    assert pool.loaded(first).db is pool.get(first).db
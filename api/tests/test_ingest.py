@@ -0,0 +1,88 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+from api.domain import ApplicationState
+from api.db import default_state
+from api.ingest import TransactionImport, iter_lines, read_csv, read_ndjson
+
+
+async def chunked(data: bytes, size: int):
+    for i in range(0, len(data), size):
+        yield data[i:i + size]
+
+
+def run_import(read, data: bytes, size: int = 7):
+    db = ApplicationState(**default_state)
+    importer = TransactionImport("a@example.com", get_now=lambda: datetime(2022, 6, 1))
+    asyncio.run(read(importer, chunked(data, size)))
+    return db, importer.apply(db)
+
+
+def test_iter_lines_reassembles_lines_across_chunks():
+    async def collect():
+        return [line async for line in iter_lines(chunked(b"ab\r\ncd\nef", 3))]
+
+    assert asyncio.run(collect()) == ["ab", "cd", "ef"]
+
+
+def test_read_csv_handles_quotes_and_bad_rows():
+    data = (
+        b'category,amount,title\n'
+        b'Gas,100,"a, ""quoted"" title"\n'
+        b'Gas,100\n'
+        b'\n'
+        b'Grocery,200,"multi\nline"\n'
+    )
+    db, report = run_import(read_csv, data)
+
+    assert report.imported == 2
+    assert [(e.row, e.error) for e in report.errors] == [(2, "expected 3 columns, got 2")]
+    titles = [t.title for t in db.state["06/22"].transactions]
+    assert titles == ['a, "quoted" title', "multi\nline"]
+
+
+def test_read_ndjson_routes_rows_by_created_at():
+    data = (
+        b'{"category": "Gas", "amount": 1, "created_at": "2022-05-31T23:59:00"}\n'
+        b'{"category": "Gas", "amount": 2}\n'
+        b'[1, 2]\n'
+        b'{"category": "Gas", "amount": 3'
+    )
+    db, report = run_import(read_ndjson, data)
+
+    assert report.imported == 2
+    assert [e.row for e in report.errors] == [3, 4]
+    assert [t.amount for t in db.state["05/22"].transactions] == [1]
+    assert [t.amount for t in db.state["06/22"].transactions] == [2]
+
+
+def test_lines_that_are_not_utf8_are_reported():
+    db, report = run_import(read_csv, b"category,amount,title\nGas,100,caf\xe9\nGas,200,cafe\n")
+
+    assert report.imported == 1
+    assert [(e.row, e.error) for e in report.errors] == [(1, "not valid UTF-8")]
+
+    data = b'{"category": "Gas", "amount": 1, "title": "caf\xe9"}\n{"category": "Gas", "amount": 2}'
+    db, report = run_import(read_ndjson, data)
+
+    assert report.imported == 1
+    assert [(e.row, e.error) for e in report.errors] == [(1, "not valid UTF-8")]
+
+
+def test_times_with_an_offset_are_made_local():
+    data = (
+        b'{"category": "Gas", "amount": 1, "created_at": "2022-06-10T10:00:00Z"}\n'
+        b'{"category": "Gas", "amount": 2, "created_at": "2022-06-10T10:00:00+02:00"}\n'
+        b'{"category": "Gas", "amount": 3, "created_at": "2022-06-10T10:00:00"}'
+    )
+    db, report = run_import(read_ndjson, data)
+
+    assert report.imported == 3
+    utc = datetime(2022, 6, 10, 10, tzinfo=timezone.utc)
+    expected = [
+        utc.astimezone().replace(tzinfo=None),
+        (utc - timedelta(hours=2)).astimezone().replace(tzinfo=None),
+        datetime(2022, 6, 10, 10),
+    ]
+    assert sorted(t.created_at for t in db.state["06/22"].transactions) == sorted(expected)
+    assert db.state["06/22"].total_spent == 6
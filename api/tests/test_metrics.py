@@ -0,0 +1,47 @@
+import pytest
+from api import metrics
+
+
+@pytest.fixture(autouse=True)
+def registry(monkeypatch):
+    monkeypatch.setattr(metrics, "_registry", [])
+
+
+def test_counter_renders_labels():
+    counter = metrics.Counter("things_total", "Things")
+    counter.inc(kind='a "quoted" thing')
+    counter.inc(2, kind='a "quoted" thing')
+    counter.inc()
+
+    assert metrics.render() == (
+        "# HELP things_total Things\n"
+        "# TYPE things_total counter\n"
+        'things_total{kind="a \\"quoted\\" thing"} 3\n'
+        "things_total 1\n"
+    )
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = metrics.Histogram("latency_seconds", "Latency", buckets=[0.1, 1])
+    for value in [0.05, 0.5, 0.7, 3]:
+        histogram.observe(value, route="/x")
+
+    lines = metrics.render().splitlines()[2:]
+    assert lines == [
+        'latency_seconds_bucket{route="/x",le="0.1"} 1',
+        'latency_seconds_bucket{route="/x",le="1"} 3',
+        'latency_seconds_bucket{route="/x",le="+Inf"} 4',
+        'latency_seconds_sum{route="/x"} 4.25',
+        'latency_seconds_count{route="/x"} 4',
+    ]
+
+
+def test_gauge_is_read_on_render_and_skipped_when_unavailable():
+    values = [7]
+    metrics.Gauge("items", "Items", lambda: values[0])
+    metrics.Gauge("broken", "Broken", lambda: 1 / 0)
+
+    assert metrics.render().splitlines()[-1] == "items 7"
+    values[0] = 8
+    assert "broken" not in metrics.render()
+    assert metrics.render().splitlines()[-1] == "items 8"
@@ -0,0 +1,56 @@
+import threading
+
+import pytest
+import requests
+from api.bench.load import run_server
+
+SHARED = {
+    "DB_MULTIPROCESS": "1",
+    "DB_MODE": "log",
+    # low enough that the processes compact each other's changes too
+    "DB_COMPACT_THRESHOLD": "25",
+    "DB_DURABILITY": "os",
+    "AUTH_BCRYPT_ROUNDS": "4",
+}
+
+
+@pytest.fixture
+def servers(tmp_path):
+    started = []
+    try:
+        for _ in range(2):
+            started.append(run_server(str(tmp_path), env=SHARED))
+        yield [url for url, _ in started]
+    finally:
+        for _, server in started:
+            server.terminate()
+            server.wait()
+
+
+def test_processes_sharing_the_database_lose_no_writes(servers):
+    first, second = servers
+    user = {"name": "A", "email": "a@example.com", "password": "1234"}
+    requests.post(f"{first}/accounts/create", json=user).raise_for_status()
+
+    failures = []
+
+    def post(url: str, count: int):
+        session = requests.Session()
+        session.post(f"{url}/accounts/login", json=user).raise_for_status()
+        for i in range(count):
+            response = session.post(f"{url}/transactions", json={"category": "Gas", "amount": i})
+            if response.status_code != 201:
+                failures.append(response.status_code)
+
+    threads = [threading.Thread(target=post, args=(servers[i % 2], 20)) for i in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert failures == []
+    for url in [first, second]:
+        session = requests.Session()
+        session.post(f"{url}/accounts/login", json=user).raise_for_status()
+        page = session.get(f"{url}/transactions", params={"limit": 500}).json()
+        assert len(page["transactions"]) == 120
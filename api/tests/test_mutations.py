@@ -0,0 +1,149 @@
+import asyncio
+from collections import OrderedDict
+from datetime import datetime
+
+import pytest
+from api import config, db as db_module, mutations
+from api.db import _delete_db_singleton, get_db_instance
+from api.domain import Transaction
+from api.households import get_pool
+from api.mutations import MutationQueue
+
+pytestmark = pytest.mark.usefixtures("clean_db")
+
+
+def make_transaction(amount: int) -> Transaction:
+    return Transaction(
+        category="Gas", amount=amount, created_at=datetime.now(), user="foo@bar.com"
+    )
+
+
+def add(transaction: Transaction):
+    def apply(db):
+        db.add_transaction(transaction)
+        return db.version
+
+    return apply
+
+
+def test_concurrent_changes_are_applied_in_order_and_written_together(monkeypatch):
+    writes = []
+    persist_household = mutations.persist_household
+
+    def counting_persist_household(household, db):
+        writes.append(db.version)
+        return persist_household(household, db)
+
+    monkeypatch.setattr(mutations, "persist_household", counting_persist_household)
+    queue = MutationQueue(max_batch=100)
+
+    async def run():
+        return await asyncio.gather(*(queue.submit(add(make_transaction(i))) for i in range(50)))
+
+    versions = asyncio.run(run())
+
+    assert versions == sorted(versions)
+    assert len(set(versions)) == 50
+    # the first change starts a batch, everything queued meanwhile is the next
+    assert len(writes) <= 2
+
+    _delete_db_singleton()
+    amounts = [t.amount for t in get_db_instance().get_current_state().transactions]
+    assert amounts == list(range(50))
+
+
+def test_batches_are_limited(monkeypatch):
+    writes = []
+    persist_household = mutations.persist_household
+    monkeypatch.setattr(
+        mutations,
+        "persist_household",
+        lambda household, db: writes.append(1) or persist_household(household, db),
+    )
+    queue = MutationQueue(max_batch=4)
+
+    async def run():
+        await asyncio.gather(*(queue.submit(add(make_transaction(i))) for i in range(10)))
+
+    asyncio.run(run())
+
+    assert len(writes) >= 3
+
+
+def test_failed_change_does_not_affect_the_others():
+    queue = MutationQueue(max_batch=100)
+
+    def fail(db):
+        raise ValueError("nope")
+
+    async def run():
+        return await asyncio.gather(
+            queue.submit(add(make_transaction(1))),
+            queue.submit(fail),
+            queue.submit(add(make_transaction(2))),
+            return_exceptions=True,
+        )
+
+    first, failed, last = asyncio.run(run())
+
+    assert isinstance(failed, ValueError)
+    assert last > first
+    assert len(get_db_instance().get_current_state().transactions) == 2
+
+
+def test_changes_whose_write_failed_are_written_with_the_next_batch(monkeypatch):
+    queue = MutationQueue(max_batch=100)
+    atomic_write = db_module.atomic_write
+
+    def fail(path, contents, fsync):
+        raise OSError("No space left on device")
+
+    async def run():
+        monkeypatch.setattr(db_module, "atomic_write", fail)
+        with pytest.raises(OSError):
+            await queue.submit(add(make_transaction(1)))
+
+        monkeypatch.setattr(db_module, "atomic_write", atomic_write)
+        await queue.submit(add(make_transaction(2)))
+
+    asyncio.run(run())
+
+    _delete_db_singleton()
+    amounts = [t.amount for t in get_db_instance().get_current_state().transactions]
+    assert amounts == [1, 2]
+
+
+def test_close_writes_what_is_left_over_from_failed_writes(monkeypatch):
+    atomic_write = db_module.atomic_write
+
+    def fail(path, contents, fsync):
+        raise OSError("No space left on device")
+
+    async def run():
+        monkeypatch.setattr(db_module, "atomic_write", fail)
+        with pytest.raises(OSError):
+            await mutations.submit(add(make_transaction(1)))
+
+        monkeypatch.setattr(db_module, "atomic_write", atomic_write)
+        await mutations.close()
+
+    asyncio.run(run())
+
+    _delete_db_singleton()
+    amounts = [t.amount for t in get_db_instance().get_current_state().transactions]
+    assert amounts == [1]
+
+
+def test_idle_writers_of_households_are_dropped(monkeypatch):
+    monkeypatch.setattr(config, "DB_HOUSEHOLD_CACHE_SIZE", 2)
+    monkeypatch.setattr(mutations, "_queues", OrderedDict())
+    households = [get_pool().create() for _ in range(4)]
+
+    async def run():
+        await mutations.submit(add(make_transaction(1)))
+        for household in households:
+            await mutations.submit(add(make_transaction(1)), household)
+
+    asyncio.run(run())
+
+    assert list(mutations._queues) == [None, *households[-2:]]
@@ -0,0 +1,115 @@
+import json
+import os
+from datetime import datetime
+
+import pytest
+from api import config
+from api.db import JsonBackend, migrate
+from api.domain import ApplicationState, Transaction, User
+from api.sharded_db import ShardedBackend
+
+
+def add_transaction(db: ApplicationState, month: int, amount: int):
+    db.add_transaction(
+        Transaction(category="Gas", amount=amount, created_at=datetime(2022, month, 1), user="a")
+    )
+
+
+def test_months_are_stored_and_loaded_separately(tmp_path):
+    backend = ShardedBackend(str(tmp_path))
+    db = backend.load()
+    db.add_user(User(name="A", email="a@example.com"))
+    add_transaction(db, 5, 1)
+    add_transaction(db, 6, 2)
+    backend.persist(db).result()
+    backend.close()
+
+    assert sorted(os.listdir(tmp_path / "months")) == ["05-22.json", "06-22.json"]
+
+    backend = ShardedBackend(str(tmp_path))
+    db = backend.load()
+    assert db.users[0].email == "a@example.com"
+    assert db.state == {}
+    assert db.month_keys() == ["05/22", "06/22"]
+    assert db.get_month("06/22").transactions[0].amount == 2
+    assert list(db.state.keys()) == ["06/22"]
+    backend.close()
+
+
+def test_only_dirty_months_are_rewritten(tmp_path):
+    backend = ShardedBackend(str(tmp_path))
+    db = backend.load()
+    add_transaction(db, 5, 1)
+    add_transaction(db, 6, 2)
+    backend.persist(db).result()
+    may_mtime = os.stat(tmp_path / "months" / "05-22.json").st_mtime_ns
+
+    add_transaction(db, 6, 3)
+    backend.persist(db).result()
+    backend.close()
+
+    assert os.stat(tmp_path / "months" / "05-22.json").st_mtime_ns == may_mtime
+    with open(tmp_path / "months" / "06-22.json", "r") as month_file:
+        assert len(json.loads(month_file.read())["transactions"]) == 2
+
+
+def test_failed_write_is_retried_with_the_next_one(tmp_path, monkeypatch):
+    backend = ShardedBackend(str(tmp_path))
+    db = backend.load()
+    add_transaction(db, 5, 1)
+
+    def fail(path, contents, fsync):
+        raise OSError("Read-only file system")
+
+    with monkeypatch.context() as patch:
+        patch.setattr("api.sharded_db.atomic_write", fail)
+        with pytest.raises(OSError):
+            backend.persist(db).result()
+
+    add_transaction(db, 6, 2)
+    backend.persist(db).result()
+    backend.close()
+
+    backend = ShardedBackend(str(tmp_path))
+    db = backend.load()
+    assert db.month_keys() == ["05/22", "06/22"]
+    assert db.get_month("05/22").transactions[0].amount == 1
+    backend.close()
+
+
+def test_least_recently_used_clean_months_are_evicted(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "DB_MONTH_CACHE_SIZE", 2)
+    backend = ShardedBackend(str(tmp_path))
+    db = backend.load()
+    for month in [1, 2, 3]:
+        add_transaction(db, month, month)
+    # dirty months are never evicted
+    assert len(db.state) == 3
+
+    backend.persist(db).result()
+    db.get_month("01/22")
+    db.get_month("03/22")
+    db.get_month("02/22")
+    assert list(db.state.keys()) == ["03/22", "02/22"]
+
+    # evicted months are loaded again on demand
+    assert db.get_month("01/22").transactions[0].amount == 1
+    assert list(db.state.keys()) == ["02/22", "01/22"]
+    backend.close()
+
+
+def test_migrate_from_json(tmp_path):
+    fixture = os.path.join(os.path.dirname(__file__), "fixtures", "test_db_state.json")
+    source = JsonBackend(fixture, str(tmp_path / "unused.log"))
+    target = ShardedBackend(str(tmp_path / "shards"))
+    migrate(source, target)
+    expected = source.load()
+    source.close()
+    target.close()
+
+    backend = ShardedBackend(str(tmp_path / "shards"))
+    db = backend.load()
+    db.load_all_months()
+    backend.close()
+    assert db.dict(exclude={"state"}) == expected.dict(exclude={"state"})
+    assert dict(db.state) == dict(expected.state)
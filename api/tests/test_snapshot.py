@@ -0,0 +1,87 @@
+import json
+import os
+from datetime import datetime
+
+import pytest
+from api.db import JsonBackend, default_state, serialize_state
+from api.domain import ApplicationState, Transaction, User
+from api.snapshot import SnapshotError, decode_snapshot, encode_snapshot
+
+
+def make_state() -> ApplicationState:
+    state = ApplicationState(**json.loads(json.dumps(default_state)))
+    state.add_user(User(name="A", email="a@example.com", password_hash="hash"))
+    for day in [3, 1, 2]:
+        state.add_transaction(
+            Transaction(
+                category="Gas",
+                amount=day * 100,
+                created_at=datetime(2022, 6, day, 12, 30),
+                user="a@example.com",
+                title="Fill up" if day != 2 else None,
+            )
+        )
+    state.add_transaction(
+        Transaction(category="Grocery", amount=5, created_at=datetime(2022, 5, 1), user="b")
+    )
+    return state
+
+
+def test_snapshot_round_trip_matches_json():
+    state = make_state()
+
+    decoded = decode_snapshot(encode_snapshot(state))
+
+    assert serialize_state(decoded) == serialize_state(state)
+    assert decoded.state["06/22"].category_totals == {"Gas": 600}
+    assert decoded.get_user("A@example.com").name == "A"
+
+
+def test_snapshot_detects_corruption():
+    data = bytearray(encode_snapshot(make_state()))
+
+    with pytest.raises(SnapshotError):
+        decode_snapshot(bytes(data[:-1]))
+
+    data[-5] ^= 0xFF
+    with pytest.raises(SnapshotError):
+        decode_snapshot(bytes(data))
+
+    with pytest.raises(SnapshotError):
+        decode_snapshot(b'{"users": []}')
+
+
+def test_snapshot_only_reencodes_changed_months():
+    state = make_state()
+    encode_snapshot(state)
+    state.mark_clean()
+    cached = state._serialized_months["columnar"]["05/22"]
+
+    state.add_transaction(
+        Transaction(category="Gas", amount=1, created_at=datetime(2022, 6, 4), user="a")
+    )
+    decoded = decode_snapshot(encode_snapshot(state))
+
+    assert state._serialized_months["columnar"]["05/22"] is cached
+    assert len(decoded.state["06/22"].transactions) == 4
+
+
+def test_json_backend_converts_between_formats(tmp_path):
+    path, log_path = str(tmp_path / "db.json"), str(tmp_path / "db.json.log")
+    binary_path = str(tmp_path / "db.bin")
+    with open(path, "w") as file:
+        file.write(serialize_state(make_state()))
+
+    backend = JsonBackend(path, log_path, binary_path, snapshot_format="binary")
+    state = backend.load()
+    backend.close()
+    assert not os.path.exists(path)
+    assert os.path.exists(binary_path)
+    assert len(state.state["06/22"].transactions) == 3
+
+    backend = JsonBackend(path, log_path, binary_path)
+    state = backend.load()
+    backend.close()
+    assert not os.path.exists(binary_path)
+    with open(path, "r") as file:
+        assert json.loads(file.read())["users"][0]["email"] == "a@example.com"
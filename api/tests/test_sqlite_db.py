@@ -0,0 +1,143 @@
+import json
+import os
+import sqlite3
+from datetime import datetime
+
+import pytest
+from api import config
+from api.db import JsonBackend, get_db_instance, migrate, persist_changes, _delete_db_singleton
+from api.domain import ApplicationState, Transaction, User
+from api.sqlite_db import SqliteBackend
+
+
+@pytest.fixture
+def sqlite_path(tmp_path):
+    return str(tmp_path / "db.sqlite3")
+
+
+def test_new_database_starts_from_defaults(sqlite_path):
+    backend = SqliteBackend(sqlite_path)
+    db = backend.load()
+    backend.close()
+
+    assert db.users == []
+    assert db.defaults.monthly_income == 570000
+    assert db.fixed_categories == ["Mortgage", "Insurance", "Giving"]
+
+
+def test_changes_are_written_incrementally_and_months_loaded_lazily(sqlite_path):
+    backend = SqliteBackend(sqlite_path)
+    db = backend.load()
+    db.add_user(User(name="A", email="a@example.com", password_hash="asdf"))
+    for day in [1, 2]:
+        db.add_transaction(
+            Transaction(category="Gas", amount=day, created_at=datetime(2022, 6, day), user="a")
+        )
+    db.add_transaction(
+        Transaction(category="Gas", amount=3, created_at=datetime(2022, 5, 1), user="a")
+    )
+    backend.persist(db).result()
+    backend.close()
+
+    backend = SqliteBackend(sqlite_path)
+    db = backend.load()
+    assert db.users[0].email == "a@example.com"
+    assert db.version == 6
+    assert db.state == {}
+
+    june = db.get_month("06/22")
+    assert [t.amount for t in june.transactions] == [1, 2]
+    assert list(db.state.keys()) == ["06/22"]
+
+    db.load_all_months()
+    assert set(db.state.keys()) == {"05/22", "06/22"}
+    backend.close()
+
+
+def test_failed_write_is_retried_with_the_next_one(sqlite_path, monkeypatch):
+    backend = SqliteBackend(sqlite_path)
+    db = backend.load()
+    db.add_transaction(
+        Transaction(category="Gas", amount=1, created_at=datetime(2022, 6, 1), user="a")
+    )
+
+    def fail(record):
+        raise sqlite3.OperationalError("disk I/O error")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(backend, "_apply_record", fail)
+        with pytest.raises(sqlite3.OperationalError):
+            backend.persist(db).result()
+
+    # nothing new, but the failed write is still pending
+    backend.persist(db).result()
+    backend.close()
+
+    backend = SqliteBackend(sqlite_path)
+    db = backend.load()
+    assert [t.amount for t in db.get_month("06/22").transactions] == [1]
+    backend.close()
+
+
+def test_households_are_kept_also_in_older_databases(sqlite_path):
+    backend = SqliteBackend(sqlite_path)
+    db = backend.load()
+    db.add_user(User(name="A", email="a@example.com"))
+    backend.persist(db).result()
+    backend.close()
+    # as created before users had households
+    conn = sqlite3.connect(sqlite_path)
+    conn.executescript(
+        "CREATE TABLE old_users AS SELECT id, name, email, password_hash FROM users;"
+        "DROP TABLE users;"
+        "ALTER TABLE old_users RENAME TO users;"
+    )
+    conn.close()
+
+    backend = SqliteBackend(sqlite_path)
+    db = backend.load()
+    db.set_household(db.get_user("a@example.com"), "abc")
+    db.set_household_invite(db.get_user("a@example.com"), "def")
+    backend.persist(db).result()
+    backend.close()
+
+    backend = SqliteBackend(sqlite_path)
+    user = backend.load().get_user("a@example.com")
+    backend.close()
+    assert (user.household, user.household_invite) == ("abc", "def")
+
+
+def test_migrate_from_json(tmp_path, sqlite_path):
+    fixture = os.path.join(os.path.dirname(__file__), "fixtures", "test_db_state.json")
+    with open(fixture, "r") as fixture_file:
+        expected = ApplicationState(**json.loads(fixture_file.read()))
+    json_path = str(tmp_path / "db.json")
+    with open(json_path, "w") as json_file:
+        json_file.write(expected.json())
+
+    source, target = JsonBackend(json_path, f"{json_path}.log"), SqliteBackend(sqlite_path)
+    migrate(source, target)
+    source.close()
+    target.close()
+
+    backend = SqliteBackend(sqlite_path)
+    db = backend.load()
+    db.load_all_months()
+    backend.close()
+    assert db == expected
+
+
+def test_db_instance_uses_configured_backend(monkeypatch, sqlite_path):
+    monkeypatch.setattr(config, "DB_BACKEND", "sqlite")
+    monkeypatch.setattr(config, "DB_SQLITE_PATH", sqlite_path)
+    _delete_db_singleton()
+
+    try:
+        db = get_db_instance()
+        db.add_user(User(name="A", email="a@example.com"))
+        persist_changes(db).result()
+
+        _delete_db_singleton()
+        assert get_db_instance().users[0].email == "a@example.com"
+    finally:
+        _delete_db_singleton()
@@ -1,8 +1,15 @@
 import os
-from api.config import DB_PATH
+import shutil
+from api.config import DB_BINARY_PATH, DB_HOUSEHOLD_DIR, DB_LOG_PATH, DB_PATH
 from api.domain import User
-from api.db import get_db_instance, save_state_to_file, _delete_db_singleton
+from api.db import (
+    get_db_instance,
+    save_state_to_file,
+    wait_for_writes,
+    _delete_db_singleton,
+)
 from api.auth import AuthProvider
+from api.households import close_pool
 
 
 """
@@ -14,13 +21,22 @@ def util_create_user(name: str, email: str, password: str) -> User:
     db = get_db_instance()
     auth = AuthProvider(db=db)
 
+    # emails are unique, so tests re-using one replace the earlier user
+    existing = db.get_user(email)
+    if existing:
+        db.users.remove(existing)
+
     user = User(name=name, email=email, password_hash=auth.hash_pw(password))
-    db.users.append(user)
+    db.add_user(user)
     save_state_to_file(db)
 
     return user
 
 def reset_db():
-    if os.path.exists(DB_PATH):
-        os.remove(DB_PATH)
-        _delete_db_singleton()
\ No newline at end of file
+    close_pool()
+    wait_for_writes()
+    for path in [DB_LOG_PATH, DB_BINARY_PATH, DB_PATH]:
+        if os.path.exists(path):
+            os.remove(path)
+    shutil.rmtree(DB_HOUSEHOLD_DIR, ignore_errors=True)
+    _delete_db_singleton()
\ No newline at end of file
@@ -32,6 +32,35 @@ def test(args):
     return call(pytest_args)
 
 
+def migrate(args):
+    """
+    Copies the JSON database into the configured DB_BACKEND
+    """
+    migrate_args = ["pipenv", "run", "python", "-m", "api.db"]
+    if args.force:
+        migrate_args.append("--force")
+
+    return call(migrate_args)
+
+
+def bench(args):
+    """
+    Runs the benchmarks and compares them with the saved baseline
+    """
+    bench_args = ["pipenv", "run", "python", "-m", "api.bench"]
+    if args.save:
+        bench_args.append("--save")
+
+    return call(bench_args)
+
+
+def load(args):
+    """
+    Generates load against the app and reports throughput and latency
+    """
+    return call(["pipenv", "run", "python", "-m", "api.bench.load"] + args.extra)
+
+
 def dev(args):
     """
     Runs local API server
@@ -45,8 +74,14 @@ commands = (
     ("test", test, {"coverage": "Generate coverage report"}),
     ("dev", dev),
     ("lint", lint),
+    ("migrate", migrate, {"force": "Overwrite an existing database"}),
+    ("bench", bench, {"save": "Save the results as the new baseline"}),
+    ("load", load),
 )
 
+# commands that pass any further arguments on, e.g. `./x.py load --rate 50`
+passthrough = (load,)
+
 
 def main() -> int:
     parser = argparse.ArgumentParser()
@@ -61,7 +96,11 @@ def main() -> int:
             for argument, doc in command[2].items():
                 sub_parser.add_argument(f"--{argument}", action="store_true", help=doc)
 
-    args = parser.parse_args()
+    args, extra = parser.parse_known_args()
+    if extra and args.func not in passthrough:
+        parser.error(f"unrecognized arguments: {' '.join(extra)}")
+
+    args.extra = extra
     return args.func(args)
 
 